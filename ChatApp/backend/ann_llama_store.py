@@ -0,0 +1,110 @@
+import json
+import os
+import sys
+import threading
+from typing import Any, List, Optional
+
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode, MetadataMode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+from llama_index.core.vector_stores.utils import metadata_dict_to_node, node_to_metadata_dict
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from ann_index import IVFPQIndex, ann_params_from_env, matches
+
+NODESTORE_FILE = "nodestore.json"
+
+class ANNLlamaVectorStore(BasePydanticVectorStore):
+    """llama_index vector store backed by an in-process IVFPQIndex instead of Chroma."""
+
+    stores_text: bool = True
+    persist_dir: Optional[str] = None
+
+    _index: Any = PrivateAttr(default=None)
+    _index_params: dict = PrivateAttr(default_factory=dict)
+    _nodes: dict = PrivateAttr(default_factory=dict)
+    _lock: Any = PrivateAttr(default=None)
+
+    def __init__(self, persist_dir=None, mmap=True, **index_params):
+        super().__init__(persist_dir=persist_dir)
+        self._index_params = {**ann_params_from_env(), **index_params}
+        self._lock = threading.RLock()
+        if persist_dir and IVFPQIndex.exists(persist_dir):
+            self._index = IVFPQIndex.load(persist_dir, mmap=mmap, n_probe=self._index_params['n_probe'])
+            with open(os.path.join(persist_dir, NODESTORE_FILE)) as f:
+                self._nodes = json.load(f)
+
+    @property
+    def client(self) -> Any:
+        return self._index
+
+    def add(self, nodes: List[BaseNode], **kwargs: Any) -> List[str]:
+        if not nodes:
+            return []
+        ids = [node.node_id for node in nodes]
+        vectors = [node.get_embedding() for node in nodes]
+        with self._lock:
+            if self._index is None:
+                self._index = IVFPQIndex(len(vectors[0]), **self._index_params)
+            self._index.add(ids, vectors)
+            for node in nodes:
+                self._nodes[node.node_id] = {
+                    'text': node.get_content(metadata_mode=MetadataMode.NONE),
+                    'metadata': node_to_metadata_dict(node, remove_text=True, flat_metadata=False),
+                }
+        return ids
+
+    def get_ids(self, where=None):
+        with self._lock:
+            return [id_ for id_, entry in self._nodes.items() if matches(entry['metadata'], where)]
+
+    def get_nodes(self, node_ids: Optional[List[str]] = None, filters=None, **kwargs: Any) -> List[BaseNode]:
+        with self._lock:
+            node_ids = list(self._nodes) if node_ids is None else node_ids
+            return [
+                metadata_dict_to_node(self._nodes[id_]['metadata'], text=self._nodes[id_]['text'])
+                for id_ in node_ids if id_ in self._nodes
+            ]
+
+    def delete_nodes(self, node_ids: Optional[List[str]] = None, filters=None, **kwargs: Any) -> None:
+        with self._lock:
+            node_ids = node_ids or []
+            if self._index is not None:
+                self._index.delete(node_ids)
+            for node_id in node_ids:
+                self._nodes.pop(node_id, None)
+
+    def delete(self, ref_doc_id: str, **kwargs: Any) -> None:
+        self.delete_nodes(self.get_ids({'ref_doc_id': ref_doc_id}))
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        if query.filters is not None:
+            raise ValueError("Metadata filters are not supported by the ANN vector store")
+        with self._lock:
+            if self._index is None:
+                return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+            hits = self._index.search(query.query_embedding, query.similarity_top_k, n_probe=kwargs.get('n_probe'))
+            nodes = [
+                metadata_dict_to_node(self._nodes[id_]['metadata'], text=self._nodes[id_]['text'])
+                for id_, _ in hits
+            ]
+        return VectorStoreQueryResult(
+            nodes=nodes,
+            similarities=[similarity for _, similarity in hits],
+            ids=[id_ for id_, _ in hits],
+        )
+
+    def persist(self, persist_path: Optional[str] = None, fs=None) -> None:
+        # persist_path is ignored: the index always lives in persist_dir
+        if not self.persist_dir or self._index is None:
+            return
+        with self._lock:
+            self._index.save(self.persist_dir)
+            tmp_path = os.path.join(self.persist_dir, NODESTORE_FILE + '.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(self._nodes, f)
+            os.replace(tmp_path, os.path.join(self.persist_dir, NODESTORE_FILE))
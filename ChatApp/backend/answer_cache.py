@@ -0,0 +1,189 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+ANSWER_CACHE_SIZE = int(os.environ.get('ANSWER_CACHE_SIZE', 1024))
+ANSWER_CACHE_TTL = float(os.environ.get('ANSWER_CACHE_TTL', 24 * 3600))
+ANSWER_CACHE_PATH = os.environ.get('ANSWER_CACHE_PATH', '')
+ANSWER_CACHE_SEMANTIC_THRESHOLD = float(os.environ.get('ANSWER_CACHE_SEMANTIC_THRESHOLD', 0))
+
+def normalize_question(question):
+    question = re.sub(r'\s+', ' ', question).strip().lower()
+    return question.rstrip('?!. ')
+
+def hash_text(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class AnswerCache:
+    """LRU/TTL cache of answers keyed by normalized question + context hashes + variant.
+
+    variant names whatever else shapes an answer (the served model, generation
+    and packing settings), so changing any of them never serves an old answer.
+
+    When embed_fn is given and similarity_threshold > 0, a miss on the exact
+    key falls back to the most similar cached question asked against the same
+    contexts.
+    """
+
+    def __init__(self, max_entries=ANSWER_CACHE_SIZE, ttl_seconds=ANSWER_CACHE_TTL,
+                 persist_path=ANSWER_CACHE_PATH, embed_fn=None,
+                 similarity_threshold=ANSWER_CACHE_SEMANTIC_THRESHOLD):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.embed_fn = embed_fn
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if persist_path:
+            self._open(persist_path)
+
+    @property
+    def semantic_enabled(self):
+        return self.embed_fn is not None and self.similarity_threshold > 0
+
+    @staticmethod
+    def contexts_key(contexts, variant=''):
+        return hash_text(variant + '\0' + '\0'.join(hash_text(context) for context in contexts))
+
+    def key(self, question, contexts, variant=''):
+        return hash_text(normalize_question(question) + '\0' + self.contexts_key(contexts, variant))
+
+    def get(self, question, contexts, variant=''):
+        key = self.key(question, contexts, variant)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not self._expired(entry, now):
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return entry['answer']
+            if entry is not None:
+                self._remove(key)
+
+        if self.semantic_enabled:
+            answer = self._semantic_lookup(question, self.contexts_key(contexts, variant), now)
+            if answer is not None:
+                return answer
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, question, contexts, answer, variant=''):
+        key = self.key(question, contexts, variant)
+        embedding = None
+        if self.semantic_enabled:
+            embedding = self._normalize(self.embed_fn(normalize_question(question)))
+        entry = {
+            'answer': answer,
+            'contexts_key': self.contexts_key(contexts, variant),
+            'embedding': embedding,
+            'created_at': time.time(),
+        }
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?)",
+                    (key, answer, entry['contexts_key'],
+                     None if embedding is None else embedding.tobytes(), entry['created_at']),
+                )
+                self._db.commit()
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM answers")
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.exact_hits + self.semantic_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'exact_hits': self.exact_hits,
+                'semantic_hits': self.semantic_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0,
+                'semantic_enabled': self.semantic_enabled,
+            }
+
+    def _semantic_lookup(self, question, contexts_key, now):
+        query = self._normalize(self.embed_fn(normalize_question(question)))
+        with self._lock:
+            candidates = [
+                (key, entry) for key, entry in self._entries.items()
+                if entry['contexts_key'] == contexts_key
+                and entry['embedding'] is not None
+                and not self._expired(entry, now)
+            ]
+            if not candidates:
+                return None
+            matrix = np.stack([entry['embedding'] for _, entry in candidates])
+            scores = matrix @ query
+            best = int(np.argmax(scores))
+            if scores[best] < self.similarity_threshold:
+                return None
+            key, entry = candidates[best]
+            self._entries.move_to_end(key)
+            self.semantic_hits += 1
+            return entry['answer']
+
+    def _expired(self, entry, now):
+        return self.ttl_seconds > 0 and now - entry['created_at'] > self.ttl_seconds
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        if self._db is not None:
+            self._db.execute("DELETE FROM answers WHERE key = ?", (key,))
+            self._db.commit()
+
+    @staticmethod
+    def _normalize(embedding):
+        embedding = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    def _open(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            "key TEXT PRIMARY KEY, answer TEXT, contexts_key TEXT, embedding BLOB, created_at REAL)"
+        )
+        rows = self._db.execute(
+            "SELECT key, answer, contexts_key, embedding, created_at FROM answers ORDER BY created_at"
+        ).fetchall()
+        now = time.time()
+        stale = [(row[0],) for row in rows[:-self.max_entries]] if len(rows) > self.max_entries else []
+        for key, answer, contexts_key, embedding, created_at in rows[-self.max_entries:]:
+            entry = {
+                'answer': answer,
+                'contexts_key': contexts_key,
+                'embedding': None if embedding is None else np.frombuffer(embedding, dtype=np.float32),
+                'created_at': created_at,
+            }
+            if self._expired(entry, now):
+                stale.append((key,))
+            else:
+                self._entries[key] = entry
+        self._db.executemany("DELETE FROM answers WHERE key = ?", stale)
+        self._db.commit()
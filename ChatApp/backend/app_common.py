@@ -0,0 +1,139 @@
+import json
+import os
+import threading
+import time
+
+from flask import Response, jsonify, request, stream_with_context
+from werkzeug.utils import secure_filename
+
+from bm25_index import HYBRID_CANDIDATES, reciprocal_rank_fusion
+from context_packer import CONTEXT_TOKENIZER, CONTEXT_WINDOW, MAX_NEW_TOKENS
+from ingestion_jobs import JobPending, progress_stream
+from metrics import timed
+from model_client import MODEL_API_URL, ModelServerError, get_client
+from reranker import RERANK_TOKEN_BUDGET, RERANK_TOP_N, RERANKER_MODEL
+
+UPLOAD_FOLDER = 'uploads'
+ALLOWED_EXTENSIONS = {'pdf'}
+# How long the model server's default model id is trusted before /models is asked again
+SERVED_MODEL_TTL = float(os.environ.get('SERVED_MODEL_TTL', 5))
+
+_served_model = {'model_id': None, 'checked_at': float('-inf')}
+_served_model_lock = threading.Lock()
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+def register_ingestion_routes(app, get_job_queue, complete_message):
+    """Add /api/upload and /api/jobs/<job_id>; get_job_queue() returns the app's IngestionJobQueue."""
+
+    @app.route('/api/upload', methods=['POST'])
+    def upload_file():
+        if not request.files:
+            return jsonify({"error": "No file part"}), 400
+
+        job_queue = get_job_queue()
+        jobs = []
+        for _, file in request.files.items():
+            if file.filename == '':
+                return jsonify({"error": "No selected file"}), 400
+            if file and allowed_file(file.filename):
+                filename = secure_filename(file.filename)
+                # Re-uploads are diffed against the stored chunks; only a file already being ingested is refused
+                file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+                try:
+                    jobs.append(job_queue.submit(filename, file_path, save_fn=file.save))
+                except JobPending:
+                    return jsonify({
+                        "error": f"{filename} is already being ingested; retry once its job has finished",
+                        "jobs": [job.to_dict() for job in jobs],
+                    }), 409
+
+        # ?async=1 returns the job ids straight away; poll /api/jobs/<job_id> for progress
+        if request.args.get('async'):
+            return jsonify({"jobs": [job.to_dict() for job in jobs]}), 202
+
+        # Ingestion runs in the background, so a client disconnect no longer interrupts it
+        return Response(
+            stream_with_context(progress_stream(job_queue, jobs, complete_message)),
+            mimetype='application/json',
+        )
+
+    @app.route('/api/jobs/<job_id>', methods=['GET'])
+    def job_status(job_id):
+        job = get_job_queue().get(job_id)
+        if job is None:
+            return jsonify({"error": "Unknown job"}), 404
+        return jsonify(job.to_dict()), 200
+
+def register_common_routes(app, answer_cache):
+    """Add the model server error handler, /api/health and /api/cache/stats."""
+
+    @app.errorhandler(ModelServerError)
+    def model_server_error(e):
+        # The model server's 429 is passed on so the frontend can back off too
+        if e.status_code == 429:
+            return jsonify({"error": "Model server busy, retry later"}), 429, {"Retry-After": "1"}
+        return jsonify({"error": str(e)}), 502
+
+    @app.route('/api/health', methods=['GET'])
+    def health():
+        return jsonify({"status": "ok"}), 200
+
+    @app.route('/api/cache/stats', methods=['GET'])
+    def cache_stats():
+        return jsonify(answer_cache.stats()), 200
+
+def hybrid_retrieve(question, dense, bm25_index, fetch, k):
+    """Fuse dense results with BM25 by rank, so exact terms like part numbers can surface.
+
+    dense is a list of (id, item) best first; fetch(ids) returns (id, item)
+    pairs for fused ids the dense search did not return.
+    """
+    items = dict(dense)
+    sparse_ids = [id_ for id_, _ in bm25_index.search(question, HYBRID_CANDIDATES)]
+    fused = reciprocal_rank_fusion(list(items), sparse_ids)[:k]
+    missing = [id_ for id_ in fused if id_ not in items]
+    if missing:
+        items.update(fetch(missing))
+    return [items[id_] for id_ in fused if id_ in items]
+
+def served_model_id():
+    with _served_model_lock:
+        if time.monotonic() - _served_model['checked_at'] > SERVED_MODEL_TTL:
+            _served_model['model_id'] = get_client(MODEL_API_URL).default_model_id()
+            _served_model['checked_at'] = time.monotonic()
+        return _served_model['model_id']
+
+def answer_cache_variant(template):
+    """Everything besides the question and contexts that an answer depends on, for AnswerCache keys."""
+    return json.dumps([
+        served_model_id(), template, CONTEXT_TOKENIZER, CONTEXT_WINDOW, MAX_NEW_TOKENS,
+        RERANKER_MODEL, RERANK_TOP_N, RERANK_TOKEN_BUDGET,
+    ])
+
+def cached_answer_response(answer, stream):
+    if stream:
+        def generate_cached():
+            yield json.dumps({"token": answer, "status": "streaming"}) + '\n'
+            yield json.dumps({"answer": answer, "status": "complete", "cached": True}) + '\n'
+
+        return Response(stream_with_context(generate_cached()), mimetype='application/json')
+    return jsonify({"answer": answer, "cached": True}), 200
+
+def stream_answer_response(tokens, on_complete, packing):
+    """NDJSON token stream; on_complete(answer) runs only if generation finished without an error."""
+    def generate():
+        answer = ""
+        try:
+            with timed('generate'):
+                for token in tokens:
+                    answer += token
+                    yield json.dumps({"token": token, "status": "streaming"}) + '\n'
+        except Exception as e:
+            yield json.dumps({"error": str(e)}) + '\n'
+            return
+        on_complete(answer)
+        yield json.dumps({"answer": answer, "status": "complete", "packing": packing}) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
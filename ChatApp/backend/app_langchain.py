@@ -1,107 +1,196 @@
-from flask import Flask, request, jsonify, Response, stream_with_context
+from flask import Flask, request, jsonify
 from flask_cors import CORS
-from werkzeug.utils import secure_filename
 import os
-import json
+import sys
 from langchain_chroma import Chroma
-from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import TokenTextSplitter
 from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_core.documents import Document
 from langchain_core.prompts import PromptTemplate
 from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
 from pydantic import Field
-import requests
-from tqdm import tqdm
-from transformers import AutoTokenizer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from answer_cache import AnswerCache
+from app_common import (
+    UPLOAD_FOLDER, answer_cache_variant, cached_answer_response, hybrid_retrieve, register_common_routes,
+    register_ingestion_routes, stream_answer_response,
+)
+from context_packer import CONTEXT_TOKENIZER, ContextPacker
+from ann_index import ANN_INDEX_DIR, VECTOR_BACKEND
+from ann_vectorstore import ANNVectorStore
+from bm25_index import BM25_INDEX_DIR, HYBRID_CANDIDATES, HYBRID_WEIGHT, BM25Index
+from embedding_cache import CachedEmbeddings
+from model_client import MODEL_API_URL, get_client, get_async_client
+from parallel_pdf import iter_pdf_shards
+from ingestion import EMBED_BATCH_SIZE, ChunkDiff, chunk_hash, chunk_id
+from ingestion_jobs import IngestionJobQueue
+from metrics import register_metrics, timed
+from reranker import reranker, select_contexts
+from serving import run_app
+from tokenizer_service import TokenCounter, token_counter
 
 app = Flask(__name__)
 CORS(app)
-UPLOAD_FOLDER = 'uploads'
-ALLOWED_EXTENSIONS = {'pdf'}
+register_metrics(app)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['EMBED_BATCH_SIZE'] = EMBED_BATCH_SIZE
 
 global_vectorstore = None
-global_uploaded_filenames = []
+bm25_index = None
+answer_cache = AnswerCache()
+# Prompts are packed with the generating model's tokenizer, not the gpt2 one used for display counts
+prompt_tokens = TokenCounter(CONTEXT_TOKENIZER)
+context_packer = ContextPacker(prompt_tokens.count_many)
+llm = None
+ingestion_jobs = None
 
 def initialize_vectorstore():
     global global_vectorstore
     print("Initializing VectorStore")
-    embeddings_model = HuggingFaceEmbeddings(model_name="sentence-transformers/all-mpnet-base-v2")
-    global_vectorstore = Chroma(embedding_function=embeddings_model, persist_directory="./chroma_db")
+    model_name = "sentence-transformers/all-mpnet-base-v2"
+    embeddings_model = CachedEmbeddings(
+        HuggingFaceEmbeddings(
+            model_name=model_name,
+            encode_kwargs={"batch_size": app.config['EMBED_BATCH_SIZE']},
+        ),
+        model_name,
+    )
+    if VECTOR_BACKEND == 'ann':
+        global_vectorstore = ANNVectorStore(embeddings_model, persist_directory=ANN_INDEX_DIR)
+    else:
+        global_vectorstore = Chroma(embedding_function=embeddings_model, persist_directory="./chroma_db")
+    answer_cache.embed_fn = embeddings_model.embed_query
     print("VectorStore OK")
 
+def initialize_bm25():
+    global bm25_index
+    bm25_index = BM25Index.load(BM25_INDEX_DIR) if BM25Index.exists(BM25_INDEX_DIR) else BM25Index()
+
+    def fetch_texts(ids):
+        stored = global_vectorstore.get(ids=ids, include=["documents"])
+        return stored['ids'], stored['documents']
+
+    # Back-fills chunks ingested before the sparse index existed or by a job that crashed before saving it
+    if bm25_index.sync(global_vectorstore.get(include=[])['ids'], fetch_texts):
+        bm25_index.save(BM25_INDEX_DIR)
+
 class LocalLLM(LLM):
     api_url: str = Field(..., description="URL of the local model API")
 
+    @property
+    def client(self):
+        return get_client(self.api_url)
+
     def _call(self, prompt: str, **kwargs):
-        response = requests.post(f"{self.api_url}/generate", json={"prompt": prompt})
-        if response.status_code == 200:
-            return response.json()['generated_text']
-        else:
-            raise Exception(f"API request failed: {response.text}")
+        return self.client.generate(prompt)
+
+    async def _acall(self, prompt: str, **kwargs):
+        return await get_async_client(self.api_url).generate(prompt)
+
+    def _stream(self, prompt: str, stop=None, run_manager=None, **kwargs):
+        for token in self.client.stream(prompt):
+            chunk = GenerationChunk(text=token)
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
 
     @property
     def _llm_type(self) -> str:
         return "local_llm"
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+def initialize_llm():
+    global llm
+    llm = LocalLLM(api_url=MODEL_API_URL)
 
-def load_and_process_document(file_path):
-    loader = PyPDFLoader(file_path)
-    docs = loader.load()
+def split_pages(docs):
     text_splitter = TokenTextSplitter(chunk_size=1000, chunk_overlap=100)
-    splits = text_splitter.split_documents(docs)
-    for i, split in enumerate(splits):
-        split.metadata['source'] = os.path.basename(file_path)
-        
-    tokenizer = AutoTokenizer.from_pretrained("gpt2")
-    token_counts = [len(tokenizer.encode(split.page_content)) for split in splits]
-    
-    print(f"Total splits: {len(splits)}")
-    print(f"Average split size: {sum(len(split.page_content) for split in splits) / len(splits):.2f} characters")
-    print(f"Average token count: {sum(token_counts) / len(token_counts):.2f}")
-    print(f"Token count range: {min(token_counts)} - {max(token_counts)}")
-    
-    return splits
-
-def add_documents_with_progress(vectorstore, splits):
-    total_splits = len(splits)
-    for i, split in enumerate(tqdm(splits, desc="Adding documents", unit="split")):
-        vectorstore.add_documents([split])
-        yield i + 1, total_splits
-
-@app.route('/api/upload', methods=['POST'])
-def upload_file():
-    global global_vectorstore, global_uploaded_filenames
-
-    if not request.files:
-        return jsonify({"error": "No file part"}), 400
-
-    def generate():
-        for filename, file in request.files.items():
-            if file.filename == '':
-                yield json.dumps({"error": "No selected file"}) + '\n'
-                return
-            if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                if filename not in global_uploaded_filenames:
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    file.save(file_path)
-                    
-                    splits = load_and_process_document(file_path)
-                    
-                    for current, total in add_documents_with_progress(global_vectorstore, splits):
-                        progress = (current / total) * 100
-                        yield json.dumps({"progress": progress, "status": "processing"}) + '\n'
-                    
-                    os.remove(file_path)
-                    global_uploaded_filenames.append(filename)
-                    print(f"File {filename} uploaded and added to vectorstore!")
-                
-        yield json.dumps({"message": "All files processed and added to vectorstore successfully", "status": "complete"}) + '\n'
-
-    return Response(stream_with_context(generate()), mimetype='application/json')
+    return text_splitter.split_documents(docs)
+
+def iter_processed_document(file_path, executor=None):
+    # Page ranges are parsed and split in worker processes and handed over shard
+    # by shard; concatenated, the splits match split_pages(PyPDFLoader(file_path).load())
+    source = os.path.basename(file_path)
+    num_splits = total_chars = total_tokens = 0
+    min_tokens = max_tokens = None
+    for splits, pages_done, total_pages in iter_pdf_shards(file_path, split_pages, executor=executor):
+        for split in splits:
+            split.metadata['source'] = source
+        with timed('tokenize'):
+            token_counts = token_counter.count_many([split.page_content for split in splits])
+        if token_counts:
+            num_splits += len(splits)
+            total_chars += sum(len(split.page_content) for split in splits)
+            total_tokens += sum(token_counts)
+            min_tokens = min(token_counts) if min_tokens is None else min(min_tokens, min(token_counts))
+            max_tokens = max(token_counts) if max_tokens is None else max(max_tokens, max(token_counts))
+        yield splits, pages_done, total_pages
+
+    print(f"Total splits: {num_splits}")
+    if num_splits:
+        print(f"Average split size: {total_chars / num_splits:.2f} characters")
+        print(f"Average token count: {total_tokens / num_splits:.2f}")
+        print(f"Token count range: {min_tokens} - {max_tokens}")
+
+def load_and_process_document(file_path, executor=None):
+    return [split for splits, _, _ in iter_processed_document(file_path, executor) for split in splits]
+
+def stored_chunk_ids(source):
+    return global_vectorstore.get(where={"source": source}, include=[])['ids']
+
+def iter_changed_splits(job, executor):
+    # Only splits whose content is not stored yet go on to be embedded
+    diff = ChunkDiff(stored_chunk_ids(job.filename))
+    for splits, pages_done, total_pages in iter_processed_document(job.file_path, executor):
+        for split in splits:
+            split.metadata['chunk_hash'] = chunk_hash(split.page_content)
+            split.id = chunk_id(split.metadata['source'], split.metadata['chunk_hash'], split.metadata.get('page'))
+        yield diff.filter_new(splits, [split.id for split in splits]), pages_done, total_pages
+    job.removed_ids = diff.removed_ids()
+    print(f"{job.filename}: {diff.unchanged} unchanged splits, {len(job.removed_ids)} removed")
+
+def add_documents_batch(splits):
+    ids = [split.id for split in splits]
+    texts = [split.page_content for split in splits]
+    # Embedding first fills the embedding cache, so the store's own embed call below is only cache reads
+    with timed('embed'):
+        global_vectorstore.embeddings.embed_documents(texts)
+    with timed('index_write'):
+        global_vectorstore.add_documents(splits, ids=ids)
+        bm25_index.add(ids, texts)
+
+def delete_documents(ids):
+    global_vectorstore.delete(ids=ids)
+    bm25_index.delete(ids)
+
+def ingestion_complete(job):
+    # Chroma writes through; the ANN store is saved once per finished file
+    if isinstance(global_vectorstore, ANNVectorStore):
+        global_vectorstore.persist()
+    bm25_index.save(BM25_INDEX_DIR)
+    print(f"File {job.filename} uploaded and added to vectorstore!")
+
+def initialize_ingestion():
+    global ingestion_jobs
+    ingestion_jobs = IngestionJobQueue(
+        iter_changed_splits,
+        add_documents_batch,
+        remove_fn=delete_documents,
+        on_complete=ingestion_complete,
+        batch_size=app.config['EMBED_BATCH_SIZE'],
+    )
+
+def retrieve_contexts(question, k=4):
+    if not HYBRID_WEIGHT:
+        return global_vectorstore.as_retriever(search_kwargs={"k": k}).invoke(question)
+    def fetch(ids):
+        stored = global_vectorstore.get(ids=ids, include=["documents", "metadatas"])
+        return [(id_, Document(page_content=text, metadata=metadata, id=id_))
+                for id_, text, metadata in zip(stored['ids'], stored['documents'], stored['metadatas'])]
+
+    dense = global_vectorstore.similarity_search(question, k=max(k, HYBRID_CANDIDATES))
+    return hybrid_retrieve(question, [(doc.id, doc) for doc in dense], bm25_index, fetch, k)
 
 @app.route('/api/query', methods=['POST'])
 def query_document():
@@ -118,16 +207,18 @@ def query_document():
         print("No vectorstore found")
         return jsonify({"error": "Vectorstore not initialized"}), 500
     
-    retriever = global_vectorstore.as_retriever()
-    contexts = retriever.get_relevant_documents(question)
-    
-    tokenizer = AutoTokenizer.from_pretrained("gpt2")
+    with timed('retrieve'):
+        contexts = retrieve_contexts(question)
+
+    with timed('tokenize'):
+        token_counts = token_counter.count_many([ctx.page_content for ctx in contexts])
     formatted_contexts = [
         {
             "page": ctx.metadata.get('page', 'Unknown'),
+            "source": ctx.metadata.get('source'),
             "content": ctx.page_content,
-            "token_count": len(tokenizer.encode(ctx.page_content))
-        } for ctx in contexts
+            "token_count": token_count
+        } for ctx, token_count in zip(contexts, token_counts)
     ]
     
     return jsonify({"contexts": formatted_contexts}), 200
@@ -140,9 +231,8 @@ def answer_question():
     
     question = data['question']
     contexts = data['contexts']
-    
-    llm = LocalLLM(api_url="http://localhost:5000")
-    
+    context_texts = [ctx['content'] for ctx in contexts]
+
     template = """
         <|system|>
             You are an assistant for question-answering tasks. 
@@ -157,16 +247,46 @@ def answer_question():
         <|end|>
         <|assistant|>"""
 
+    # Looked up once the template is known, since answers are cached per template, model and settings
+    cache_variant = answer_cache_variant(template)
+    cached_answer = answer_cache.get(question, context_texts, cache_variant)
+    if cached_answer is not None:
+        return cached_answer_response(cached_answer, data.get('stream'))
+
     prompt = PromptTemplate.from_template(template)
-    combined_context = "\n".join([ctx['content'] for ctx in contexts])
-    formatted_prompt = prompt.format(input=question, context=combined_context)
+    order = select_contexts(question, context_texts, prompt_tokens.count_many)
+    chunks = [{"text": contexts[i]['content'], "source": contexts[i].get('source'), "page": contexts[i].get('page')} for i in order]
+    with timed('prompt_format'):
+        packed_contexts, packing = context_packer.pack(chunks, prompt.format(input=question, context=""))
+        combined_context = "\n".join(packed_contexts)
+        formatted_prompt = prompt.format(input=question, context=combined_context)
+    print("Context packing:", packing)
     
     print("Formatted prompt:", formatted_prompt)
-    response = llm(formatted_prompt)
+
+    if data.get('stream'):
+        return stream_answer_response(
+            llm.stream(formatted_prompt),
+            lambda answer: answer_cache.put(question, context_texts, answer, cache_variant),
+            packing,
+        )
+
+    with timed('generate'):
+        response = llm(formatted_prompt)
+    answer_cache.put(question, context_texts, response, cache_variant)
     
-    return jsonify({"answer": response}), 200
+    return jsonify({"answer": response, "packing": packing}), 200
+
+register_ingestion_routes(app, lambda: ingestion_jobs, "All files processed and added to vectorstore successfully")
+register_common_routes(app, answer_cache)
 
 if __name__ == '__main__':
     os.makedirs(UPLOAD_FOLDER, exist_ok=True)
     initialize_vectorstore()
-    app.run(debug=True, port=5001)
\ No newline at end of file
+    initialize_bm25()
+    initialize_llm()
+    initialize_ingestion()
+    token_counter.load()
+    prompt_tokens.load()
+    reranker.load()
+    run_app(app, 5001)
\ No newline at end of file
@@ -1,23 +1,20 @@
-from flask import Flask, request, jsonify, Response, stream_with_context
+from flask import Flask, request, jsonify
 from flask_cors import CORS
-from werkzeug.utils import secure_filename
 import os
-import json
-import requests
-from tqdm import tqdm
+import sys
 import chromadb
-from transformers import AutoTokenizer
 from typing import Any
 from pydantic import BaseModel, Field
 
 from llama_index.core import (
+    Document,
     VectorStoreIndex,
-    SimpleDirectoryReader,
     StorageContext,
     PromptTemplate,
     Settings
 )
 from llama_index.core.node_parser import SimpleNodeParser
+from llama_index.core.schema import MetadataMode
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 from llama_index.core.retrievers import VectorIndexRetriever
 from llama_index.vector_stores.chroma import ChromaVectorStore
@@ -29,15 +26,43 @@ from llama_index.core.llms import (
 )
 from llama_index.core.llms.callbacks import llm_completion_callback
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from answer_cache import AnswerCache
+from app_common import (
+    UPLOAD_FOLDER, answer_cache_variant, cached_answer_response, hybrid_retrieve, register_common_routes,
+    register_ingestion_routes, stream_answer_response,
+)
+from context_packer import CONTEXT_TOKENIZER, ContextPacker
+from ann_index import ANN_INDEX_DIR, VECTOR_BACKEND
+from embedding_cache import EmbeddingCache
+from model_client import MODEL_API_URL, get_client, get_async_client
+from parallel_pdf import iter_pdf_shards
+from ingestion import EMBED_BATCH_SIZE, ChunkDiff, chunk_hash, chunk_id
+from ingestion_jobs import IngestionJobQueue
+from metrics import register_metrics, timed
+from ann_llama_store import ANNLlamaVectorStore
+from bm25_index import BM25_INDEX_DIR, HYBRID_CANDIDATES, HYBRID_WEIGHT, BM25Index
+from reranker import reranker, select_contexts
+from serving import run_app
+from tokenizer_service import TokenCounter, token_counter
+
 app = Flask(__name__)
 CORS(app)
-UPLOAD_FOLDER = 'uploads'
-ALLOWED_EXTENSIONS = {'pdf'}
+register_metrics(app)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['EMBED_BATCH_SIZE'] = EMBED_BATCH_SIZE
 
 global_index = None
-global_uploaded_filenames = []
+global_collection = None
+global_vector_store = None
+bm25_index = None
 query_engine = None
+answer_cache = AnswerCache()
+# Prompts are packed with the generating model's tokenizer, not the gpt2 one used for display counts
+prompt_tokens = TokenCounter(CONTEXT_TOKENIZER)
+context_packer = ContextPacker(prompt_tokens.count_many)
+embedding_cache = EmbeddingCache()
+ingestion_jobs = None
 
 class LocalLLM(CustomLLM, BaseModel):
     api_url: str = Field(description="URL of the local LLM API")
@@ -58,101 +83,191 @@ class LocalLLM(CustomLLM, BaseModel):
 
     @llm_completion_callback()
     def complete(self, prompt: str, **kwargs: Any) -> CompletionResponse:
-        payload = {"prompt": prompt}
-        response = requests.post(f"{self.api_url}/generate", json=payload)
-        if response.status_code == 200:
-            return CompletionResponse(text=response.json()['generated_text'])
-        else:
-            raise Exception(f"API request failed: {response.text}")
+        return CompletionResponse(text=get_client(self.api_url).generate(prompt))
+
+    @llm_completion_callback()
+    async def acomplete(self, prompt: str, **kwargs: Any) -> CompletionResponse:
+        return CompletionResponse(text=await get_async_client(self.api_url).generate(prompt))
 
     @llm_completion_callback()
     def stream_complete(self, prompt: str, **kwargs: Any) -> CompletionResponseGen:
-        response = self.complete(prompt, **kwargs)
-        yield response
+        text = ""
+        for token in get_client(self.api_url).stream(prompt):
+            text += token
+            yield CompletionResponse(text=text, delta=token)
 
 def initialize_index():
     global global_index
+    global global_collection
+    global global_vector_store
     global query_engine
-    db = chromadb.PersistentClient(path="./chroma_db")
-    chroma_collection = db.get_or_create_collection("quickstart")
-    vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
+    if VECTOR_BACKEND == 'ann':
+        vector_store = ANNLlamaVectorStore(persist_dir=ANN_INDEX_DIR)
+    else:
+        db = chromadb.PersistentClient(path="./chroma_db")
+        chroma_collection = db.get_or_create_collection("quickstart")
+        global_collection = chroma_collection
+        vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
+    global_vector_store = vector_store
     storage_context = StorageContext.from_defaults(vector_store=vector_store)
-    embed_model = HuggingFaceEmbedding(model_name="sentence-transformers/all-mpnet-base-v2")
+    embed_model = HuggingFaceEmbedding(
+        model_name="sentence-transformers/all-mpnet-base-v2",
+        embed_batch_size=app.config['EMBED_BATCH_SIZE'],
+    )
     Settings.embed_model = embed_model
+    answer_cache.embed_fn = embed_model.get_query_embedding
     global_index = VectorStoreIndex.from_vector_store(
         vector_store,
         storage_context=storage_context,
     )
 
     #global_llm = LocalLLM(api_url="http://localhost:5000")
-    Settings.llm = LocalLLM(api_url="http://localhost:5000")
+    Settings.llm = LocalLLM(api_url=MODEL_API_URL)
     query_engine = global_index.as_query_engine()
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+def initialize_bm25():
+    global bm25_index
+    bm25_index = BM25Index.load(BM25_INDEX_DIR) if BM25Index.exists(BM25_INDEX_DIR) else BM25Index()
+
+    def fetch_texts(ids):
+        if global_collection is None:
+            nodes = global_vector_store.get_nodes(node_ids=ids)
+            return [node.node_id for node in nodes], [node.get_content(metadata_mode=MetadataMode.NONE) for node in nodes]
+        stored = global_collection.get(ids=ids, include=["documents"])
+        return stored['ids'], stored['documents']
+
+    if global_collection is None:
+        stored_ids = global_vector_store.get_ids()
+    else:
+        stored_ids = global_collection.get(include=[])['ids']
+    # Back-fills nodes ingested before the sparse index existed or by a job that crashed before saving it
+    if bm25_index.sync(stored_ids, fetch_texts):
+        bm25_index.save(BM25_INDEX_DIR)
 
-def load_and_process_document(file_path):
-    reader = SimpleDirectoryReader(input_files=[file_path])
-    docs = reader.load_data()
+def split_pages(docs):
+    # Runs in the parse workers on one page shard. The page Documents carry the same page_label and
+    # file_name metadata SimpleDirectoryReader gave them, plus the 0-based page /api/query reports
+    pages = [
+        Document(
+            text=doc.page_content,
+            metadata={
+                'page_label': str(doc.metadata['page'] + 1),
+                'file_name': os.path.basename(doc.metadata['source']),
+                'page': doc.metadata['page'],
+            },
+            excluded_embed_metadata_keys=['page'],
+            excluded_llm_metadata_keys=['page'],
+        )
+        for doc in docs
+    ]
     parser = SimpleNodeParser.from_defaults(chunk_size=1000, chunk_overlap=100)
-    nodes = parser.get_nodes_from_documents(docs)
+    return parser.get_nodes_from_documents(pages)
+
+def iter_processed_document(file_path, executor):
+    # Page ranges are read and split in the worker processes a shard at a time, so
+    # neither the pages nor the nodes of the whole file are ever held at once
+    yield from iter_pdf_shards(file_path, split_pages, executor=executor)
+
+def embed_nodes_with_cache(nodes):
+    # insert_nodes only embeds nodes whose embedding is still None
+    embed_model = Settings.embed_model
+    texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+    with timed('embed'):
+        embeddings = embedding_cache.embed_with_cache(embed_model.model_name, texts, embed_model.get_text_embedding_batch)
+    for node, embedding in zip(nodes, embeddings):
+        node.embedding = embedding
     return nodes
 
-def add_documents_with_progress(index, nodes):
-    total_nodes = len(nodes)
-    for i, node in enumerate(tqdm(nodes, desc="Adding documents", unit="node")):
-        index.insert_nodes([node])
-        yield i + 1, total_nodes
-
-@app.route('/api/upload', methods=['POST'])
-def upload_file():
-    if not request.files:
-        return jsonify({"error": "No file part"}), 400
-
-    def generate():
-        for filename, file in request.files.items():
-            if file.filename == '':
-                yield json.dumps({"error": "No selected file"}) + '\n'
-                return
-            if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                if filename not in global_uploaded_filenames:
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    file.save(file_path)
-                    nodes = load_and_process_document(file_path)
-                    for current, total in add_documents_with_progress(global_index, nodes):
-                        progress = (current / total) * 100
-                        yield json.dumps({"progress": progress, "status": "processing"}) + '\n'
-                    os.remove(file_path)
-                    global_uploaded_filenames.append(filename)
-        yield json.dumps({"message": "All files processed and added to index successfully", "status": "complete"}) + '\n'
-
-    return Response(stream_with_context(generate()), mimetype='application/json')
+def add_nodes_batch(nodes):
+    nodes = embed_nodes_with_cache(nodes)
+    with timed('index_write'):
+        global_index.insert_nodes(nodes)
+        bm25_index.add([node.node_id for node in nodes], [node.get_content(metadata_mode=MetadataMode.NONE) for node in nodes])
+
+def stored_chunk_ids(source):
+    # Nodes stored before content-addressed ids have random ids and no source, only the reader's
+    # file_name; listing them here makes the first re-upload replace them instead of duplicating them
+    ids = []
+    for where in ({"source": source}, {"file_name": source}):
+        if global_collection is None:
+            ids.extend(global_vector_store.get_ids(where=where))
+        else:
+            ids.extend(global_collection.get(where=where, include=[])['ids'])
+    return ids
+
+def iter_changed_nodes(job, executor):
+    # Only nodes whose content is not stored yet go on to be embedded
+    diff = ChunkDiff(stored_chunk_ids(job.filename))
+    for nodes, pages_done, total_pages in iter_processed_document(job.file_path, executor):
+        for node in nodes:
+            node.metadata['source'] = job.filename
+            node.metadata['chunk_hash'] = chunk_hash(node.get_content(metadata_mode=MetadataMode.NONE))
+            # Bookkeeping only: keep it out of the embedded and prompted text
+            node.excluded_embed_metadata_keys = [*node.excluded_embed_metadata_keys, 'source', 'chunk_hash']
+            node.excluded_llm_metadata_keys = [*node.excluded_llm_metadata_keys, 'source', 'chunk_hash']
+            node.id_ = chunk_id(job.filename, node.metadata['chunk_hash'], node.metadata.get('page'))
+        yield diff.filter_new(nodes, [node.id_ for node in nodes]), pages_done, total_pages
+    job.removed_ids = diff.removed_ids()
+    print(f"{job.filename}: {diff.unchanged} unchanged nodes, {len(job.removed_ids)} removed")
+
+def delete_nodes(ids):
+    if global_collection is None:
+        global_vector_store.delete_nodes(ids)
+    else:
+        global_collection.delete(ids=ids)
+    bm25_index.delete(ids)
+
+def ingestion_complete(job):
+    # Only the ANN node store and the BM25 index buffer writes, so both are flushed per file
+    if global_collection is None:
+        global_vector_store.persist()
+    bm25_index.save(BM25_INDEX_DIR)
+    print(f"File {job.filename} uploaded and added to index!")
+
+def initialize_ingestion():
+    global ingestion_jobs
+    ingestion_jobs = IngestionJobQueue(
+        iter_changed_nodes,
+        add_nodes_batch,
+        remove_fn=delete_nodes,
+        on_complete=ingestion_complete,
+        batch_size=app.config['EMBED_BATCH_SIZE'],
+    )
+
+def retrieve_nodes(question, k=10):
+    if not HYBRID_WEIGHT:
+        return VectorIndexRetriever(index=global_index, similarity_top_k=k).retrieve(question)
+    def fetch(ids):
+        return [(node.node_id, node) for node in global_vector_store.get_nodes(node_ids=ids)]
+
+    retriever = VectorIndexRetriever(index=global_index, similarity_top_k=max(k, HYBRID_CANDIDATES))
+    dense = [(node.node_id, node) for node in retriever.retrieve(question)]
+    return hybrid_retrieve(question, dense, bm25_index, fetch, k)
 
 @app.route('/api/query', methods=['POST'])
 def query_document():
-    tokenizer = AutoTokenizer.from_pretrained("gpt2")
     data = request.json
     if not data or 'question' not in data:
         return jsonify({"error": "No question provided"}), 400
     question = data['question']
     if global_index is None:
         return jsonify({"error": "Index not initialized"}), 500
-    retriever = VectorIndexRetriever(index=global_index, similarity_top_k=10)
-    nodes = retriever.retrieve(question)
-    formatted_contexts = [{"page": node.metadata.get('page', 'Unknown'), "content": node.text, "token_count": len(tokenizer.encode(node.text))} for node in nodes]
+    with timed('retrieve'):
+        nodes = retrieve_nodes(question)
+    with timed('tokenize'):
+        token_counts = token_counter.count_many([node.text for node in nodes])
+    formatted_contexts = [{"page": node.metadata.get('page', 'Unknown'), "source": node.metadata.get('source'), "content": node.text, "token_count": token_count} for node, token_count in zip(nodes, token_counts)]
     return jsonify({"contexts": formatted_contexts}), 200
 
 @app.route('/api/answer', methods=['POST'])
 def answer_question():
-    global query_engine
-
     data = request.json
     if not data or 'question' not in data or 'contexts' not in data:
         return jsonify({"error": "Missing question or contexts"}), 400
     question = data['question']
     contexts = data['contexts']
-    
+    context_texts = [ctx['content'] for ctx in contexts]
+
     template = (
         "<|system|>\n"
         "You are an assistant for question-answering tasks. Use the following pieces of retrieved context to answer the question. "
@@ -165,19 +280,49 @@ def answer_question():
         "<|end|>\n"
         "<|assistant|>"
     )
+    # Looked up once the template is known, since answers are cached per template, model and settings
+    cache_variant = answer_cache_variant(template)
+    cached_answer = answer_cache.get(question, context_texts, cache_variant)
+    if cached_answer is not None:
+        return cached_answer_response(cached_answer, data.get('stream'))
+
     prompt = PromptTemplate(template)
-    combined_context = "\n".join([ctx['content'] for ctx in contexts])
-    formatted_prompt = prompt.format(query_str=question, context_str=combined_context)
+    order = select_contexts(question, context_texts, prompt_tokens.count_many)
+    chunks = [{"text": contexts[i]['content'], "source": contexts[i].get('source'), "page": contexts[i].get('page')} for i in order]
+    with timed('prompt_format'):
+        packed_contexts, packing = context_packer.pack(chunks, prompt.format(query_str=question, context_str=""))
+        combined_context = "\n".join(packed_contexts)
+        formatted_prompt = prompt.format(query_str=question, context_str=combined_context)
+    print("Context packing:", packing)
+
+    if data.get('stream'):
+        def tokens():
+            for response in Settings.llm.stream_complete(formatted_prompt):
+                yield response.delta
+
+        return stream_answer_response(
+            tokens(),
+            lambda answer: answer_cache.put(question, context_texts, answer, cache_variant),
+            packing,
+        )
     
-    # Use Settings.llm instead of global_llm
-    #response = Settings.llm.complete(formatted_prompt)
-    response = query_engine.query(formatted_prompt)
+    # The prompt is already packed; a query engine would retrieve and wrap it again
+    with timed('generate'):
+        response = Settings.llm.complete(formatted_prompt)
+    answer = response.text
+    answer_cache.put(question, context_texts, answer, cache_variant)
     
-    print(dir(response))
-    #return jsonify({"answer": response.text}), 200
-    return jsonify({"answer": response}), 200
+    return jsonify({"answer": answer, "packing": packing}), 200
+
+register_ingestion_routes(app, lambda: ingestion_jobs, "All files processed and added to index successfully")
+register_common_routes(app, answer_cache)
 
 if __name__ == '__main__':
     os.makedirs(UPLOAD_FOLDER, exist_ok=True)
     initialize_index()
-    app.run(debug=True, port=5001)
\ No newline at end of file
+    initialize_bm25()
+    initialize_ingestion()
+    token_counter.load()
+    prompt_tokens.load()
+    reranker.load()
+    run_app(app, 5001)
\ No newline at end of file
@@ -0,0 +1,62 @@
+import argparse
+import time
+
+from langchain_chroma import Chroma
+from langchain_huggingface import HuggingFaceEmbeddings
+
+from app_langchain import load_and_process_document
+from ingestion import add_in_batches
+
+def per_split_ingest(vectorstore, splits):
+    for split in splits:
+        vectorstore.add_documents([split])
+
+def batched_ingest(vectorstore, splits, batch_size):
+    for _ in add_in_batches(vectorstore.add_documents, splits, batch_size):
+        pass
+
+def time_ingest(name, ingest_fn, embeddings_model, splits):
+    vectorstore = Chroma(collection_name=name, embedding_function=embeddings_model)
+    start = time.perf_counter()
+    ingest_fn(vectorstore, splits)
+    elapsed = time.perf_counter() - start
+    vectorstore.delete_collection()
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-split vs batched ingestion")
+    parser.add_argument("--file", required=True, help="PDF file to ingest")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[16, 64, 256], help="Batch sizes to try")
+    parser.add_argument("--max_splits", type=int, default=None, help="Only ingest the first N splits")
+    args = parser.parse_args()
+
+    splits = load_and_process_document(args.file)
+    if args.max_splits:
+        splits = splits[:args.max_splits]
+
+    results = []
+    embeddings_model = HuggingFaceEmbeddings(model_name="sentence-transformers/all-mpnet-base-v2")
+    elapsed = time_ingest("bench_per_split", per_split_ingest, embeddings_model, splits)
+    results.append(("per-split", elapsed))
+
+    for batch_size in args.batch_sizes:
+        embeddings_model = HuggingFaceEmbeddings(
+            model_name="sentence-transformers/all-mpnet-base-v2",
+            encode_kwargs={"batch_size": batch_size},
+        )
+        elapsed = time_ingest(
+            f"bench_batch_{batch_size}",
+            lambda vs, s: batched_ingest(vs, s, batch_size),
+            embeddings_model,
+            splits,
+        )
+        results.append((f"batch={batch_size}", elapsed))
+
+    baseline = results[0][1]
+    print(f"\n{len(splits)} chunks")
+    print(f"{'mode':<12} {'seconds':>10} {'chunks/sec':>12} {'speedup':>9}")
+    for name, elapsed in results:
+        print(f"{name:<12} {elapsed:>10.2f} {len(splits) / elapsed:>12.1f} {baseline / elapsed:>8.1f}x")
+
+if __name__ == "__main__":
+    main()
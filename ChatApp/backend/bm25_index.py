@@ -0,0 +1,212 @@
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+
+import numpy as np
+
+BM25_INDEX_DIR = os.environ.get('BM25_INDEX_DIR', './bm25_index')
+# Share of the fused score given to BM25; 0 (the default) keeps retrieval dense-only
+HYBRID_WEIGHT = float(os.environ.get('HYBRID_WEIGHT', 0))
+HYBRID_CANDIDATES = int(os.environ.get('HYBRID_CANDIDATES', 20))
+RRF_K = int(os.environ.get('RRF_K', 60))
+
+META_FILE = "bm25_meta.json"
+# Keeps part numbers and acronyms such as "xj-2000" or "v1.2" together
+TOKEN_PATTERN = re.compile(r"\w+(?:[-./]\w+)*")
+
+def tokenize(text):
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        tokens.append(token)
+        parts = re.split(r"[-./]", token)
+        if len(parts) > 1:
+            # Also index the pieces (and the run-together form) so "xj2000" and "xj" match "xj-2000"
+            tokens.extend(parts)
+            tokens.append(''.join(parts))
+    return tokens
+
+def reciprocal_rank_fusion(dense_ids, sparse_ids, sparse_weight=HYBRID_WEIGHT, k=RRF_K):
+    """Merge two rankings of ids; each list contributes weight / (k + rank)."""
+    scores = {}
+    for weight, ranked in ((1.0 - sparse_weight, dense_ids), (sparse_weight, sparse_ids)):
+        for rank, id_ in enumerate(ranked):
+            scores[id_] = scores.get(id_, 0.0) + weight / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+class Segment:
+    """Immutable CSR postings: rows[offsets[i]:offsets[i + 1]] hold the documents containing terms[i]."""
+
+    def __init__(self, terms, offsets, rows, tfs):
+        self.terms = terms
+        self.offsets = offsets
+        self.rows = rows
+        self.tfs = tfs
+
+    @classmethod
+    def build(cls, term_ids, rows, tfs):
+        order = np.lexsort((rows, term_ids))
+        term_ids, rows, tfs = term_ids[order], rows[order], tfs[order]
+        terms, starts = np.unique(term_ids, return_index=True)
+        offsets = np.append(starts, len(term_ids)).astype(np.int64)
+        return cls(terms.astype(np.int32), offsets, rows.astype(np.int32), tfs.astype(np.float32))
+
+    def postings(self, term_id):
+        i = np.searchsorted(self.terms, term_id)
+        if i == len(self.terms) or self.terms[i] != term_id:
+            return None, None
+        return self.rows[self.offsets[i]:self.offsets[i + 1]], self.tfs[self.offsets[i]:self.offsets[i + 1]]
+
+    def triples(self):
+        term_ids = np.repeat(self.terms, np.diff(self.offsets))
+        return term_ids, self.rows, self.tfs
+
+class BM25Index:
+    """Incremental BM25 index over chunk ids.
+
+    Each add() writes a small sorted segment of NumPy postings; once there are
+    more than max_segments they are merged into one, which also drops deleted
+    chunks from the postings and the document frequencies.
+    """
+
+    def __init__(self, k1=1.5, b=0.75, max_segments=8):
+        self.k1 = k1
+        self.b = b
+        self.max_segments = max_segments
+        self.vocab = {}
+        self.ids = []
+        self._row_of = {}
+        self.doc_lengths = np.empty(0, dtype=np.float32)
+        self.alive = np.empty(0, dtype=bool)
+        self.df = np.empty(0, dtype=np.int32)
+        self.segments = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._row_of)
+
+    def add(self, ids, texts):
+        with self._lock:
+            self._delete(ids)
+            start = len(self.ids)
+            term_ids, rows, tfs, lengths = [], [], [], []
+            for i, text in enumerate(texts):
+                counts = Counter(tokenize(text))
+                for term, tf in counts.items():
+                    term_ids.append(self.vocab.setdefault(term, len(self.vocab)))
+                    rows.append(start + i)
+                    tfs.append(tf)
+                lengths.append(sum(counts.values()))
+            self.ids.extend(ids)
+            self._row_of.update((id_, start + i) for i, id_ in enumerate(ids))
+            self.doc_lengths = np.concatenate([self.doc_lengths, np.array(lengths, dtype=np.float32)])
+            self.alive = np.concatenate([self.alive, np.ones(len(ids), dtype=bool)])
+            if term_ids:
+                term_ids = np.array(term_ids, dtype=np.int32)
+                self.segments.append(Segment.build(term_ids, np.array(rows), np.array(tfs)))
+                self.df = np.concatenate([self.df, np.zeros(len(self.vocab) - len(self.df), dtype=np.int32)])
+                self.df += np.bincount(term_ids, minlength=len(self.vocab)).astype(np.int32)
+            if len(self.segments) > self.max_segments:
+                self._merge()
+
+    def delete(self, ids):
+        with self._lock:
+            self._delete(ids)
+
+    def _delete(self, ids):
+        for id_ in ids:
+            row = self._row_of.pop(id_, None)
+            if row is not None:
+                self.alive[row] = False
+
+    def _merge(self):
+        if not self.segments:
+            return
+        term_ids, rows, tfs = (np.concatenate(parts) for parts in zip(*(segment.triples() for segment in self.segments)))
+        live = self.alive[rows]
+        term_ids, rows, tfs = term_ids[live], rows[live], tfs[live]
+        self.segments = [Segment.build(term_ids, rows, tfs)] if len(term_ids) else []
+        self.df = np.bincount(term_ids, minlength=len(self.vocab)).astype(np.int32)
+
+    def search(self, query, k=HYBRID_CANDIDATES):
+        """Return up to k (id, BM25 score) pairs, best first."""
+        with self._lock:
+            n_docs = len(self._row_of)
+            term_ids = {self.vocab[term] for term in tokenize(query) if term in self.vocab}
+            if not n_docs or not term_ids:
+                return []
+            avg_length = float(self.doc_lengths[self.alive].mean())
+            scores = np.zeros(len(self.ids), dtype=np.float32)
+            for term_id in term_ids:
+                df = int(self.df[term_id])
+                idf = math.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+                for segment in self.segments:
+                    rows, tfs = segment.postings(term_id)
+                    if rows is None:
+                        continue
+                    norm = self.k1 * (1.0 - self.b + self.b * self.doc_lengths[rows] / avg_length)
+                    # A term occurs once per document in a segment, so plain fancy-index addition is safe
+                    scores[rows] += idf * tfs * (self.k1 + 1.0) / (tfs + norm)
+            scores[~self.alive] = 0.0
+            candidates = np.flatnonzero(scores > 0)
+            if len(candidates) > k:
+                candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+            candidates = candidates[np.argsort(-scores[candidates])]
+            return [(self.ids[row], float(scores[row])) for row in candidates]
+
+    def sync(self, stored_ids, fetch_texts):
+        """Index stored chunks that are missing here and drop ones no longer stored.
+
+        fetch_texts(ids) returns (ids, texts) for the chunks to add. Covers chunks
+        written to the vector store by a job that died before the index was saved.
+        Returns True if anything changed.
+        """
+        with self._lock:
+            indexed = set(self._row_of)
+        stored = set(stored_ids)
+        missing = [id_ for id_ in stored_ids if id_ not in indexed]
+        extra = indexed - stored
+        if extra:
+            self.delete(extra)
+        if missing:
+            self.add(*fetch_texts(missing))
+        return bool(missing or extra)
+
+    def save(self, directory=BM25_INDEX_DIR):
+        with self._lock:
+            # Saving always writes a single compacted segment
+            self._merge()
+            os.makedirs(directory, exist_ok=True)
+            arrays = {'doc_lengths': self.doc_lengths, 'alive': self.alive, 'df': self.df}
+            if self.segments:
+                segment = self.segments[0]
+                arrays.update(terms=segment.terms, offsets=segment.offsets, rows=segment.rows, tfs=segment.tfs)
+            tmp_path = os.path.join(directory, 'postings.tmp.npz')
+            np.savez(tmp_path, **arrays)
+            os.replace(tmp_path, os.path.join(directory, 'postings.npz'))
+            meta = {'k1': self.k1, 'b': self.b, 'vocab': self.vocab, 'ids': self.ids}
+            with open(os.path.join(directory, META_FILE + '.tmp'), 'w') as f:
+                json.dump(meta, f)
+            os.replace(os.path.join(directory, META_FILE + '.tmp'), os.path.join(directory, META_FILE))
+
+    @classmethod
+    def exists(cls, directory=BM25_INDEX_DIR):
+        return os.path.exists(os.path.join(directory, META_FILE))
+
+    @classmethod
+    def load(cls, directory=BM25_INDEX_DIR):
+        with open(os.path.join(directory, META_FILE)) as f:
+            meta = json.load(f)
+        index = cls(k1=meta['k1'], b=meta['b'])
+        index.vocab = meta['vocab']
+        index.ids = meta['ids']
+        with np.load(os.path.join(directory, 'postings.npz')) as arrays:
+            index.doc_lengths = arrays['doc_lengths']
+            index.alive = arrays['alive']
+            index.df = arrays['df']
+            if 'terms' in arrays:
+                index.segments = [Segment(arrays['terms'], arrays['offsets'], arrays['rows'], arrays['tfs'])]
+        index._row_of = {id_: row for row, id_ in enumerate(index.ids) if index.alive[row]}
+        return index
@@ -0,0 +1,59 @@
+import hashlib
+import os
+from itertools import islice
+
+from tqdm import tqdm
+
+EMBED_BATCH_SIZE = int(os.environ.get('EMBED_BATCH_SIZE', 64))
+
+def iter_batches(items, batch_size):
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def add_in_batches(add_fn, items, batch_size=EMBED_BATCH_SIZE, desc="Adding documents", unit="split"):
+    # add_fn receives a whole batch so the embedder runs one forward pass per
+    # batch and the vector store issues a single bulk write.
+    total = len(items)
+    done = 0
+    with tqdm(total=total, desc=desc, unit=unit) as progress_bar:
+        for batch in iter_batches(items, batch_size):
+            add_fn(batch)
+            done += len(batch)
+            progress_bar.update(len(batch))
+            yield done, total
+
+def chunk_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def chunk_id(source, content_hash, page=None):
+    # Stable per (document, page, chunk content), so re-uploads map onto the stored vectors; a chunk
+    # that moved to another page gets a new id, so its stored page is never stale (its embedding
+    # still comes from the cache)
+    return hashlib.sha256(f"{source}\0{page}\0{content_hash}".encode('utf-8')).hexdigest()
+
+class ChunkDiff:
+    """Diffs the chunks of a re-uploaded document against the ids already stored for it."""
+
+    def __init__(self, stored_ids):
+        self.stored_ids = set(stored_ids)
+        self.seen_ids = set()
+        self.unchanged = 0
+
+    def filter_new(self, chunks, ids):
+        new_chunks = []
+        for chunk, id_ in zip(chunks, ids):
+            if id_ in self.seen_ids:
+                continue
+            self.seen_ids.add(id_)
+            if id_ in self.stored_ids:
+                self.unchanged += 1
+            else:
+                new_chunks.append(chunk)
+        return new_chunks
+
+    def removed_ids(self):
+        return list(self.stored_ids - self.seen_ids)
@@ -0,0 +1,197 @@
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from ingestion import EMBED_BATCH_SIZE, iter_batches
+
+INGESTION_WORKERS = int(os.environ.get('INGESTION_WORKERS', os.cpu_count() or 1))
+INGESTION_MAX_IN_FLIGHT = int(os.environ.get('INGESTION_MAX_IN_FLIGHT', 8))
+JOB_RETENTION_SECONDS = 3600
+
+class JobPending(RuntimeError):
+    pass
+
+class IngestionJob:
+    def __init__(self, filename, file_path):
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.file_path = file_path
+        self.status = 'queued'
+        self.units_done = 0
+        self.units_total = 0
+        self.embedded = 0
+        # Filled in by parse_fn: ids of previously stored chunks that are gone from this version
+        self.removed_ids = []
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.status in ('complete', 'failed')
+
+    @property
+    def progress(self):
+        if self.status == 'complete':
+            return 100.0
+        return (self.units_done / self.units_total) * 100 if self.units_total else 0.0
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'filename': self.filename,
+            'status': self.status,
+            'progress': self.progress,
+            'pages_done': self.units_done,
+            'pages_total': self.units_total,
+            'embedded': self.embedded,
+            'error': self.error,
+        }
+
+class IngestionJobQueue:
+    """Background PDF ingestion: a process pool parses and splits, one thread embeds.
+
+    parse_fn(job, executor) runs on a coordinator thread and yields
+    (chunks, units_done, units_total) as parsing progresses, fanning the work
+    out to the process pool executor. add_fn(batch) runs on the single
+    embedder thread, and remove_fn(ids) deletes job.removed_ids once every
+    new chunk has been written. The hand-off queue holds at most max_in_flight chunk
+    groups, so a fast parser blocks instead of buffering a whole document.
+    """
+
+    def __init__(self, parse_fn, add_fn, remove_fn=None, on_complete=None, workers=INGESTION_WORKERS,
+                 batch_size=EMBED_BATCH_SIZE, max_in_flight=INGESTION_MAX_IN_FLIGHT):
+        self.parse_fn = parse_fn
+        self.add_fn = add_fn
+        self.remove_fn = remove_fn
+        self.on_complete = on_complete
+        self.batch_size = batch_size
+        self.jobs = {}
+        self._lock = threading.Lock()
+        # spawn, since forking a process that already runs torch and Flask threads can deadlock the workers
+        self._pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        self._coordinators = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingestion-parse")
+        self._embed_queue = queue.Queue(maxsize=max_in_flight)
+        self._embedder = threading.Thread(target=self._embed_loop, name="ingestion-embedder", daemon=True)
+        self._embedder.start()
+
+    def submit(self, filename, file_path, save_fn=None):
+        """Queue filename for ingestion, raising JobPending if it is already being ingested.
+
+        save_fn(file_path) writes the upload only once the job is registered, so
+        a concurrent upload of the same file cannot overwrite it mid-parse.
+        """
+        job = IngestionJob(filename, file_path)
+        with self._lock:
+            self._prune()
+            if any(other.filename == filename and not other.finished for other in self.jobs.values()):
+                raise JobPending(filename)
+            self.jobs[job.id] = job
+        if save_fn:
+            try:
+                save_fn(file_path)
+            except Exception as e:
+                self._fail(job, e)
+                raise
+        self._coordinators.submit(self._produce, job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def follow(self, job_ids, interval=0.25):
+        """Yield the list of jobs every interval seconds until they have all finished."""
+        jobs = [self.get(job_id) for job_id in job_ids]
+        while True:
+            yield jobs
+            if all(job.finished for job in jobs):
+                return
+            time.sleep(interval)
+
+    def shutdown(self):
+        self._coordinators.shutdown()
+        self._embed_queue.put(None)
+        self._embedder.join()
+        self._pool.shutdown()
+
+    def _produce(self, job):
+        job.status = 'processing'
+        try:
+            for chunks, units_done, units_total in self.parse_fn(job, self._pool):
+                if job.finished:
+                    # The embedder already failed this job
+                    return
+                self._embed_queue.put(('chunks', job, (chunks, units_done, units_total)))
+        except Exception as e:
+            self._embed_queue.put(('error', job, e))
+            return
+        self._embed_queue.put(('done', job, None))
+
+    def _embed_loop(self):
+        while True:
+            item = self._embed_queue.get()
+            if item is None:
+                return
+            kind, job, payload = item
+            if job.finished:
+                continue
+            if kind == 'error':
+                self._fail(job, payload)
+                continue
+            try:
+                if kind == 'chunks':
+                    chunks, units_done, units_total = payload
+                    for batch in iter_batches(chunks, self.batch_size):
+                        self.add_fn(batch)
+                        job.embedded += len(batch)
+                    job.units_done, job.units_total = units_done, units_total
+                    continue
+                if self.remove_fn and job.removed_ids:
+                    self.remove_fn(job.removed_ids)
+                if self.on_complete:
+                    self.on_complete(job)
+            except Exception as e:
+                self._fail(job, e)
+                continue
+            job.status = 'complete'
+            job.finished_at = time.time()
+            self._cleanup(job)
+
+    def _fail(self, job, error):
+        print(f"Ingestion of {job.filename} failed: {error}")
+        job.error = str(error)
+        job.status = 'failed'
+        job.finished_at = time.time()
+        self._cleanup(job)
+
+    def _prune(self):
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job.finished and job.finished_at < cutoff]:
+            del self.jobs[job_id]
+
+    def _cleanup(self, job):
+        if os.path.exists(job.file_path):
+            os.remove(job.file_path)
+
+def progress_stream(job_queue, jobs, complete_message):
+    """NDJSON lines in the format /api/upload has always streamed, driven by job progress."""
+    for snapshot in job_queue.follow([job.id for job in jobs]):
+        failed = [job for job in snapshot if job.status == 'failed']
+        if failed:
+            yield json.dumps({"error": f"Failed to process {failed[0].filename}: {failed[0].error}"}) + '\n'
+            return
+        if snapshot:
+            progress = sum(job.progress for job in snapshot) / len(snapshot)
+            yield json.dumps({
+                "progress": progress,
+                "status": "processing",
+                "jobs": [job.to_dict() for job in snapshot],
+            }) + '\n'
+    yield json.dumps({"message": complete_message, "status": "complete"}) + '\n'
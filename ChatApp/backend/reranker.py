@@ -0,0 +1,119 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import torch
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+from metrics import timed
+
+# Empty disables re-ranking, e.g. RERANKER_MODEL=cross-encoder/ms-marco-MiniLM-L-6-v2
+RERANKER_MODEL = os.environ.get('RERANKER_MODEL', '')
+RERANKER_DEVICE = os.environ.get('RERANKER_DEVICE', 'cpu')
+RERANK_TOP_N = int(os.environ.get('RERANK_TOP_N', 4))
+RERANK_TOKEN_BUDGET = int(os.environ.get('RERANK_TOKEN_BUDGET', 1500))
+RERANK_DEADLINE_MS = float(os.environ.get('RERANK_DEADLINE_MS', 250))
+
+def pack_by_budget(order, token_counts, top_n, token_budget):
+    """Take indices in order until top_n are kept or the next one would exceed token_budget."""
+    selected, used = [], 0
+    for i in order:
+        if len(selected) == top_n:
+            break
+        if selected and used + token_counts[i] > token_budget:
+            continue
+        selected.append(i)
+        used += token_counts[i]
+    return selected
+
+class CrossEncoderReranker:
+    """Scores (question, context) pairs with a small cross-encoder in one batched forward pass.
+
+    Scoring runs on a dedicated thread; if it misses the deadline the contexts
+    keep their retrieval order, so a slow re-rank never holds up an answer.
+    """
+
+    def __init__(self, model_name=RERANKER_MODEL, device=RERANKER_DEVICE, max_length=512):
+        self.model_name = model_name
+        self.device = device
+        self.max_length = max_length
+        self._model = None
+        self._tokenizer = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="reranker")
+        self.reranked = 0
+        self.timeouts = 0
+
+    @property
+    def enabled(self):
+        return bool(self.model_name)
+
+    def load(self):
+        if not self.enabled or self._model is not None:
+            return
+        with self._lock:
+            if self._model is None:
+                self._tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+                self._model = AutoModelForSequenceClassification.from_pretrained(self.model_name).to(self.device).eval()
+
+    def score(self, question, contexts):
+        self.load()
+        inputs = self._tokenizer(
+            [question] * len(contexts),
+            contexts,
+            padding=True,
+            truncation='only_second',
+            max_length=self.max_length,
+            return_tensors='pt',
+        ).to(self.device)
+        with torch.inference_mode():
+            logits = self._model(**inputs).logits
+        # Single-logit models give a relevance score; two-class ones put "relevant" second
+        scores = logits[:, 0] if logits.shape[-1] == 1 else logits[:, -1]
+        return scores.float().cpu().tolist()
+
+    def _score_by(self, deadline, question, contexts):
+        # A pass that only starts after its request gave up would just delay the ones queued behind it
+        if time.perf_counter() >= deadline:
+            return None
+        return self.score(question, contexts)
+
+    def rerank(self, question, contexts, token_counts, top_n=RERANK_TOP_N, token_budget=RERANK_TOKEN_BUDGET,
+               deadline_ms=RERANK_DEADLINE_MS):
+        """Return (indices of the contexts to keep, best first, stats dict)."""
+        start = time.perf_counter()
+        order = list(range(len(contexts)))
+        reranked = False
+        if self.enabled and len(contexts) > 1:
+            future = self._executor.submit(self._score_by, start + deadline_ms / 1000, question, contexts)
+            try:
+                scores = future.result(timeout=deadline_ms / 1000)
+                if scores is None:
+                    raise TimeoutError
+                order.sort(key=lambda i: scores[i], reverse=True)
+                reranked = True
+                self.reranked += 1
+            except TimeoutError:
+                # Dropped if still queued; a pass already running finishes in the background and is discarded
+                future.cancel()
+                self.timeouts += 1
+        selected = pack_by_budget(order, token_counts, top_n, token_budget)
+        stats = {
+            'reranked': reranked,
+            'kept': len(selected),
+            'dropped': len(contexts) - len(selected),
+            'elapsed_ms': round((time.perf_counter() - start) * 1000, 2),
+        }
+        return selected, stats
+
+reranker = CrossEncoderReranker()
+
+def select_contexts(question, contexts, count_tokens):
+    """Indices of the contexts to prompt with, best first; all of them in order when re-ranking is off."""
+    if not reranker.enabled:
+        return list(range(len(contexts)))
+    with timed('rerank'):
+        selected, stats = reranker.rerank(question, contexts, count_tokens(contexts))
+    print(f"Re-rank: {stats}")
+    return selected
@@ -0,0 +1,337 @@
+import json
+import os
+
+import numpy as np
+
+# 'chroma' (default) or 'ann' for the in-process IVFPQIndex
+VECTOR_BACKEND = os.environ.get('VECTOR_BACKEND', 'chroma')
+ANN_INDEX_DIR = os.environ.get('ANN_INDEX_DIR', './ann_index')
+ANN_N_LISTS = int(os.environ.get('ANN_N_LISTS', 64))
+ANN_N_PROBE = int(os.environ.get('ANN_N_PROBE', 8))
+ANN_PQ_M = int(os.environ.get('ANN_PQ_M', 0))
+# 'none', 'int8' or 'binary' first-pass codes; candidates are re-scored with the float vectors
+ANN_QUANTIZATION = os.environ.get('ANN_QUANTIZATION', 'none')
+ANN_RESCORE_FACTOR = int(os.environ.get('ANN_RESCORE_FACTOR', 4))
+
+META_FILE = "ann_meta.json"
+PQ_CENTROIDS = 256
+QUANTIZATIONS = ('none', 'int8', 'binary')
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def ann_params_from_env():
+    return {
+        'n_lists': ANN_N_LISTS, 'n_probe': ANN_N_PROBE, 'pq_m': ANN_PQ_M,
+        'quantization': ANN_QUANTIZATION, 'rescore_factor': ANN_RESCORE_FACTOR,
+    }
+
+def matches(metadata, where):
+    # Equality-only subset of Chroma's where filters, shared by the ANN vector stores
+    return all(metadata.get(key) == value for key, value in (where or {}).items())
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def nearest_centroids(x, centroids, chunk_size=16384):
+    # argmin ||x - c||^2 computed in chunks to bound the (n, k) distance matrix
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    assignments = np.empty(len(x), dtype=np.int32)
+    for start in range(0, len(x), chunk_size):
+        block = x[start:start + chunk_size]
+        distances = centroid_norms[None, :] - 2.0 * block @ centroids.T
+        assignments[start:start + chunk_size] = distances.argmin(axis=1)
+    return assignments
+
+def kmeans(x, k, n_iter=20, max_samples=65536, seed=0):
+    rng = np.random.default_rng(seed)
+    if len(x) > max_samples:
+        x = x[rng.choice(len(x), max_samples, replace=False)]
+    k = min(k, len(x))
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = nearest_centroids(x, centroids)
+        counts = np.bincount(assignments, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, x)
+        # Empty clusters keep their previous centroid
+        non_empty = counts > 0
+        centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+    return centroids
+
+def quantize_int8(vectors):
+    # One scale per vector; unit vectors rarely need the full range of any single dimension
+    scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127.0
+    codes = np.round(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+def quantize_binary(vectors):
+    return np.packbits(vectors > 0, axis=1)
+
+class IVFPQIndex:
+    """Inverted-file ANN index over cosine similarity, optionally product quantized.
+
+    Vectors are clustered into n_lists coarse cells by k-means and a query
+    only scores the n_probe closest cells. With pq_m > 0 each vector is stored
+    as pq_m one-byte codes (dim / pq_m dims per code) and scored with
+    asymmetric distance tables instead of float dot products. Until
+    train_size vectors have been added (or always, with n_lists=0) the index
+    is searched exhaustively.
+
+    quantization='int8' or 'binary' keeps an int8 or sign-bit copy of every
+    vector for the first pass and re-scores the best k * rescore_factor
+    candidates exactly against the float vectors. Those are memory-mapped
+    from disk after save(), so only the compressed codes stay resident.
+    All arrays are saved as .npy files and can be reopened memory-mapped.
+    """
+
+    def __init__(self, dim, n_lists=ANN_N_LISTS, n_probe=ANN_N_PROBE, pq_m=ANN_PQ_M, train_size=None, seed=0,
+                 quantization=ANN_QUANTIZATION, rescore_factor=ANN_RESCORE_FACTOR):
+        if pq_m and dim % pq_m:
+            raise ValueError(f"pq_m={pq_m} must divide the embedding dimension {dim}")
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization {quantization!r}, expected one of {QUANTIZATIONS}")
+        if pq_m and quantization != 'none':
+            raise ValueError("PQ codes replace the float vectors, so they cannot be combined with re-scored quantization")
+        self.dim = dim
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.pq_m = pq_m
+        self.train_size = train_size or n_lists * 16
+        self.seed = seed
+        self.quantization = quantization
+        self.rescore_factor = rescore_factor
+
+        self.ids = []
+        self._row_of = {}
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+        # Rows added while vectors is memory-mapped; merged into vectors.npy by save()
+        self._tail = np.empty((0, dim), dtype=np.float32)
+        self.codes = np.empty((0, pq_m), dtype=np.uint8)
+        self.qcodes = np.empty((0, (dim + 7) // 8 if quantization == 'binary' else dim),
+                               dtype=np.int8 if quantization == 'int8' else np.uint8)
+        self.scales = np.empty(0, dtype=np.float32)
+        self.lists = np.empty(0, dtype=np.int32)
+        self.alive = np.empty(0, dtype=bool)
+        self.centroids = None
+        self.codebooks = None
+        self._order = None
+        self._offsets = None
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    def __len__(self):
+        return len(self._row_of)
+
+    def add(self, ids, vectors):
+        vectors = normalize(vectors).reshape(-1, self.dim)
+        for id_ in ids:
+            # Re-adding an id replaces the old vector
+            if id_ in self._row_of:
+                self.alive[self._row_of.pop(id_)] = False
+        start = len(self.ids)
+        self.ids.extend(ids)
+        self._row_of.update((id_, start + i) for i, id_ in enumerate(ids))
+        self.alive = np.concatenate([self.alive, np.ones(len(ids), dtype=bool)])
+        if self.quantization == 'int8':
+            codes, scales = quantize_int8(vectors)
+            self.qcodes = np.concatenate([self.qcodes, codes])
+            self.scales = np.concatenate([self.scales, scales])
+        elif self.quantization == 'binary':
+            self.qcodes = np.concatenate([self.qcodes, quantize_binary(vectors)])
+
+        if self.trained:
+            self.lists = np.concatenate([self.lists, nearest_centroids(vectors, self.centroids)])
+            if self.pq_m:
+                self.codes = np.concatenate([self.codes, self._encode(vectors)])
+            else:
+                self._append_vectors(vectors)
+            self._order = None
+        else:
+            self.lists = np.concatenate([self.lists, np.full(len(ids), -1, dtype=np.int32)])
+            self._append_vectors(vectors)
+            if self.n_lists and len(self) >= self.train_size:
+                self.train()
+
+    def _append_vectors(self, vectors):
+        if isinstance(self.vectors, np.memmap):
+            # Concatenating onto the map would read the whole float matrix back into memory
+            self._tail = np.concatenate([self._tail, vectors])
+        else:
+            self.vectors = np.concatenate([self.vectors, vectors])
+
+    def _vectors_at(self, rows):
+        if not len(self._tail):
+            return self.vectors[rows]
+        base = len(self.vectors)
+        in_base = rows < base
+        out = np.empty((len(rows), self.dim), dtype=np.float32)
+        out[in_base] = self.vectors[rows[in_base]]
+        out[~in_base] = self._tail[rows[~in_base] - base]
+        return out
+
+    def _all_vectors(self):
+        return np.concatenate([self.vectors, self._tail]) if len(self._tail) else self.vectors
+
+    def delete(self, ids):
+        for id_ in ids:
+            row = self._row_of.pop(id_, None)
+            if row is not None:
+                self.alive[row] = False
+
+    def train(self):
+        vectors = self._all_vectors()
+        live = vectors[self.alive]
+        self.centroids = kmeans(live, self.n_lists, seed=self.seed)
+        self.lists = nearest_centroids(vectors, self.centroids)
+        if self.pq_m:
+            sub_dim = self.dim // self.pq_m
+            self.codebooks = np.stack([
+                kmeans(live[:, m * sub_dim:(m + 1) * sub_dim], PQ_CENTROIDS, seed=self.seed + m)
+                for m in range(self.pq_m)
+            ])
+            self.codes = self._encode(vectors)
+            # Only the codes are kept once the quantizer is trained
+            self.vectors = np.empty((0, self.dim), dtype=np.float32)
+            self._tail = np.empty((0, self.dim), dtype=np.float32)
+        self._order = None
+
+    def search(self, query, k=4, n_probe=None):
+        """Return up to k (id, cosine similarity) pairs, best first."""
+        query = normalize(query).reshape(self.dim)
+        if self.trained:
+            rows = self._probe_rows(query, n_probe or self.n_probe)
+        else:
+            rows = np.arange(len(self.ids))
+        rows = rows[self.alive[rows]]
+        if len(rows) == 0:
+            return []
+        scores = self._score(query, rows)
+        if self.quantization != 'none':
+            rows, scores = self._rescore(query, rows, scores, k)
+        k = min(k, len(rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[rows[i]], float(scores[i])) for i in top]
+
+    def _probe_rows(self, query, n_probe):
+        if self._order is None:
+            self._order = np.argsort(self.lists, kind='stable').astype(np.int64)
+            self._offsets = np.searchsorted(self.lists[self._order], np.arange(len(self.centroids) + 1))
+        n_probe = min(n_probe, len(self.centroids))
+        probe = np.argpartition(-(self.centroids @ query), n_probe - 1)[:n_probe]
+        return np.concatenate([self._order[self._offsets[l]:self._offsets[l + 1]] for l in probe])
+
+    def _rescore(self, query, rows, scores, k):
+        n_candidates = min(k * max(self.rescore_factor, 1), len(rows))
+        candidates = rows[np.argpartition(-scores, n_candidates - 1)[:n_candidates]]
+        # Sorted rows keep reads from the memory-mapped float vectors sequential
+        candidates = np.sort(candidates)
+        return candidates, self._vectors_at(candidates) @ query
+
+    def _score(self, query, rows):
+        if self.quantization == 'int8':
+            return (self.qcodes[rows].astype(np.float32) @ query) * self.scales[rows]
+        if self.quantization == 'binary':
+            # Negated Hamming distance between sign bits; only used to pick candidates
+            query_bits = quantize_binary(query[None, :])[0]
+            return -POPCOUNT[np.bitwise_xor(self.qcodes[rows], query_bits)].sum(axis=1, dtype=np.int32)
+        if self.trained and self.pq_m:
+            sub_dim = self.dim // self.pq_m
+            # tables[m, c] = <query_m, codebook_m[c]>, so a vector's score is a sum of lookups
+            tables = np.einsum('mcd,md->mc', self.codebooks, query.reshape(self.pq_m, sub_dim))
+            return tables[np.arange(self.pq_m), self.codes[rows]].sum(axis=1)
+        return self._vectors_at(rows) @ query
+
+    def _encode(self, vectors):
+        sub_dim = self.dim // self.pq_m
+        return np.stack([
+            nearest_centroids(vectors[:, m * sub_dim:(m + 1) * sub_dim], self.codebooks[m])
+            for m in range(self.pq_m)
+        ], axis=1).astype(np.uint8)
+
+    def memory_bytes(self):
+        """Bytes every search keeps hot. Memory-mapped float vectors that are only read to re-score are not counted."""
+        arrays = [self._tail, self.codes, self.qcodes, self.scales, self.lists, self.alive, self.centroids, self.codebooks]
+        if self.quantization == 'none' or not isinstance(self.vectors, np.memmap):
+            arrays.append(self.vectors)
+        return sum(array.nbytes for array in arrays if array is not None)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        arrays = {
+            'vectors': self.vectors, 'codes': self.codes, 'qcodes': self.qcodes, 'scales': self.scales,
+            'lists': self.lists, 'alive': self.alive,
+        }
+        if self.trained:
+            arrays['centroids'] = self.centroids
+        if self.codebooks is not None:
+            arrays['codebooks'] = self.codebooks
+        for name, array in arrays.items():
+            path = os.path.join(directory, f"{name}.npy")
+            if name == 'vectors' and len(self._tail):
+                # Base and tail are copied into a new file through a map, never joined in memory
+                out = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=np.float32,
+                                                shape=(len(self.vectors) + len(self._tail), self.dim))
+                out[:len(self.vectors)] = self.vectors
+                out[len(self.vectors):] = self._tail
+                out.flush()
+                del out
+                os.replace(path + '.tmp', path)
+            # Empty arrays cannot be memory-mapped, so they are simply not written
+            elif array.size:
+                # Write then rename so a live memory map of the old file stays valid
+                with open(path + '.tmp', 'wb') as f:
+                    np.save(f, np.ascontiguousarray(array))
+                os.replace(path + '.tmp', path)
+            elif os.path.exists(path):
+                os.remove(path)
+        meta = {
+            'dim': self.dim, 'n_lists': self.n_lists, 'n_probe': self.n_probe, 'pq_m': self.pq_m,
+            'train_size': self.train_size, 'seed': self.seed, 'quantization': self.quantization,
+            'rescore_factor': self.rescore_factor, 'ids': self.ids,
+        }
+        tmp_path = os.path.join(directory, META_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(directory, META_FILE))
+        if self.vectors.size and (self.quantization != 'none' or isinstance(self.vectors, np.memmap)):
+            # The float vectors are only read for re-scoring (or were mapped already), so serve them from disk
+            self.vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode='r')
+            self._tail = np.empty((0, self.dim), dtype=np.float32)
+
+    @classmethod
+    def exists(cls, directory):
+        return os.path.exists(os.path.join(directory, META_FILE))
+
+    @classmethod
+    def load(cls, directory, mmap=True, n_probe=None):
+        with open(os.path.join(directory, META_FILE)) as f:
+            meta = json.load(f)
+        index = cls(meta['dim'], meta['n_lists'], n_probe or meta['n_probe'], meta['pq_m'],
+                    meta['train_size'], meta['seed'], meta.get('quantization', 'none'),
+                    meta.get('rescore_factor', ANN_RESCORE_FACTOR))
+        mmap_mode = 'r' if mmap else None
+
+        def load_array(name, default=None):
+            path = os.path.join(directory, f"{name}.npy")
+            return np.load(path, mmap_mode=mmap_mode) if os.path.exists(path) else default
+
+        index.vectors = load_array('vectors', index.vectors)
+        index.codes = load_array('codes', index.codes)
+        index.qcodes = load_array('qcodes', index.qcodes)
+        index.scales = load_array('scales', index.scales)
+        if index.quantization != 'none':
+            # The first pass touches every code, so keep those resident and only map the float vectors
+            index.qcodes = np.array(index.qcodes)
+            index.scales = np.array(index.scales)
+        index.lists = load_array('lists', index.lists)
+        # alive is updated in place on delete, so it is always read into memory
+        index.alive = np.array(load_array('alive', index.alive))
+        index.centroids = load_array('centroids')
+        index.codebooks = load_array('codebooks')
+        index.ids = meta['ids']
+        index._row_of = {id_: row for row, id_ in enumerate(index.ids) if index.alive[row]}
+        return index
@@ -0,0 +1,111 @@
+import json
+import os
+import threading
+import uuid
+
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+from ann_index import IVFPQIndex, ann_params_from_env, matches
+
+DOCSTORE_FILE = "docstore.json"
+
+class ANNVectorStore(VectorStore):
+    """LangChain vector store backed by an in-process IVFPQIndex instead of Chroma.
+
+    Scores are cosine distances (lower is closer), like a Chroma collection with hnsw:space=cosine. Writes
+    stay in memory until persist() is called.
+    """
+
+    def __init__(self, embedding_function, persist_directory=None, mmap=True, **index_params):
+        self._embedding = embedding_function
+        self.persist_directory = persist_directory
+        self.index_params = {**ann_params_from_env(), **index_params}
+        self.index = None
+        self.docs = {}
+        self._lock = threading.RLock()
+        if persist_directory and IVFPQIndex.exists(persist_directory):
+            self.index = IVFPQIndex.load(persist_directory, mmap=mmap, n_probe=self.index_params['n_probe'])
+            with open(os.path.join(persist_directory, DOCSTORE_FILE)) as f:
+                self.docs = json.load(f)
+
+    @property
+    def embeddings(self):
+        return self._embedding
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        ids = list(ids) if ids else [str(uuid.uuid4()) for _ in texts]
+        vectors = self._embedding.embed_documents(texts)
+        with self._lock:
+            if self.index is None:
+                self.index = IVFPQIndex(len(vectors[0]), **self.index_params)
+            self.index.add(ids, vectors)
+            for id_, text, metadata in zip(ids, texts, metadatas):
+                self.docs[id_] = {'text': text, 'metadata': metadata}
+        return ids
+
+    def delete(self, ids=None, **kwargs):
+        with self._lock:
+            if self.index is not None and ids:
+                self.index.delete(ids)
+            for id_ in ids or []:
+                self.docs.pop(id_, None)
+        return True
+
+    def get(self, ids=None, where=None, include=("documents", "metadatas")):
+        """Chroma-style lookup by id and/or exact-match metadata filter."""
+        with self._lock:
+            selected = [
+                id_ for id_ in (ids if ids is not None else self.docs)
+                if id_ in self.docs and matches(self.docs[id_]['metadata'], where)
+            ]
+            result = {'ids': selected}
+            if 'documents' in include:
+                result['documents'] = [self.docs[id_]['text'] for id_ in selected]
+            if 'metadatas' in include:
+                result['metadatas'] = [self.docs[id_]['metadata'] for id_ in selected]
+        return result
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4, filter=None, n_probe=None, **kwargs):
+        with self._lock:
+            if self.index is None:
+                return []
+            # Metadata filters are applied after the ANN search, so over-fetch when filtering
+            hits = self.index.search(embedding, k * 4 if filter else k, n_probe=n_probe)
+            results = []
+            for id_, similarity in hits:
+                doc = self.docs[id_]
+                if matches(doc['metadata'], filter):
+                    results.append((Document(page_content=doc['text'], metadata=doc['metadata'], id=id_), 1.0 - similarity))
+        return results[:k]
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k, filter, **kwargs)]
+
+    def similarity_search_with_score(self, query, k=4, filter=None, **kwargs):
+        return self.similarity_search_by_vector_with_score(self._embedding.embed_query(query), k, filter, **kwargs)
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        return lambda distance: 1.0 - distance
+
+    def persist(self):
+        if not self.persist_directory or self.index is None:
+            return
+        with self._lock:
+            self.index.save(self.persist_directory)
+            tmp_path = os.path.join(self.persist_directory, DOCSTORE_FILE + '.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(self.docs, f)
+            os.replace(tmp_path, os.path.join(self.persist_directory, DOCSTORE_FILE))
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, persist_directory=None, **kwargs):
+        store = cls(embedding, persist_directory=persist_directory, **kwargs)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        store.persist()
+        return store
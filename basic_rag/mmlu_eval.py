@@ -0,0 +1,124 @@
+import argparse
+import time
+from typing import List
+
+import torch
+from deepeval.benchmarks import MMLU
+from deepeval.benchmarks.tasks import MMLUTask
+from deepeval.models.base_model import DeepEvalBaseLLM
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+
+CHOICES = ('A', 'B', 'C', 'D')
+EVAL_BATCH_SIZE = 16
+
+def load_causal_lm(model_id, quantize=False, device=None):
+    """Model and tokenizer on device (the GPU when there is one); 4-bit quantization needs CUDA and is skipped on CPU."""
+    device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    kwargs = {}
+    if quantize and device != 'cpu':
+        kwargs['quantization_config'] = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.bfloat16
+        )
+        # bitsandbytes places the weights itself
+        kwargs['device_map'] = device
+    model = AutoModelForCausalLM.from_pretrained(model_id, torch_dtype="auto", trust_remote_code=True, **kwargs)
+    if 'quantization_config' not in kwargs:
+        model = model.to(device)
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
+    return model.eval(), tokenizer
+
+def task_names(tasks=None):
+    return list(tasks) if tasks else [task.value for task in MMLUTask]
+
+def make_benchmark(tasks=None, n_shots=5):
+    """MMLU over the named tasks (e.g. 'high_school_computer_science'), or all of them."""
+    return MMLU(tasks=[MMLUTask(task) for task in tasks] if tasks else None, n_shots=n_shots)
+
+class MultipleChoiceLLM(DeepEvalBaseLLM):
+    """DeepEval model that answers multiple-choice prompts from next-token logits.
+
+    Instead of sampling up to 100 tokens per prompt, prompts are padded into
+    batches and each gets the choice letter with the highest logit at the
+    position after "Answer:", so one forward pass scores a whole batch.
+    """
+
+    def __init__(self, model, tokenizer, name=None, batch_size=EVAL_BATCH_SIZE, choices=CHOICES):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.model_name = model.name_or_path if name is None else name
+        self.batch_size = batch_size
+        self.choices = choices
+        # Left padding keeps every prompt's last token in the last position
+        self.tokenizer.padding_side = 'left'
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.choice_ids = [self._choice_token_ids(choice) for choice in choices]
+        self.prompts_scored = 0
+
+    def _choice_token_ids(self, choice):
+        # The letter may be predicted with or without a leading space depending on the tokenizer
+        ids = {self.tokenizer.encode(text, add_special_tokens=False)[-1] for text in (choice, f" {choice}")}
+        return sorted(ids)
+
+    def load_model(self):
+        return self.model
+
+    @staticmethod
+    def answer_prompt(prompt):
+        prompt = prompt.rstrip()
+        return prompt if prompt.endswith("Answer:") else f"{prompt}\nAnswer:"
+
+    def batch_generate(self, prompts: List[str]) -> List[str]:
+        model = self.load_model()
+        device = next(model.parameters()).device
+        encoded = self.tokenizer([self.answer_prompt(prompt) for prompt in prompts], add_special_tokens=True)['input_ids']
+        # Batching prompts of similar length wastes less compute on padding
+        order = sorted(range(len(prompts)), key=lambda i: len(encoded[i]))
+        answers = [None] * len(prompts)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            inputs = self.tokenizer.pad({'input_ids': [encoded[i] for i in batch]}, return_tensors='pt').to(device)
+            # Count positions from each prompt's first real token, so models with absolute position
+            # embeddings (GPT-2) score a padded prompt exactly as they would on its own
+            position_ids = (inputs['attention_mask'].long().cumsum(-1) - 1).clamp(min=0)
+            with torch.inference_mode():
+                logits = model(**inputs, position_ids=position_ids).logits[:, -1, :]
+            scores = torch.stack([logits[:, ids].max(dim=-1).values for ids in self.choice_ids], dim=-1)
+            for i, best in zip(batch, scores.argmax(dim=-1).tolist()):
+                answers[i] = self.choices[best]
+        self.prompts_scored += len(prompts)
+        return answers
+
+    def generate(self, prompt: str) -> str:
+        return self.batch_generate([prompt])[0]
+
+    async def a_generate(self, prompt: str) -> str:
+        return self.generate(prompt)
+
+    def get_model_name(self):
+        return self.model_name
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched MMLU evaluation by next-token choice logits")
+    parser.add_argument("--model", default="sshleifer/tiny-gpt2", help="Model ID")
+    parser.add_argument("--device", help="cuda, cuda:N or cpu (default: cuda when available)")
+    parser.add_argument("--quantize", action="store_true", help="Load the model in 4-bit (GPU only)")
+    parser.add_argument("--tasks", nargs="+", help="MMLU tasks to run, e.g. high_school_computer_science (default: all)")
+    parser.add_argument("--n_shots", type=int, default=5, help="Few-shot examples per prompt")
+    parser.add_argument("--batch_size", type=int, default=EVAL_BATCH_SIZE, help="Prompts scored per forward pass")
+    args = parser.parse_args()
+
+    model, tokenizer = load_causal_lm(args.model, args.quantize, args.device)
+    llm = MultipleChoiceLLM(model, tokenizer, batch_size=args.batch_size)
+    benchmark = make_benchmark(args.tasks, args.n_shots)
+    start = time.perf_counter()
+    results = benchmark.evaluate(model=llm, batch_size=args.batch_size)
+    elapsed = time.perf_counter() - start
+    print(f"Overall Score: {results}")
+    print(f"{llm.prompts_scored} prompts in {elapsed:.1f}s ({llm.prompts_scored / elapsed:.1f} prompts/s)")
+
+if __name__ == "__main__":
+    main()
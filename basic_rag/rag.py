@@ -1,4 +1,5 @@
 import os
+import sys
 import torch
 import argparse
 from langchain_huggingface.llms import HuggingFacePipeline
@@ -8,10 +9,15 @@ from langchain_chroma import Chroma
 from langchain_community.document_loaders import WebBaseLoader
 from langchain_core.prompts import PromptTemplate
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain.chains import create_retrieval_chain
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ann_index import VECTOR_BACKEND
+from ann_vectorstore import ANNVectorStore
+from rag_common import create_embeddings, iter_questions, open_persistent_index
+from vector_index import documents_hash
+
 def load_model(model_id, gpu_id):
     device = f'cuda:{gpu_id}' if torch.cuda.is_available() else 'cpu'
     model = AutoModelForCausalLM.from_pretrained(
@@ -26,7 +32,7 @@ def load_model(model_id, gpu_id):
                     max_new_tokens=1024)
     return HuggingFacePipeline(pipeline=pipe)
 
-def load_and_process_document(url):
+def load_url(url):
     loader = WebBaseLoader(
         web_paths=(url,),
         bs_kwargs=dict(
@@ -35,13 +41,19 @@ def load_and_process_document(url):
             )
         ),
     )
-    docs = loader.load()
+    return loader.load()
+
+def split_documents(docs):
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
     return text_splitter.split_documents(docs)
 
+def load_and_process_document(url):
+    return split_documents(load_url(url))
+
 def create_vectorstore(splits):
-    embeddings_model = HuggingFaceEmbeddings(model_name="sentence-transformers/all-mpnet-base-v2")
-    return Chroma.from_documents(splits, embedding=embeddings_model)
+    if VECTOR_BACKEND == 'ann':
+        return ANNVectorStore.from_documents(splits, embedding=create_embeddings())
+    return Chroma.from_documents(splits, embedding=create_embeddings())
 
 def create_rag_chain(llm, retriever):
     template = """<|system|>
@@ -60,21 +72,27 @@ def parse_assistant_phi_response(model_response: str):
 def main():
     parser = argparse.ArgumentParser(description="RAG Chain Script")
     parser.add_argument("--model", default="microsoft/Phi-3-mini-4k-instruct", help="Model ID")
-    parser.add_argument("--question", required=True, help="Question to answer")
+    parser.add_argument("--question", help="Question to answer; if omitted, questions are read from stdin")
     parser.add_argument("--url", default="https://lilianweng.github.io/posts/2023-06-23-agent/", help="URL to process")
     parser.add_argument("--gpu", type=int, default=0, help="GPU ID to use")
+    parser.add_argument("--index_dir", "--index-dir", help="Persist the vector index here and reuse it across runs")
     args = parser.parse_args()
 
     os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
 
     llm = load_model(args.model, args.gpu)
-    splits = load_and_process_document(args.url)
-    vectorstore = create_vectorstore(splits)
+    if args.index_dir:
+        docs = load_url(args.url)
+        vectorstore = open_persistent_index(args.index_dir, args.url, documents_hash(docs), lambda: split_documents(docs))
+    else:
+        splits = load_and_process_document(args.url)
+        vectorstore = create_vectorstore(splits)
     retriever = vectorstore.as_retriever()
     rag_chain = create_rag_chain(llm, retriever)
 
-    response = rag_chain.invoke({"input": args.question})
-    print(parse_assistant_phi_response(response['answer']))
+    for question in iter_questions(args.question):
+        response = rag_chain.invoke({"input": question})
+        print(parse_assistant_phi_response(response['answer']))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
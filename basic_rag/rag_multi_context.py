@@ -1,4 +1,5 @@
 import os
+import sys
 import torch
 import argparse
 from langchain_huggingface.llms import HuggingFacePipeline
@@ -7,11 +8,19 @@ import bs4
 from langchain_chroma import Chroma
 from langchain_community.document_loaders import WebBaseLoader
 from langchain_core.prompts import PromptTemplate
+from langchain_core.runnables import RunnableLambda
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain.chains import create_retrieval_chain
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ann_index import VECTOR_BACKEND
+from ann_vectorstore import ANNVectorStore
+from context_packer import ContextPacker
+from rag_common import create_embeddings, iter_questions, open_persistent_index, pack_documents
+from tokenizer_service import TokenCounter
+from vector_index import documents_hash
+
 def load_model(model_id, gpu_id):
     device = f'cuda:{gpu_id}' if torch.cuda.is_available() else 'cpu'
     model = AutoModelForCausalLM.from_pretrained(
@@ -27,7 +36,7 @@ def load_model(model_id, gpu_id):
                     max_new_tokens=1024)
     return HuggingFacePipeline(pipeline=pipe)
 
-def load_and_process_document(url):
+def load_url(url):
     loader = WebBaseLoader(
         web_paths=(url,),
         bs_kwargs=dict(
@@ -36,15 +45,21 @@ def load_and_process_document(url):
             )
         ),
     )
-    docs = loader.load()
+    return loader.load()
+
+def split_documents(docs):
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
     return text_splitter.split_documents(docs)
 
+def load_and_process_document(url):
+    return split_documents(load_url(url))
+
 def create_vectorstore(splits):
-    embeddings_model = HuggingFaceEmbeddings(model_name="sentence-transformers/all-mpnet-base-v2")
-    return Chroma.from_documents(splits, embedding=embeddings_model)
+    if VECTOR_BACKEND == 'ann':
+        return ANNVectorStore.from_documents(splits, embedding=create_embeddings())
+    return Chroma.from_documents(splits, embedding=create_embeddings())
 
-def create_multi_context_rag_chain(llm, retriever, num_contexts):
+def create_multi_context_rag_chain(llm, retriever, num_contexts, packer=None):
     template = """<|system|>
 You are an assistant for question-answering tasks. Use the following pieces of retrieved context to answer the question. If you don't know the answer, just say that you don't know. Use three sentences maximum and keep the answer concise.<|end|>
 <|user|>
@@ -58,6 +73,13 @@ Contexts:
     def format_docs(docs):
         return "\n\n".join(f"Context {i+1}:\n{doc.page_content}" for i, doc in enumerate(docs))
     
+    if packer is not None:
+        # Overlapping chunks are stitched and the set is trimmed to the model's token budget
+        base_retriever = retriever
+        retriever = RunnableLambda(
+            lambda inputs: pack_documents(packer, prompt, base_retriever.invoke(inputs["input"]), inputs["input"])
+        )
+
     question_answer_chain = create_stuff_documents_chain(llm, prompt)
     return create_retrieval_chain(retriever, question_answer_chain)
 
@@ -67,22 +89,29 @@ def parse_assistant_phi_response(model_response: str):
 def main():
     parser = argparse.ArgumentParser(description="Multi-Context RAG Chain Script")
     parser.add_argument("--model", default="microsoft/Phi-3-mini-4k-instruct", help="Model ID")
-    parser.add_argument("--question", required=True, help="Question to answer")
+    parser.add_argument("--question", help="Question to answer; if omitted, questions are read from stdin")
     parser.add_argument("--url", default="https://lilianweng.github.io/posts/2023-06-23-agent/", help="URL to process")
     parser.add_argument("--gpu", type=int, default=0, help="GPU ID to use")
+    parser.add_argument("--index_dir", "--index-dir", help="Persist the vector index here and reuse it across runs")
     parser.add_argument("--num_contexts", type=int, default=4, help="Number of contexts to retrieve")
     args = parser.parse_args()
 
     os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
 
     llm = load_model(args.model, args.gpu)
-    splits = load_and_process_document(args.url)
-    vectorstore = create_vectorstore(splits)
+    if args.index_dir:
+        docs = load_url(args.url)
+        vectorstore = open_persistent_index(args.index_dir, args.url, documents_hash(docs), lambda: split_documents(docs))
+    else:
+        splits = load_and_process_document(args.url)
+        vectorstore = create_vectorstore(splits)
     retriever = vectorstore.as_retriever(search_kwargs={"k": args.num_contexts})
-    rag_chain = create_multi_context_rag_chain(llm, retriever, args.num_contexts)
+    packer = ContextPacker(TokenCounter(args.model).count_many)
+    rag_chain = create_multi_context_rag_chain(llm, retriever, args.num_contexts, packer)
 
-    response = rag_chain.invoke({"input": args.question})
-    print(parse_assistant_phi_response(response['answer']))
+    for question in iter_questions(args.question):
+        response = rag_chain.invoke({"input": question})
+        print(parse_assistant_phi_response(response['answer']))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
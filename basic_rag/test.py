@@ -1,8 +1,9 @@
 from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline, BitsAndBytesConfig
-from deepeval.models.base_model import DeepEvalBaseLLM
 from deepeval.benchmarks import MMLU
 import os, torch, datasets
 
+from mmlu_eval import EVAL_BATCH_SIZE, MultipleChoiceLLM
+
 #datasets.config.MAX_DURATION = 1000000  # Set a very high timeout in seconds
 
 os.environ['CUDA_VISIBLE_DEVICES'] = str(5)
@@ -20,37 +21,6 @@ def remove_model_from_gpu(model):
     torch.cuda.empty_cache()  # Clear CUDA cache
     print("Model removed from GPU and CUDA cache cleared.")
 
-class Phi(DeepEvalBaseLLM):
-    def __init__(
-        self,
-        model,
-        tokenizer,
-        name=None
-    ):
-        self.model = model
-        self.tokenizer = tokenizer
-        self.model_name = model.name_or_path if name is None else name
-
-    def load_model(self):
-        return self.model
-
-    def generate(self, prompt: str) -> str:
-        torch.cuda.empty_cache()  # Clear CUDA cache
-        model = self.load_model()
-
-        device = "cuda" # the device to load the model onto
-
-        model_inputs = self.tokenizer([prompt], return_tensors="pt").to(device)
-
-        generated_ids = model.generate(**model_inputs, max_new_tokens=100, do_sample=True)
-        return self.tokenizer.batch_decode(generated_ids)[0]
-
-    async def a_generate(self, prompt: str) -> str:
-        return self.generate(prompt)
-
-    def get_model_name(self):
-        return self.model_name
-
 ############################################################################################
 
 model_id = "microsoft/Phi-3.5-mini-instruct"
@@ -71,10 +41,10 @@ model = AutoModelForCausalLM.from_pretrained(
 
 tokenizer = AutoTokenizer.from_pretrained(model_id)
 
-phi = Phi(model=model, tokenizer=tokenizer, name="phi-3.5-mini-4b")
+phi = MultipleChoiceLLM(model=model, tokenizer=tokenizer, name="phi-3.5-mini-4b")
 
 benchmark = MMLU()
-results = benchmark.evaluate(model=phi)
+results = benchmark.evaluate(model=phi, batch_size=EVAL_BATCH_SIZE)
 print("Overall Score: ", results)
 
 filename="phi3.5-mini-4b_quant.txt"
@@ -87,10 +57,10 @@ remove_model_from_gpu(model)
 model = AutoModelForCausalLM.from_pretrained('microsoft/Phi-3.5-mini-instruct')
 tokenizer = AutoTokenizer.from_pretrained('microsoft/Phi-3.5-mini-instruct')
 
-phi = Phi(model=model, tokenizer=tokenizer)
+phi = MultipleChoiceLLM(model=model, tokenizer=tokenizer)
 
 benchmark = MMLU()
-results = benchmark.evaluate(model=phi)
+results = benchmark.evaluate(model=phi, batch_size=EVAL_BATCH_SIZE)
 print("Overall Score: ", results)
 
 filename="phi3.5-mini-no_quant.txt"
@@ -120,10 +90,10 @@ model = AutoModelForCausalLM.from_pretrained(
 tokenizer = AutoTokenizer.from_pretrained(model_id)
 
 
-phi = Phi(model=model, tokenizer=tokenizer)
+phi = MultipleChoiceLLM(model=model, tokenizer=tokenizer)
 
 benchmark = MMLU()
-results = benchmark.evaluate(model=phi)
+results = benchmark.evaluate(model=phi, batch_size=EVAL_BATCH_SIZE)
 print("Overall Score: ", results)
 
 filename="phi3.5-MoE-4b_quant.txt"
@@ -150,10 +120,10 @@ model = AutoModelForCausalLM.from_pretrained(
 tokenizer = AutoTokenizer.from_pretrained(model_id)
 
 
-phi = Phi(model=model, tokenizer=tokenizer)
+phi = MultipleChoiceLLM(model=model, tokenizer=tokenizer)
 
 benchmark = MMLU()
-results = benchmark.evaluate(model=phi)
+results = benchmark.evaluate(model=phi, batch_size=EVAL_BATCH_SIZE)
 print("Overall Score: ", results)
 
 filename="phi3-mini-no_quant.txt"
@@ -1,13 +1,18 @@
 import os
+import time
 import torch
 import json
 import argparse
 import csv
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
-from deepeval.models.base_model import DeepEvalBaseLLM
-from deepeval.benchmarks import MMLU
+from collections import deque
+from multiprocessing.connection import wait
 import torch.multiprocessing as mp
 
+from mmlu_eval import EVAL_BATCH_SIZE, MultipleChoiceLLM, load_causal_lm, make_benchmark, task_names
+
+REPORT_FIELDS = ['model_id', 'quantize', 'name', 'status', 'attempts', 'device', 'overall_score', 'tasks',
+                 'questions', 'eval_seconds', 'wall_clock_seconds', 'questions_per_sec']
+
 def save_results_to_file(results, filename="mmlu_results.txt"):
     with open(filename, "w") as f:
         f.write(f"Overall Score: {results}\n")
@@ -19,69 +24,143 @@ def remove_model_from_gpu(model):
     torch.cuda.empty_cache()
     print("Model removed from GPU and CUDA cache cleared.")
 
-class Phi(DeepEvalBaseLLM):
-    def __init__(self, model, tokenizer, name=None):
-        self.model = model
-        self.tokenizer = tokenizer
-        self.model_name = model.name_or_path if name is None else name
-
-    def load_model(self):
-        return self.model
-
-    def generate(self, prompt: str) -> str:
-        torch.cuda.empty_cache()
-        model = self.load_model()
-        device = next(model.parameters()).device
-        model_inputs = self.tokenizer([prompt], return_tensors="pt").to(device)
-        generated_ids = model.generate(**model_inputs, max_new_tokens=100, do_sample=True)
-        return self.tokenizer.batch_decode(generated_ids)[0]
-
-    async def a_generate(self, prompt: str) -> str:
-        return self.generate(prompt)
-
-    def get_model_name(self):
-        return self.model_name
-
-def evaluate_model(gpu_id, model_config):
-    os.environ['CUDA_VISIBLE_DEVICES'] = str(gpu_id)
-    torch.cuda.set_device(0)  # Use the first (and only) GPU visible to this process
-    
+def write_json(path, data):
+    # Written whole or not at all, so a crash never leaves a half checkpoint behind
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_path, path)
+
+def model_name(model_config):
+    model_id, _, name_suffix = model_config
+    return f"{model_id}-{name_suffix}"
+
+def job_dir(checkpoint_dir, model_config):
+    return os.path.join(checkpoint_dir, model_name(model_config).replace('/', '-'))
+
+def evaluate_model(device, model_config, batch_size=EVAL_BATCH_SIZE, tasks=None, n_shots=5,
+                   checkpoint_dir="mmlu_checkpoints"):
+    # device is a GPU ID or 'cpu:N'; either way it must be set before CUDA is first touched
+    os.environ['CUDA_VISIBLE_DEVICES'] = '' if str(device).startswith('cpu') else str(device)
+    torch_device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if torch_device == 'cuda':
+        torch.cuda.set_device(0)  # Use the first (and only) GPU visible to this process
+
     model_id, quantize, name_suffix = model_config
     quantize = quantize.lower() == 'true'  # Convert string to boolean
-    
-    if quantize:
-        bnb_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_use_double_quant=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.bfloat16
-        )
-        model = AutoModelForCausalLM.from_pretrained(
-            model_id,
-            torch_dtype="auto",
-            trust_remote_code=True,
-            quantization_config=bnb_config
-        ).to('cuda')
-    else:
-        model = AutoModelForCausalLM.from_pretrained(
-            model_id,
-            torch_dtype="auto",
-            trust_remote_code=True
-        ).to('cuda')
-    
-    tokenizer = AutoTokenizer.from_pretrained(model_id)
-    
-    phi = Phi(model=model, tokenizer=tokenizer, name=f"{model_id}-{name_suffix}")
-    
-    benchmark = MMLU()
-    results = benchmark.evaluate(model=phi)
-    print(f"Overall Score for {phi.get_model_name()}: {results}")
-    
-    filename = f"{phi.get_model_name().replace('/', '-')}_results.txt"
+
+    # Subjects finished by an earlier, crashed attempt are not run again
+    directory = job_dir(checkpoint_dir, model_config)
+    os.makedirs(directory, exist_ok=True)
+    remaining = [task for task in task_names(tasks) if not os.path.exists(os.path.join(directory, f"{task}.json"))]
+
+    if remaining:
+        model, tokenizer = load_causal_lm(model_id, quantize, torch_device)
+        phi = MultipleChoiceLLM(model=model, tokenizer=tokenizer, name=model_name(model_config), batch_size=batch_size)
+        for task in remaining:
+            scored = phi.prompts_scored
+            start = time.perf_counter()
+            score = make_benchmark([task], n_shots).evaluate(model=phi, batch_size=batch_size)
+            write_json(os.path.join(directory, f"{task}.json"), {
+                'task': task,
+                'score': score,
+                'questions': phi.prompts_scored - scored,
+                'seconds': time.perf_counter() - start,
+            })
+        remove_model_from_gpu(model)
+
+    checkpoints = []
+    for task in task_names(tasks):
+        with open(os.path.join(directory, f"{task}.json")) as f:
+            checkpoints.append(json.load(f))
+    questions = sum(checkpoint['questions'] for checkpoint in checkpoints)
+    results = {
+        # MMLU's overall score weights every question equally
+        'overall_score': sum(c['score'] * c['questions'] for c in checkpoints) / questions if questions else 0.0,
+        'task_scores': {checkpoint['task']: checkpoint['score'] for checkpoint in checkpoints},
+        'questions': questions,
+        'eval_seconds': sum(checkpoint['seconds'] for checkpoint in checkpoints),
+    }
+    write_json(os.path.join(directory, "summary.json"), results)
+    print(f"Overall Score for {model_name(model_config)}: {results['overall_score']}")
+
+    filename = f"{model_name(model_config).replace('/', '-')}_results.txt"
     save_results_to_file(results, filename=filename)
     print(f"Results saved to {filename}")
-    
-    remove_model_from_gpu(model)
+
+def run_jobs(model_configs, devices, workers_per_device=1, max_retries=1, **eval_kwargs):
+    """Run evaluate_model for every config with at most workers_per_device jobs per device.
+
+    A job is started only when a device has a free slot, and one that exits
+    abnormally (e.g. killed on OOM) is queued again up to max_retries times.
+    Returns {config: record} with status, attempts, device and wall clock.
+    """
+    # spawn so that each job sets CUDA_VISIBLE_DEVICES before CUDA is initialized
+    ctx = mp.get_context('spawn')
+    pending = deque((model_config, 1) for model_config in model_configs)
+    free = {device: workers_per_device for device in devices}
+    running = {}
+    started = {}
+    records = {}
+    while pending or running:
+        while pending and max(free.values()) > 0:
+            device = max(devices, key=lambda d: free[d])
+            model_config, attempt = pending.popleft()
+            process = ctx.Process(target=evaluate_model, args=(device, model_config), kwargs=eval_kwargs)
+            process.start()
+            free[device] -= 1
+            running[process.sentinel] = (process, device, model_config, attempt)
+            started.setdefault(model_config, time.perf_counter())
+            print(f"Started {model_name(model_config)} on {device} (attempt {attempt})")
+
+        for sentinel in wait(list(running)):
+            process, device, model_config, attempt = running.pop(sentinel)
+            process.join()
+            free[device] += 1
+            if process.exitcode != 0 and attempt <= max_retries:
+                print(f"{model_name(model_config)} exited with {process.exitcode} on {device}; retrying")
+                pending.append((model_config, attempt + 1))
+                continue
+            records[model_config] = {
+                'status': 'ok' if process.exitcode == 0 else f'failed ({process.exitcode})',
+                'attempts': attempt,
+                'device': device,
+                'wall_clock_seconds': time.perf_counter() - started[model_config],
+            }
+            print(f"Finished {model_name(model_config)}: {records[model_config]['status']}")
+    return records
+
+def write_report(model_configs, records, checkpoint_dir, report):
+    rows = []
+    for model_config in model_configs:
+        model_id, quantize, _ = model_config
+        record = records[model_config]
+        summary = {}
+        summary_path = os.path.join(job_dir(checkpoint_dir, model_config), "summary.json")
+        if record['status'] == 'ok' and os.path.exists(summary_path):
+            with open(summary_path) as f:
+                summary = json.load(f)
+        questions = summary.get('questions', 0)
+        rows.append({
+            'model_id': model_id,
+            'quantize': quantize,
+            'name': model_name(model_config),
+            **record,
+            'overall_score': summary.get('overall_score'),
+            'tasks': len(summary.get('task_scores', {})),
+            'questions': questions,
+            'eval_seconds': summary.get('eval_seconds'),
+            # Scoring time summed over attempts, so resumed jobs are not credited with earlier runs' questions
+            'questions_per_sec': questions / summary['eval_seconds'] if summary.get('eval_seconds') else None,
+        })
+
+    with open(f"{report}.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    with open(f"{report}.json", "w") as f:
+        json.dump(rows, f, indent=4)
+    print(f"Report written to {report}.csv and {report}.json")
 
 def read_model_configs(csv_file):
     model_configs = []
@@ -94,27 +173,38 @@ def read_model_configs(csv_file):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run MMLU evaluations on multiple GPUs.")
-    parser.add_argument("--gpus", type=int, nargs="+", required=True, help="List of GPU IDs to use")
+    parser.add_argument("--gpus", type=int, nargs="+", default=[], help="List of GPU IDs to use")
+    parser.add_argument("--cpu_workers", type=int, default=0, help="CPU devices to schedule jobs on, e.g. for tiny test models")
+    parser.add_argument("--workers_per_device", type=int, default=1, help="Jobs run at once on each device")
+    parser.add_argument("--max_retries", type=int, default=1, help="Times a crashed job is queued again")
     parser.add_argument("--config", type=str, required=True, help="Path to CSV file containing model configurations")
+    parser.add_argument("--batch_size", type=int, default=EVAL_BATCH_SIZE, help="Prompts scored per forward pass")
+    parser.add_argument("--tasks", nargs="+", help="MMLU tasks to run, e.g. high_school_computer_science (default: all)")
+    parser.add_argument("--n_shots", type=int, default=5, help="Few-shot examples per prompt")
+    parser.add_argument("--checkpoint_dir", default="mmlu_checkpoints", help="Per-subject results; rerunning resumes from them")
+    parser.add_argument("--report", default="mmlu_report", help="Write the aggregated report to REPORT.csv and REPORT.json")
     args = parser.parse_args()
 
-    #mp.set_start_method('spawn')
-    
+    # Each CPU worker counts as a device of its own
+    devices = [*args.gpus, *(f'cpu:{i}' for i in range(args.cpu_workers))]
+    if not devices:
+        parser.error("give --gpus and/or --cpu_workers")
+
     model_configs = read_model_configs(args.config)
-    
-    available_gpus = args.gpus
-    num_gpus = len(available_gpus)
-    print(f"Using GPUs: {available_gpus}")
+    print(f"Using devices: {devices}")
     print(f"Loaded {len(model_configs)} model configurations")
-    
-    processes = []
-    for i, model_config in enumerate(model_configs):
-        gpu_id = available_gpus[i % num_gpus]
-        p = mp.Process(target=evaluate_model, args=(gpu_id, model_config))
-        p.start()
-        processes.append(p)
-    
-    for p in processes:
-        p.join()
-
-    print("All evaluations completed.")
\ No newline at end of file
+
+    start = time.perf_counter()
+    records = run_jobs(
+        model_configs,
+        devices,
+        workers_per_device=args.workers_per_device,
+        max_retries=args.max_retries,
+        batch_size=args.batch_size,
+        tasks=args.tasks,
+        n_shots=args.n_shots,
+        checkpoint_dir=args.checkpoint_dir,
+    )
+    write_report(model_configs, records, args.checkpoint_dir, args.report)
+
+    print(f"All evaluations completed in {time.perf_counter() - start:.1f}s.")
@@ -0,0 +1,96 @@
+import csv
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from embedding_cache import CachedEmbeddings
+from model_client import ModelClient
+
+def read_questions(path):
+    """Yield {'id', 'question'} records from a JSONL or CSV file without loading it all."""
+    _, extension = os.path.splitext(path)
+    with open(path, newline='') as f:
+        if extension.lower() == '.csv':
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for i, row in enumerate(rows):
+            yield {'id': str(row.get('id', i)), 'question': row['question']}
+
+def load_done_ids(output_path):
+    done = set()
+    if os.path.exists(output_path):
+        with open(output_path) as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)['id'])
+                except (ValueError, KeyError):
+                    # A partially written last line from an interrupted run
+                    continue
+    return done
+
+def retrieve_batch(vectorstore, questions, k):
+    start = time.perf_counter()
+    # mpnet embeds queries and documents the same way, so one batched call covers the whole batch;
+    # it goes to the model behind the cache so questions never crowd out cached chunks
+    embeddings = vectorstore.embeddings
+    if isinstance(embeddings, CachedEmbeddings):
+        embeddings = embeddings.embeddings
+    query_vectors = embeddings.embed_documents(questions)
+    embed_time = (time.perf_counter() - start) / len(questions)
+    results = []
+    for vector in query_vectors:
+        search_start = time.perf_counter()
+        docs = vectorstore.similarity_search_by_vector(vector, k=k)
+        results.append((docs, embed_time + time.perf_counter() - search_start))
+    return results
+
+def generate(client, prompt):
+    start = time.perf_counter()
+    answer = client.generate(prompt)
+    return answer, time.perf_counter() - start
+
+def answer_questions_file(vectorstore, prompt, api_url, questions_path, output_path,
+                          k=4, batch_size=32, concurrency=8):
+    done = load_done_ids(output_path)
+    if done:
+        print(f"Resuming: {len(done)} questions already answered in {output_path}")
+    pending = (record for record in read_questions(questions_path) if record['id'] not in done)
+
+    client = ModelClient(api_url, pool_size=concurrency)
+    answered = 0
+    start = time.perf_counter()
+    with open(output_path, 'a') as out, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            batch = list(islice(pending, batch_size))
+            if not batch:
+                break
+            retrieved = retrieve_batch(vectorstore, [record['question'] for record in batch], k)
+            prompts = [
+                prompt.format(input=record['question'], context="\n\n".join(doc.page_content for doc in docs))
+                for record, (docs, _) in zip(batch, retrieved)
+            ]
+            futures = [executor.submit(generate, client, p) for p in prompts]
+            for record, (docs, retrieval_time), future in zip(batch, retrieved, futures):
+                result = {'id': record['id'], 'question': record['question']}
+                try:
+                    answer, generation_time = future.result()
+                    result.update(answer=answer, generation_s=generation_time)
+                except Exception as e:
+                    result.update(answer=None, error=str(e))
+                result.update(
+                    retrieval_s=retrieval_time,
+                    contexts=[doc.metadata for doc in docs],
+                )
+                if result.get('error'):
+                    # Leave failed questions out so the next run retries them
+                    print(f"Question {record['id']} failed: {result['error']}")
+                    continue
+                out.write(json.dumps(result) + '\n')
+                answered += 1
+            out.flush()
+            elapsed = time.perf_counter() - start
+            print(f"Answered {answered} questions ({answered / elapsed:.2f} q/s)")
+    return answered
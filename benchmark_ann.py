@@ -0,0 +1,95 @@
+import argparse
+import tempfile
+import time
+
+import numpy as np
+from langchain_chroma import Chroma
+
+from ann_index import IVFPQIndex, normalize
+from batch_qa import read_questions
+from rag_common import create_embeddings
+from rest_rag import load_and_process_document, load_and_process_pdf, load_url_content
+
+def recall_at_k(results, truth):
+    return np.mean([len(set(found) & set(expected)) / len(expected) for found, expected in zip(results, truth)])
+
+def timed_search(search_fn, queries):
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(search_fn(query))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return results, np.percentile(latencies, 50), np.percentile(latencies, 95)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark recall, latency and memory of the ANN index against Chroma")
+    parser.add_argument("--file", help="PDF file to index")
+    parser.add_argument("--url", default="https://lilianweng.github.io/posts/2023-06-23-agent/", help="URL to index when no --file is given")
+    parser.add_argument("--questions_file", help="JSONL or CSV questions to use as queries (default: chunk prefixes)")
+    parser.add_argument("--num_queries", type=int, default=200, help="Queries sampled from the chunks when no --questions_file is given")
+    parser.add_argument("--k", type=int, default=4, help="Neighbours retrieved per query")
+    parser.add_argument("--n_lists", type=int, nargs="+", default=[0, 16, 64], help="IVF cell counts to try (0 = exhaustive)")
+    parser.add_argument("--n_probe", type=int, nargs="+", default=[1, 4, 8, 16], help="Cells probed per query")
+    parser.add_argument("--pq_m", type=int, nargs="+", default=[0, 16, 48], help="PQ code bytes per vector (0 = float vectors)")
+    parser.add_argument("--quantization", nargs="+", default=["none", "int8", "binary"], help="First-pass codes to try")
+    parser.add_argument("--rescore_factor", type=int, nargs="+", default=[4], help="Candidates re-scored per result")
+    args = parser.parse_args()
+
+    splits = load_and_process_pdf(args.file) if args.file else load_and_process_document(load_url_content(args.url))
+    texts = [split.page_content for split in splits]
+    embeddings = create_embeddings()
+    vectors = normalize(embeddings.embed_documents(texts))
+    ids = [str(i) for i in range(len(texts))]
+
+    if args.questions_file:
+        query_texts = [record['question'] for record in read_questions(args.questions_file)]
+    else:
+        rng = np.random.default_rng(0)
+        sample = rng.choice(len(texts), min(args.num_queries, len(texts)), replace=False)
+        query_texts = [texts[i][:200] for i in sample]
+    queries = normalize([embeddings.embed_query(text) for text in query_texts])
+    print(f"{len(texts)} chunks, {len(queries)} queries, k={args.k}")
+
+    # Exact cosine top-k is the ground truth for every backend
+    truth = [list(np.argsort(-(vectors @ query))[:args.k].astype(str)) for query in queries]
+
+    # index MB is what stays resident; memory-mapped float vectors are paged in only when re-scored
+    print(f"{'backend':<30} {'recall@k':>9} {'p50 ms':>8} {'p95 ms':>8} {'index MB':>9}")
+    # Chroma defaults to L2; cosine makes it answer the same question as the ground truth
+    chroma = Chroma(collection_name="benchmark_ann", embedding_function=embeddings,
+                    collection_metadata={"hnsw:space": "cosine"})
+    chroma.add_texts(texts, ids=ids)
+    results, p50, p95 = timed_search(
+        lambda query: [doc.id for doc in chroma.similarity_search_by_vector(query.tolist(), k=args.k)], queries)
+    print(f"{'chroma':<30} {recall_at_k(results, truth):>9.3f} {p50:>8.2f} {p95:>8.2f} {'-':>9}")
+    chroma.delete_collection()
+
+    for n_lists in args.n_lists:
+        for pq_m in args.pq_m:
+            for quantization in args.quantization:
+                if pq_m and (vectors.shape[1] % pq_m or quantization != 'none'):
+                    continue
+                for rescore_factor in (args.rescore_factor if quantization != 'none' else [0]):
+                    with tempfile.TemporaryDirectory() as index_dir:
+                        index = IVFPQIndex(vectors.shape[1], n_lists=n_lists, pq_m=pq_m,
+                                           train_size=min(n_lists * 16, len(vectors)),
+                                           quantization=quantization, rescore_factor=rescore_factor)
+                        index.add(ids, vectors)
+                        # Reload memory-mapped, as a persisted index is served
+                        index.save(index_dir)
+                        index = IVFPQIndex.load(index_dir)
+                        for n_probe in (args.n_probe if n_lists else [0]):
+                            if n_probe > n_lists:
+                                continue
+                            results, p50, p95 = timed_search(
+                                lambda query: [id_ for id_, _ in index.search(query, args.k, n_probe=n_probe)], queries)
+                            name = f"ivf{n_lists} probe={n_probe}" if n_lists else "flat"
+                            if pq_m:
+                                name += f" pq={pq_m}"
+                            if quantization != 'none':
+                                name += f" {quantization} x{rescore_factor}"
+                            print(f"{name:<30} {recall_at_k(results, truth):>9.3f} {p50:>8.2f} {p95:>8.2f} "
+                                  f"{index.memory_bytes() / 1024 ** 2:>9.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+import uuid
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ChatApp', 'backend'))
+
+WORDS = (
+    "retrieval augmented generation index vector embedding chunk context prompt token model latency throughput "
+    "batch cache query answer document page section corpus dense sparse ranking fusion scheduler server request "
+    "decoder encoder attention layer memory budget window overlap splitter parser shard worker queue"
+).split()
+RAG_TEMPLATE = """<|system|>
+You are an assistant for question-answering tasks. Use the following pieces of retrieved context to answer the question. If you don't know the answer, just say that you don't know. Use three sentences maximum and keep the answer concise.<|end|>
+<|user|>
+Question: {question}
+Contexts:
+{context}<|end|>
+<|assistant|>"""
+# Metrics where a larger value is an improvement; every other compared metric is a latency
+HIGHER_IS_BETTER = ('per_sec', 'hit_rate')
+
+def percentiles(latencies_ms):
+    latencies_ms = np.asarray(latencies_ms)
+    if not len(latencies_ms):
+        return {'p50_ms': None, 'p95_ms': None, 'p99_ms': None}
+    return {f'p{q}_ms': float(np.percentile(latencies_ms, q)) for q in (50, 95, 99)}
+
+def fact(rng, doc, page):
+    part = f"QX-{doc:02d}{page:03d}"
+    volts = rng.randint(100, 999)
+    return (f"Component {part} is rated for {volts} volts.",
+            f"What voltage is component {part} rated for?", f"{volts} volts")
+
+def synthetic_paragraphs(rng, count, words_per_sentence=14, sentences=5):
+    return [
+        " ".join(" ".join(rng.choice(WORDS) for _ in range(words_per_sentence)).capitalize() + "."
+                 for _ in range(sentences))
+        for _ in range(count)
+    ]
+
+def pdf_escape(text):
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+def write_pdf(path, pages):
+    """Minimal Helvetica text PDF, one list of lines per page, that pypdf can extract."""
+    objects = {
+        1: b"<< /Type /Catalog /Pages 2 0 R >>",
+        3: b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    }
+    kids = []
+    for i, lines in enumerate(pages):
+        page_id, content_id = 4 + 2 * i, 5 + 2 * i
+        text = "BT /F1 10 Tf 12 TL 50 780 Td " + " ".join(f"({pdf_escape(line)}) Tj T*" for line in lines) + " ET"
+        data = text.encode('latin-1')
+        objects[content_id] = b"<< /Length %d >>\nstream\n" % len(data) + data + b"\nendstream"
+        objects[page_id] = (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>"
+        ).encode()
+        kids.append(f"{page_id} 0 R")
+    objects[2] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(pages)} >>".encode()
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = {}
+    for number in sorted(objects):
+        offsets[number] = len(out)
+        out += b"%d 0 obj\n" % number + objects[number] + b"\nendobj\n"
+    xref = len(out)
+    size = max(objects) + 1
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % size
+    for number in range(1, size):
+        out += b"%010d 00000 n \n" % offsets[number]
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (size, xref)
+    with open(path, 'wb') as f:
+        f.write(out)
+
+def write_fixtures(directory, num_pdfs, pages_per_pdf, num_html, seed=0):
+    """Write synthetic PDFs and HTML pages; every page carries one fact the returned questions ask about."""
+    rng = random.Random(seed)
+    pdfs, htmls, questions = [], [], []
+    for doc in range(num_pdfs):
+        pages = []
+        for page in range(pages_per_pdf):
+            sentence, question, answer = fact(rng, doc, page)
+            questions.append((question, answer))
+            paragraphs = synthetic_paragraphs(rng, 6)
+            paragraphs.insert(rng.randrange(len(paragraphs)), sentence)
+            pages.append([line for paragraph in paragraphs for line in textwrap.wrap(paragraph, 90)])
+        path = os.path.join(directory, f"fixture_{doc}.pdf")
+        write_pdf(path, pages)
+        pdfs.append(path)
+    for doc in range(num_pdfs, num_pdfs + num_html):
+        sentence, question, answer = fact(rng, doc, 0)
+        questions.append((question, answer))
+        paragraphs = synthetic_paragraphs(rng, 12)
+        paragraphs.insert(rng.randrange(len(paragraphs)), sentence)
+        body = "".join(f"<p>{paragraph}</p>\n" for paragraph in paragraphs)
+        path = os.path.join(directory, f"fixture_{doc}.html")
+        with open(path, 'w') as f:
+            f.write(f"<html><head><title>Fixture {doc}</title></head><body><h1>Fixture {doc}</h1>\n{body}</body></html>")
+        htmls.append(path)
+    return pdfs, htmls, questions
+
+def load_html(path):
+    from bs4 import BeautifulSoup
+    from langchain_core.documents import Document
+
+    with open(path) as f:
+        text = BeautifulSoup(f.read(), 'html.parser').get_text(separator='\n')
+    return [Document(page_content=text, metadata={'source': path})]
+
+def benchmark_ingestion(pdfs, htmls, embeddings, backend, workers):
+    from langchain_chroma import Chroma
+
+    from ann_vectorstore import ANNVectorStore
+    from parallel_pdf import load_pdf_parallel, page_count
+    from rest_rag import split_documents
+
+    start = time.perf_counter()
+    splits = []
+    for path in pdfs:
+        splits.extend(load_pdf_parallel(path, split_documents, workers=workers))
+    for path in htmls:
+        splits.extend(split_documents(load_html(path)))
+    parsed = time.perf_counter()
+    if backend == 'ann':
+        vectorstore = ANNVectorStore.from_documents(splits, embedding=embeddings)
+    else:
+        vectorstore = Chroma.from_documents(splits, embedding=embeddings, collection_name=f"benchmark_{uuid.uuid4().hex}")
+    finished = time.perf_counter()
+
+    pages = sum(page_count(path) for path in pdfs) + len(htmls)
+    total = finished - start
+    return vectorstore, {
+        'pages': pages,
+        'chunks': len(splits),
+        'parse_split_s': parsed - start,
+        'embed_index_s': finished - parsed,
+        'total_s': total,
+        'pages_per_sec': pages / total,
+        'chunks_per_sec': len(splits) / total,
+    }
+
+def benchmark_queries(vectorstore, questions, ks, num_queries):
+    vectorstore.similarity_search(questions[0][0], k=max(ks))
+    results = {}
+    for k in ks:
+        latencies, hits = [], 0
+        for i in range(num_queries):
+            question, answer = questions[i % len(questions)]
+            start = time.perf_counter()
+            docs = vectorstore.similarity_search(question, k=k)
+            latencies.append((time.perf_counter() - start) * 1000)
+            hits += any(answer in doc.page_content for doc in docs)
+        results[f'k={k}'] = {'queries': num_queries, 'hit_rate': hits / num_queries, **percentiles(latencies)}
+    return results
+
+def serve_in_thread(app):
+    """Serve a Flask app on a free local port from a daemon thread; returns (url, server)."""
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server
+
+def tokens_generated():
+    from prometheus_client import REGISTRY
+
+    return REGISTRY.get_sample_value('rag_tokens_generated_total') or 0.0
+
+def level_summary(level):
+    return {key: level[key] for key in ('concurrency', 'requests', 'ok', 'rejected_429', 'errors', 'requests_per_sec',
+                                        'p50_ms', 'p95_ms', 'p99_ms')}
+
+def benchmark_generate(url, prompts, concurrency_levels, num_requests, max_new_tokens, timeout):
+    from load_test import run_level
+
+    def payload(endpoint, i, max_new_tokens):
+        return '/generate', {"prompt": prompts[i % len(prompts)], "max_new_tokens": max_new_tokens}
+
+    run_level(url, 'generate', 1, 1, max_new_tokens, timeout, payload)
+    levels = []
+    for concurrency in concurrency_levels:
+        before = tokens_generated()
+        level = run_level(url, 'generate', concurrency, num_requests, max_new_tokens, timeout, payload)
+        tokens = tokens_generated() - before
+        levels.append({**level_summary(level), 'tokens': tokens, 'tokens_per_sec': tokens / level['elapsed_s']})
+    return levels
+
+def benchmark_answer(url, requests_data, concurrency_levels, num_requests, timeout):
+    from load_test import run_level
+
+    def payload_for_level(label):
+        def payload(endpoint, i, max_new_tokens):
+            question, contexts = requests_data[i % len(requests_data)]
+            # A distinct question per request keeps the answer cache out of the measurement
+            return '/api/answer', {"question": f"{question} (run {label}-{i})", "contexts": contexts}
+        return payload
+
+    run_level(url, 'answer', 1, 1, None, timeout, payload_for_level('warmup'))
+    levels = []
+    for concurrency in concurrency_levels:
+        level = run_level(url, 'answer', concurrency, num_requests, None, timeout, payload_for_level(concurrency))
+        levels.append(level_summary(level))
+    return levels
+
+def flatten(results):
+    """Comparable metrics as {'section.key.metric': value}."""
+    flat = {}
+    for section in ('ingestion', 'query', 'generate', 'answer'):
+        value = results.get(section)
+        if isinstance(value, list):
+            for level in value:
+                for metric, number in level.items():
+                    flat[f"{section}.c{level['concurrency']}.{metric}"] = number
+        elif isinstance(value, dict):
+            for key, metric_value in value.items():
+                if isinstance(metric_value, dict):
+                    for metric, number in metric_value.items():
+                        flat[f"{section}.{key}.{metric}"] = number
+                else:
+                    flat[f"{section}.{key}"] = metric_value
+    return flat
+
+def is_compared(name):
+    return name.endswith(('_ms', '_s') + HIGHER_IS_BETTER)
+
+def compare(results, baseline, tolerance):
+    """Print current vs baseline for every shared metric and return the names that regressed."""
+    current, previous = flatten(results), flatten(baseline)
+    regressions = []
+    print(f"{'metric':<40} {'baseline':>12} {'current':>12} {'change':>9}")
+    for name in sorted(set(current) & set(previous)):
+        new, old = current[name], previous[name]
+        if not is_compared(name) or new is None or old is None:
+            continue
+        change = (new - old) / old if old else 0.0
+        worse = -change if name.endswith(HIGHER_IS_BETTER) else change
+        flag = ''
+        if worse > tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:<40} {old:>12.3f} {new:>12.3f} {change:>+8.1%}{flag}")
+    return regressions
+
+def run(args):
+    # Module-level settings in the servers are read from the environment at import time
+    os.environ['MAX_NEW_TOKENS'] = str(args.max_new_tokens)
+    os.environ['CONTEXT_WINDOW'] = str(args.context_window)
+    os.environ['CONTEXT_TOKENIZER'] = args.llm
+    os.environ['RERANKER_MODEL'] = ''
+    if not args.download:
+        os.environ['HF_HUB_OFFLINE'] = '1'
+        os.environ['TRANSFORMERS_OFFLINE'] = '1'
+
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    import app_langchain as backend
+    import deploy_phi
+
+    results = {'config': vars(args).copy(), 'started_at': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    with tempfile.TemporaryDirectory() as directory:
+        pdfs, htmls, questions = write_fixtures(directory, args.pdfs, args.pages, args.html)
+        embeddings = HuggingFaceEmbeddings(model_name=args.embedding_model)
+        embeddings.embed_query("warm up")
+
+        print("Ingestion...")
+        vectorstore, results['ingestion'] = benchmark_ingestion(pdfs, htmls, embeddings, args.vector_backend, args.workers)
+        print(json.dumps(results['ingestion'], indent=2))
+
+        print("Query latency...")
+        results['query'] = benchmark_queries(vectorstore, questions, args.k, args.queries)
+        print(json.dumps(results['query'], indent=2))
+
+        answer_requests = []
+        for question, _ in questions:
+            docs = vectorstore.similarity_search(question, k=min(args.k))
+            contexts = [{"content": doc.page_content, "source": doc.metadata.get('source'), "page": doc.metadata.get('page')}
+                        for doc in docs]
+            answer_requests.append((question, contexts))
+    prompts = [RAG_TEMPLATE.format(question=question, context="\n".join(c['content'] for c in contexts))
+               for question, contexts in answer_requests]
+
+    model_url, model_server = serve_in_thread(deploy_phi.app)
+    response = deploy_phi.app.test_client().post('/initialize', json={'model_id': args.llm, 'gpu_id': args.gpu})
+    if response.status_code != 200:
+        raise RuntimeError(f"Failed to initialize {args.llm}: {response.get_json()}")
+    backend.llm = backend.LocalLLM(api_url=model_url)
+    backend_url, backend_server = serve_in_thread(backend.app)
+
+    # The servers print every prompt; keep the report readable
+    with open(os.devnull, 'w') as devnull:
+        print("/generate throughput...")
+        with contextlib.redirect_stdout(devnull):
+            results['generate'] = benchmark_generate(model_url, prompts, args.concurrency, args.requests,
+                                                     args.max_new_tokens, args.timeout)
+        print(json.dumps(results['generate'], indent=2))
+
+        print("/api/answer end to end...")
+        with contextlib.redirect_stdout(devnull):
+            results['answer'] = benchmark_answer(backend_url, answer_requests, args.concurrency, args.requests, args.timeout)
+        print(json.dumps(results['answer'], indent=2))
+
+    backend_server.shutdown()
+    model_server.shutdown()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end RAG benchmark on synthetic fixtures with tiny local models")
+    parser.add_argument("--embedding_model", default="sentence-transformers/paraphrase-MiniLM-L3-v2", help="Embedding model ID")
+    parser.add_argument("--llm", default="sshleifer/tiny-gpt2", help="Causal LM served by deploy_phi.py")
+    parser.add_argument("--gpu", type=int, default=0, help="GPU ID for the model server (CPU when none is available)")
+    parser.add_argument("--vector_backend", choices=["chroma", "ann"], default="chroma", help="Vector store to ingest into")
+    parser.add_argument("--pdfs", type=int, default=4, help="Synthetic PDFs")
+    parser.add_argument("--pages", type=int, default=20, help="Pages per synthetic PDF")
+    parser.add_argument("--html", type=int, default=8, help="Synthetic HTML pages")
+    parser.add_argument("--workers", type=int, default=2, help="Processes used to parse PDF pages")
+    parser.add_argument("--k", type=int, nargs="+", default=[4, 10], help="Retrieval depths to time")
+    parser.add_argument("--queries", type=int, default=100, help="Timed queries per k")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16], help="Concurrent clients per level")
+    parser.add_argument("--requests", type=int, default=32, help="/generate and /api/answer requests per level")
+    parser.add_argument("--max_new_tokens", type=int, default=32, help="Tokens generated per request")
+    parser.add_argument("--context_window", type=int, default=1024, help="Context window of --llm, for prompt packing")
+    parser.add_argument("--timeout", type=float, default=300, help="Per-request timeout in seconds")
+    parser.add_argument("--download", action="store_true", help="Allow downloading models; otherwise only the local cache is used")
+    parser.add_argument("--output", default="benchmark_e2e.json", help="Write the results here as JSON")
+    parser.add_argument("--baseline", help="Compare against a stored results file and exit 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative slowdown before a metric regresses")
+    parser.add_argument("--compare_only", help="Compare this results file with --baseline instead of running")
+    args = parser.parse_args()
+
+    if args.compare_only:
+        with open(args.compare_only) as f:
+            results = json.load(f)
+    else:
+        results = run(args)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} metrics regressed by more than {args.tolerance:.0%}")
+            sys.exit(1)
+        print("No regressions")
+
+if __name__ == "__main__":
+    main()
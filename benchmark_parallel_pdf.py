@@ -0,0 +1,31 @@
+import argparse
+import time
+
+from langchain_community.document_loaders import PyPDFLoader
+
+from parallel_pdf import PDF_WORKERS, load_pdf_parallel
+from rest_rag import split_documents
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sequential vs page-parallel PDF parsing and splitting")
+    parser.add_argument("--file", required=True, help="PDF file to parse")
+    parser.add_argument("--workers", type=int, nargs="+", default=[2, 4, PDF_WORKERS], help="Worker counts to try")
+    parser.add_argument("--pages_per_shard", type=int, default=None, help="Pages per shard (default: automatic)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    sequential = split_documents(PyPDFLoader(args.file).load())
+    baseline = time.perf_counter() - start
+    print(f"{len(sequential)} splits")
+    print(f"{'mode':<12} {'seconds':>10} {'speedup':>9} {'identical':>10}")
+    print(f"{'sequential':<12} {baseline:>10.2f} {1.0:>8.1f}x {'-':>10}")
+
+    for workers in sorted(set(args.workers)):
+        start = time.perf_counter()
+        parallel = load_pdf_parallel(args.file, split_documents, workers=workers, pages_per_shard=args.pages_per_shard)
+        elapsed = time.perf_counter() - start
+        identical = [(d.page_content, d.metadata) for d in parallel] == [(d.page_content, d.metadata) for d in sequential]
+        print(f"{f'workers={workers}':<12} {elapsed:>10.2f} {baseline / elapsed:>8.1f}x {str(identical):>10}")
+
+if __name__ == "__main__":
+    main()
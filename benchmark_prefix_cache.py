@@ -0,0 +1,69 @@
+import argparse
+import sys
+import time
+
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from generation_scheduler import BatchScheduler
+from prefix_cache import PrefixCache
+
+SYSTEM_PROMPT = (
+    "<|system|>\n"
+    "You are an assistant for question-answering tasks. Use the following pieces of retrieved context to answer "
+    "the question. If you don't know the answer, just say that you don't know. Use three sentences maximum and "
+    "keep the answer concise.<|end|>\n"
+)
+
+def time_requests(scheduler, prompts, max_new_tokens):
+    latencies, outputs = [], []
+    for prompt in prompts:
+        start = time.perf_counter()
+        outputs.append(scheduler.generate(prompt, max_new_tokens=max_new_tokens))
+        latencies.append(time.perf_counter() - start)
+    return sum(latencies) / len(latencies), outputs
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure prefill time saved by reusing the cached system-prompt prefix on CPU")
+    # Needs a model on the DynamicCache format; GPT-2 checkpoints still use the legacy one and are never cached
+    parser.add_argument("--model", default="hf-internal-testing/tiny-random-LlamaForCausalLM", help="Model ID")
+    parser.add_argument("--requests", type=int, default=20, help="Sequential requests per mode")
+    parser.add_argument("--prefix_repeats", type=int, default=8, help="Repeat the system block to lengthen the shared prefix")
+    parser.add_argument("--max_new_tokens", type=int, default=1, help="1 isolates prefill cost")
+    args = parser.parse_args()
+
+    model = AutoModelForCausalLM.from_pretrained(args.model)
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    prefix = SYSTEM_PROMPT.replace("<|end|>", "") * (args.prefix_repeats - 1) + SYSTEM_PROMPT
+    prompts = [f"{prefix}<|user|>\nQuestion {i}: what is retrieval augmented generation?<|end|>\n<|assistant|>"
+               for i in range(args.requests)]
+    print(f"shared prefix: {len(tokenizer(prefix)['input_ids'])} tokens")
+
+    baseline_scheduler = BatchScheduler(model, tokenizer, device='cpu', max_batch_size=1)
+    baseline, baseline_outputs = time_requests(baseline_scheduler, prompts, args.max_new_tokens)
+    baseline_scheduler.stop()
+
+    prefix_cache = PrefixCache(model, tokenizer, min_tokens=1)
+    if not prefix_cache.enabled:
+        print(f"FAIL: {args.model} uses the legacy cache format, so prefix reuse is disabled for it")
+        sys.exit(1)
+    cached_scheduler = BatchScheduler(model, tokenizer, device='cpu', max_batch_size=1, prefix_cache=prefix_cache)
+    # The first request prefills and stores the prefix
+    time_requests(cached_scheduler, prompts[:1], args.max_new_tokens)
+    cached, cached_outputs = time_requests(cached_scheduler, prompts, args.max_new_tokens)
+    cached_scheduler.stop()
+
+    print(f"{'mode':<14} {'ms/request':>11}")
+    print(f"{'full prefill':<14} {baseline * 1000:>11.2f}")
+    print(f"{'prefix cache':<14} {cached * 1000:>11.2f}  ({baseline / cached:.1f}x)")
+    print(prefix_cache.stats())
+    if not prefix_cache.hits:
+        print("FAIL: no request resumed from the cached prefix")
+        sys.exit(1)
+    # Resuming from the cached prefix must not change what is generated
+    if cached_outputs != baseline_outputs:
+        print("FAIL: outputs differ with the prefix cache")
+        sys.exit(1)
+    print("OK: outputs identical with and without the prefix cache")
+
+if __name__ == "__main__":
+    main()
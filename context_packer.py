@@ -0,0 +1,100 @@
+import os
+from collections import OrderedDict
+
+CONTEXT_TOKENIZER = os.environ.get('CONTEXT_TOKENIZER', 'microsoft/Phi-3-mini-4k-instruct')
+CONTEXT_WINDOW = int(os.environ.get('CONTEXT_WINDOW', 4096))
+# Same variable as deploy_phi.py, which generates up to this many new tokens unless told otherwise
+MAX_NEW_TOKENS = int(os.environ.get('MAX_NEW_TOKENS', 1024))
+MIN_OVERLAP_CHARS = 20
+
+def overlap_length(a, b, min_overlap=MIN_OVERLAP_CHARS):
+    """Length of the longest suffix of a that is also a prefix of b (0 if shorter than min_overlap)."""
+    if len(a) < min_overlap or len(b) < min_overlap:
+        return 0
+    probe = b[:min_overlap]
+    start = max(0, len(a) - len(b))
+    # Scanning left to right finds the longest overlap first
+    position = a.find(probe, start)
+    while position != -1:
+        if b.startswith(a[position:]):
+            return len(a) - position
+        position = a.find(probe, position + 1)
+    return 0
+
+def merge_group(texts):
+    """Drop duplicate/contained chunks and stitch overlapping ones; returns [(first index, text)]."""
+    pieces = []
+    for i, text in enumerate(texts):
+        if any(text in other for _, other in pieces):
+            continue
+        pieces = [(j, other) for j, other in pieces if other not in text]
+        pieces.append((i, text))
+    merged = True
+    while merged:
+        merged = False
+        for x, (i, a) in enumerate(pieces):
+            for y, (j, b) in enumerate(pieces):
+                if x == y:
+                    continue
+                overlap = overlap_length(a, b)
+                if overlap:
+                    # a runs into b, so b continues a in reading order
+                    pieces[x] = (min(i, j), a + b[overlap:])
+                    del pieces[y]
+                    merged = True
+                    break
+            if merged:
+                break
+    return pieces
+
+class ContextPacker:
+    """Fits retrieved chunks into the prompt's token budget.
+
+    Chunks from the same source page that overlap (the splitters' chunk_overlap)
+    are stitched back together without the repeated text, duplicates are
+    dropped, and the result is filled in relevance order up to
+    context_window - max_new_tokens - the prompt's own tokens.
+    """
+
+    def __init__(self, count_tokens, context_window=CONTEXT_WINDOW, max_new_tokens=MAX_NEW_TOKENS):
+        self.count_tokens = count_tokens
+        self.context_window = context_window
+        self.max_new_tokens = max_new_tokens
+
+    def budget(self, prompt_without_context=""):
+        prompt_tokens = self.count_tokens([prompt_without_context])[0] if prompt_without_context else 0
+        return max(0, self.context_window - self.max_new_tokens - prompt_tokens)
+
+    def pack(self, chunks, prompt_without_context=""):
+        """chunks are {'text', 'source', 'page'} dicts, best first. Returns (texts, stats)."""
+        groups = OrderedDict()
+        for rank, chunk in enumerate(chunks):
+            groups.setdefault((chunk.get('source'), chunk.get('page')), []).append((rank, chunk['text']))
+        pieces = []
+        for members in groups.values():
+            ranks = [rank for rank, _ in members]
+            for i, text in merge_group([text for _, text in members]):
+                pieces.append((ranks[i], text))
+        pieces.sort()
+
+        budget = self.budget(prompt_without_context)
+        counts = self.count_tokens([text for _, text in pieces]) if pieces else []
+        packed, used = [], 0
+        for (_, text), count in zip(pieces, counts):
+            if used + count <= budget:
+                packed.append(text)
+                used += count
+            elif not packed and budget:
+                # Even the best chunk is too long: keep its roughly proportional head
+                packed.append(text[:len(text) * budget // count])
+                used = budget
+        tokens_in = sum(self.count_tokens([chunk['text'] for chunk in chunks])) if chunks else 0
+        stats = {
+            'chunks_in': len(chunks),
+            'chunks_out': len(packed),
+            'tokens_in': tokens_in,
+            'tokens_out': used,
+            'tokens_saved': tokens_in - used,
+            'budget': budget,
+        }
+        return packed, stats
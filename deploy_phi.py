@@ -1,84 +1,230 @@
 import os
+import json
+import threading
 import torch
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
 
+from generation_scheduler import BatchScheduler, SchedulerBusy
+from model_pool import ModelPool
+from prefix_cache import PREFIX_CACHE_MB, PrefixCache
+from serving import run_app
+from metrics import register_metrics
+
 app = Flask(__name__)
+register_metrics(app)
+
+DEFAULT_MODEL_ID = 'microsoft/Phi-3-mini-4k-instruct'
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 8))
+MAX_WAIT_MS = float(os.environ.get('MAX_WAIT_MS', 20))
+MAX_RESIDENT_MODELS = int(os.environ.get('MAX_RESIDENT_MODELS', 2))
+MODEL_MEMORY_BUDGET_GB = os.environ.get('MODEL_MEMORY_BUDGET_GB')
+# Beyond these, /generate answers 429 instead of queueing without bound
+MAX_QUEUE_SIZE = int(os.environ.get('MAX_QUEUE_SIZE', 64))
+MAX_ACTIVE_STREAMS = int(os.environ.get('MAX_ACTIVE_STREAMS', 16))
+RETRY_AFTER_SECONDS = 1
+# Default for requests that do not set max_new_tokens; context_packer.py reads the same variable
+MAX_NEW_TOKENS = int(os.environ.get('MAX_NEW_TOKENS', 1024))
 
-model = None
-tokenizer = None
-pipe = None
 current_model_id = None
 current_gpu_id = None
 
-def load_model(model_id, gpu_id):
-    global model, tokenizer, pipe, current_model_id, current_gpu_id
-    
-    # Check if the model is already loaded with the same configuration
-    if model_id == current_model_id and gpu_id == current_gpu_id:
-        return jsonify({'message': 'Model already initialized with the same configuration'})
-    
-    device = f'cuda:{gpu_id}' if torch.cuda.is_available() else 'cpu'
-    
-    # Clear CUDA cache if switching GPUs or models
-    if torch.cuda.is_available():
-        torch.cuda.empty_cache()
-    
-    model = AutoModelForCausalLM.from_pretrained(
-        model_id,
-        torch_dtype="auto",
-        trust_remote_code=True,
-    )
-    tokenizer = AutoTokenizer.from_pretrained(model_id)
-    pipe = pipeline("text-generation",
-                    model=model,
-                    tokenizer=tokenizer,
-                    device=device,
-                    max_new_tokens=1024)
-    
-    current_model_id = model_id
-    current_gpu_id = gpu_id
+class LoadedModel:
+    def __init__(self, model_id, gpu_id, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+        self.model_id = model_id
+        self.gpu_id = gpu_id
+        self._in_flight = 0
+        self._closed = False
+        self._idle = threading.Condition()
+        device = f'cuda:{gpu_id}' if torch.cuda.is_available() else 'cpu'
+
+        model = AutoModelForCausalLM.from_pretrained(
+            model_id,
+            torch_dtype="auto",
+            trust_remote_code=True,
+        )
+        tokenizer = AutoTokenizer.from_pretrained(model_id)
+        self.pipe = pipeline("text-generation",
+                             model=model,
+                             tokenizer=tokenizer,
+                             device=device,
+                             max_new_tokens=MAX_NEW_TOKENS)
+        # PREFIX_CACHE_MB=0 turns prefix reuse off
+        prefix_cache = PrefixCache(self.pipe.model, self.pipe.tokenizer) if PREFIX_CACHE_MB > 0 else None
+        self.scheduler = BatchScheduler(self.pipe.model, self.pipe.tokenizer, device=self.pipe.device,
+                                        max_batch_size=max_batch_size, max_wait_ms=max_wait_ms,
+                                        prefix_cache=prefix_cache, max_queue_size=MAX_QUEUE_SIZE,
+                                        max_streams=MAX_ACTIVE_STREAMS)
+        self.size_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+
+    def acquire(self):
+        """Register an in-flight request; False once the model is being unloaded."""
+        with self._idle:
+            if self._closed:
+                return False
+            self._in_flight += 1
+            return True
+
+    def release(self):
+        with self._idle:
+            self._in_flight -= 1
+            self._idle.notify_all()
+
+    def unload(self):
+        # New requests go to the pool again; the ones holding this model finish first
+        with self._idle:
+            self._closed = True
+            self._idle.wait_for(lambda: self._in_flight == 0)
+        self.scheduler.stop()
+        if self.scheduler.prefix_cache is not None:
+            self.scheduler.prefix_cache.clear()
+        self.pipe = None
+        self.scheduler = None
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        print(f"Unloaded {self.model_id}")
+
+def load_model(model_id, gpu_id, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+    return LoadedModel(model_id, gpu_id if gpu_id is not None else 0, max_batch_size, max_wait_ms)
+
+model_pool = ModelPool(
+    load_model,
+    max_models=MAX_RESIDENT_MODELS,
+    memory_budget_bytes=int(float(MODEL_MEMORY_BUDGET_GB) * 1024 ** 3) if MODEL_MEMORY_BUDGET_GB else None,
+)
 
 @app.route('/initialize', methods=['POST'])
 def initialize():
-    global model, current_model_id, current_gpu_id
+    global current_model_id, current_gpu_id
     data = request.json
-    model_id = data.get('model_id', 'microsoft/Phi-3-mini-4k-instruct')
+    model_id = data.get('model_id', DEFAULT_MODEL_ID)
     gpu_id = data.get('gpu_id', 0)
+    max_batch_size = data.get('max_batch_size', MAX_BATCH_SIZE)
+    max_wait_ms = data.get('max_wait_ms', MAX_WAIT_MS)
 
     # Check if the requested model is already loaded
-    if model is not None and model_id == current_model_id and gpu_id == current_gpu_id:
+    if model_id == current_model_id and gpu_id == current_gpu_id and model_id in model_pool:
         return jsonify({'message': 'Model already initialized with the same configuration'})
 
-    os.environ['CUDA_VISIBLE_DEVICES'] = str(gpu_id)
-    
     try:
-        load_model(model_id, gpu_id)
+        model_pool.get(model_id, gpu_id, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+        current_model_id = model_id
+        current_gpu_id = gpu_id
         return jsonify({'message': 'Model initialized successfully'})
     except Exception as e:
         return jsonify({'error': f'Failed to initialize model: {str(e)}'}), 500
 
+@app.route('/preload', methods=['POST'])
+def preload():
+    data = request.json or {}
+    model_id = data.get('model_id')
+    if not model_id:
+        return jsonify({'error': 'No model_id provided'}), 400
+    started = model_pool.preload(model_id, data.get('gpu_id', current_gpu_id),
+                                 max_batch_size=data.get('max_batch_size', MAX_BATCH_SIZE),
+                                 max_wait_ms=data.get('max_wait_ms', MAX_WAIT_MS))
+    message = 'Preload started' if started else 'Model already resident or loading'
+    return jsonify({'message': message}), 202
+
+@app.route('/models', methods=['GET'])
+def models():
+    return jsonify({'default_model_id': current_model_id, **model_pool.status()})
+
+class ModelNotLoaded(LookupError):
+    pass
+
+def resolve_model(model_id):
+    # Only the /initialize'd default is reloaded on demand (e.g. after eviction); any other
+    # model must have been loaded or preloaded explicitly, so clients cannot pull arbitrary repos
+    model_id = model_id or current_model_id
+    if model_id is None:
+        return None
+    if model_id != current_model_id and not model_pool.is_available(model_id):
+        raise ModelNotLoaded(model_id)
+    return model_pool.get(model_id, None if model_id in model_pool else current_gpu_id)
+
+def acquire_model(model_id, attempts=3):
+    """Resolve and lease a model. One evicted between lookup and lease is looked up (reloaded) again."""
+    for _ in range(attempts):
+        loaded = resolve_model(model_id)
+        if loaded is None or loaded.acquire():
+            return loaded
+    raise RuntimeError('Model was unloaded while acquiring it')
+
+def busy_response():
+    response = jsonify({'error': 'Server busy, retry later'})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(RETRY_AFTER_SECONDS)
+    return response
+
+@app.route('/health', methods=['GET'])
+def health():
+    # Never touches a model or the generation queues, so it answers during loads and long generations
+    return jsonify({'status': 'ok', 'default_model_id': current_model_id})
+
 @app.route('/generate', methods=['POST'])
 def generate():
-    global pipe
-    if pipe is None:
-        return jsonify({'error': 'Model not initialized. Call /initialize first.'}), 400
-    
     data = request.json
     prompt = data.get('prompt')
     if not prompt:
         return jsonify({'error': 'No prompt provided'}), 400
+
+    # The lease keeps this model (and its scheduler) resident until the response is done,
+    # even if /initialize or a load for another model evicts it meanwhile
+    try:
+        loaded = acquire_model(data.get('model_id'))
+    except ModelNotLoaded as e:
+        return jsonify({'error': f'Model {e} is not loaded. Call /initialize or /preload first.'}), 404
+    except Exception as e:
+        return jsonify({'error': f'Failed to load model: {str(e)}'}), 500
+    if loaded is None:
+        return jsonify({'error': 'Model not initialized. Call /initialize first.'}), 400
     
-    max_new_tokens = data.get('max_new_tokens', 1024)
+    max_new_tokens = data.get('max_new_tokens', MAX_NEW_TOKENS)
+
+    if data.get('stream'):
+        try:
+            tokens = loaded.scheduler.stream(prompt, max_new_tokens=max_new_tokens)
+        except SchedulerBusy:
+            loaded.release()
+            return busy_response()
+
+        def stream_tokens():
+            try:
+                for token in tokens:
+                    yield json.dumps({'token': token}) + '\n'
+                yield json.dumps({'done': True}) + '\n'
+            except Exception as e:
+                yield json.dumps({'error': f'Generation failed: {str(e)}'}) + '\n'
+
+        response = Response(stream_with_context(stream_tokens()), mimetype='application/json')
+        # Runs even if the client disconnects before the body is read
+        response.call_on_close(tokens.close)
+        response.call_on_close(loaded.release)
+        return response
     
     try:
-        result = pipe(prompt, max_new_tokens=max_new_tokens)
-        generated_text = result[0]['generated_text']
-        # Parsing the response to extract only the assistant's part
-        assistant_response = generated_text.split("<|assistant|>")[-1].strip()
+        # The scheduler only decodes the new tokens, so this is already the assistant's part
+        assistant_response = loaded.scheduler.generate(prompt, max_new_tokens=max_new_tokens)
         return jsonify({'generated_text': assistant_response})
+    except SchedulerBusy:
+        return busy_response()
     except Exception as e:
         return jsonify({'error': f'Generation failed: {str(e)}'}), 500
+    finally:
+        loaded.release()
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    model_id = request.args.get('model_id', current_model_id)
+    if model_id is None:
+        return jsonify({'error': 'Model not initialized. Call /initialize first.'}), 400
+    # A read-only endpoint must never load a model, even one evicted a moment ago
+    loaded = model_pool.peek(model_id)
+    if loaded is None:
+        return jsonify({'error': f'Model {model_id} is not loaded'}), 404
+    return jsonify(loaded.scheduler.stats())
 
 if __name__ == "__main__":
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    # threaded so concurrent /generate calls can queue up and be batched together
+    run_app(app, 5000, threaded=True)
@@ -0,0 +1,92 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+EMBEDDING_CACHE_PATH = os.environ.get(
+    'EMBEDDING_CACHE_PATH', os.path.join(os.path.expanduser('~'), '.cache', 'ragchat', 'embeddings.sqlite')
+)
+
+def hash_text(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class EmbeddingCache:
+    """SQLite store of float32 embeddings keyed by (model name, text hash)."""
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT, hash TEXT, vector BLOB, PRIMARY KEY (model, hash))"
+        )
+        self._db.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, model_name, texts):
+        hashes = [hash_text(text) for text in texts]
+        found = {}
+        unique = list(set(hashes))
+        with self._lock:
+            # Stay well under SQLite's bound-parameter limit
+            for start in range(0, len(unique), 500):
+                chunk = unique[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._db.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({placeholders})",
+                    [model_name, *chunk],
+                )
+                for text_hash, vector in rows:
+                    found[text_hash] = np.frombuffer(vector, dtype=np.float32)
+            vectors = [found.get(text_hash) for text_hash in hashes]
+            hits = sum(vector is not None for vector in vectors)
+            self.hits += hits
+            self.misses += len(vectors) - hits
+        return vectors
+
+    def put_many(self, model_name, texts, vectors):
+        rows = [
+            (model_name, hash_text(text), np.asarray(vector, dtype=np.float32).tobytes())
+            for text, vector in zip(texts, vectors)
+        ]
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows)
+            self._db.commit()
+
+    def embed_with_cache(self, model_name, texts, embed_fn):
+        """Return embeddings for texts, calling embed_fn only on the ones not cached yet."""
+        vectors = self.get_many(model_name, texts)
+        missing = {}
+        for i, (text, vector) in enumerate(zip(texts, vectors)):
+            if vector is None:
+                missing.setdefault(text, []).append(i)
+        if missing:
+            missing_texts = list(missing)
+            new_vectors = embed_fn(missing_texts)
+            self.put_many(model_name, missing_texts, new_vectors)
+            for text, vector in zip(missing_texts, new_vectors):
+                for i in missing[text]:
+                    vectors[i] = vector
+        return [np.asarray(vector, dtype=np.float32).tolist() for vector in vectors]
+
+class CachedEmbeddings(Embeddings):
+    """LangChain embeddings wrapper that only runs the model on chunks it has not seen before."""
+
+    def __init__(self, embeddings, model_name, cache=None):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.cache = cache if cache is not None else EmbeddingCache()
+
+    def embed_documents(self, texts):
+        return self.cache.embed_with_cache(self.model_name, texts, self.embeddings.embed_documents)
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
@@ -0,0 +1,306 @@
+import argparse
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+
+from metrics import TOKENS_GENERATED, observe
+
+class SchedulerBusy(RuntimeError):
+    """The request queue or the stream slots are full; callers should back off and retry."""
+
+class StepTimer(StoppingCriteria):
+    """Never stops generation; notes when the first new token exists (end of prefill) and counts steps."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_token_at = None
+        self.steps = 0
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.steps += 1
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+    def record(self, tokens_generated):
+        finished = time.perf_counter()
+        first_token_at = self.first_token_at or finished
+        observe('prefill', first_token_at - self.started)
+        observe('decode', finished - first_token_at)
+        TOKENS_GENERATED.inc(tokens_generated)
+
+class CancelCriteria(StoppingCriteria):
+    """Stops every sequence at the next step once the event is set."""
+
+    def __init__(self, cancelled):
+        self.cancelled = cancelled
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.cancelled.is_set(), dtype=torch.bool, device=input_ids.device)
+
+class GenerationRequest:
+    def __init__(self, prompt, max_new_tokens):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+class BatchScheduler:
+    """Groups concurrent generate calls into padded batches run through one model.generate call.
+
+    With a prefix_cache, streams and single-request batches resume from the
+    cached state of their shared prompt prefix. Left padding shifts the prefix
+    differently in every row, so multi-request batches are prefilled in full.
+    """
+
+    def __init__(self, model, tokenizer, device=None, max_batch_size=8, max_wait_ms=20, prefix_cache=None,
+                 max_queue_size=None, max_streams=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.prefix_cache = prefix_cache
+        self.max_queue_size = max_queue_size
+        self.max_streams = max_streams
+        self._stream_slots = threading.BoundedSemaphore(max_streams) if max_streams else None
+        self.device = device if device is not None else model.device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+
+        # Decoder-only models must be left padded so every row continues from its own last token.
+        self.tokenizer.padding_side = 'left'
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self._requests_served = 0
+        self._queue_wait_total = 0.0
+        self._rejected = 0
+        self._active_streams = 0
+        self._running = True
+        self._worker = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+        self._worker.start()
+
+    def submit(self, prompt, max_new_tokens=1024):
+        if not self._running:
+            raise RuntimeError("Scheduler is stopped")
+        if self.max_queue_size and self._queue.qsize() >= self.max_queue_size:
+            self._reject()
+        request = GenerationRequest(prompt, max_new_tokens)
+        self._queue.put(request)
+        return request.future
+
+    def generate(self, prompt, max_new_tokens=1024, timeout=None):
+        return self.submit(prompt, max_new_tokens).result(timeout=timeout)
+
+    def stream(self, prompt, max_new_tokens=1024):
+        """Token iterator for prompt. Raises SchedulerBusy straight away if every stream slot is taken."""
+        if self._stream_slots is not None and not self._stream_slots.acquire(blocking=False):
+            self._reject()
+        with self._stats_lock:
+            self._active_streams += 1
+        return TokenStream(self._stream_tokens(prompt, max_new_tokens), self._release_stream)
+
+    def _reject(self):
+        with self._stats_lock:
+            self._rejected += 1
+        raise SchedulerBusy("Generation queue is full")
+
+    def _release_stream(self):
+        with self._stats_lock:
+            self._active_streams -= 1
+        if self._stream_slots is not None:
+            self._stream_slots.release()
+
+    def _stream_tokens(self, prompt, max_new_tokens):
+        # Streaming requests bypass batching: tokens are pushed to the caller
+        # as soon as they are decoded, so time-to-first-token is one prefill.
+        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        cancelled = threading.Event()
+        errors = []
+
+        def run():
+            try:
+                timer = StepTimer()
+                with torch.no_grad():
+                    self.model.generate(
+                        **inputs,
+                        **self._cached_prefix([prompt], inputs),
+                        max_new_tokens=max_new_tokens,
+                        pad_token_id=self.tokenizer.pad_token_id,
+                        streamer=streamer,
+                        stopping_criteria=StoppingCriteriaList([timer, CancelCriteria(cancelled)]),
+                    )
+                timer.record(timer.steps)
+            except Exception as e:
+                errors.append(e)
+                streamer.end()
+
+        thread = threading.Thread(target=run, name="stream-generate", daemon=True)
+        thread.start()
+        try:
+            for text in streamer:
+                if text:
+                    yield text
+        finally:
+            # Closing the stream (e.g. the client went away) stops decoding at the next step,
+            # so a freed stream slot also means the model is no longer working on it
+            cancelled.set()
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def _cached_prefix(self, prompts, inputs):
+        if self.prefix_cache is None or len(prompts) != 1:
+            return {}
+        past_key_values = self.prefix_cache.lookup(prompts[0], inputs['input_ids'])
+        return {} if past_key_values is None else {'past_key_values': past_key_values}
+
+    def stop(self):
+        self._running = False
+        self._queue.put(None)
+        self._worker.join()
+
+    def stats(self):
+        with self._stats_lock:
+            batches = sum(self._batch_sizes.values())
+            return {
+                'queue_depth': self._queue.qsize(),
+                'max_queue_size': self.max_queue_size,
+                'active_streams': self._active_streams,
+                'rejected': self._rejected,
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000.0,
+                'batches': batches,
+                'requests': self._requests_served,
+                'avg_batch_size': self._requests_served / batches if batches else 0.0,
+                'avg_queue_wait_ms': 1000.0 * self._queue_wait_total / self._requests_served if self._requests_served else 0.0,
+                'batch_size_histogram': {str(size): count for size, count in sorted(self._batch_sizes.items())},
+                'prefix_cache': self.prefix_cache.stats() if self.prefix_cache is not None else None,
+            }
+
+    def _collect_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return []
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                self._running = False
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while self._running or not self._queue.empty():
+            batch = self._collect_batch()
+            if not batch:
+                continue
+            try:
+                texts = self._generate_batch(batch)
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            for request, text in zip(batch, texts):
+                request.future.set_result(text)
+
+    def _generate_batch(self, batch):
+        started = time.perf_counter()
+        inputs = self.tokenizer(
+            [request.prompt for request in batch],
+            return_tensors="pt",
+            padding=True,
+        ).to(self.device)
+        max_new_tokens = max(request.max_new_tokens for request in batch)
+        for request in batch:
+            observe('queue_wait', started - request.enqueued_at)
+        timer = StepTimer()
+        with torch.no_grad():
+            output_ids = self.model.generate(
+                **inputs,
+                **self._cached_prefix([request.prompt for request in batch], inputs),
+                max_new_tokens=max_new_tokens,
+                pad_token_id=self.tokenizer.pad_token_id,
+                stopping_criteria=StoppingCriteriaList([timer]),
+            )
+
+        prompt_length = inputs['input_ids'].shape[1]
+        texts = []
+        tokens_generated = 0
+        for request, ids in zip(batch, output_ids):
+            new_ids = ids[prompt_length:prompt_length + request.max_new_tokens]
+            tokens_generated += int((new_ids != self.tokenizer.pad_token_id).sum())
+            texts.append(self.tokenizer.decode(new_ids, skip_special_tokens=True).strip())
+        timer.record(tokens_generated)
+
+        with self._stats_lock:
+            self._batch_sizes[len(batch)] += 1
+            self._requests_served += len(batch)
+            self._queue_wait_total += sum(started - request.enqueued_at for request in batch)
+        return texts
+
+class TokenStream:
+    """Iterator over a stream's tokens that frees its stream slot exactly once, even if never iterated."""
+
+    def __init__(self, tokens, release):
+        self._tokens = tokens
+        self._release = release
+        self._lock = threading.Lock()
+        self._open = True
+
+    def __iter__(self):
+        try:
+            yield from self._tokens
+        finally:
+            self.close()
+
+    def close(self):
+        with self._lock:
+            was_open, self._open = self._open, False
+        if was_open:
+            self._tokens.close()
+            self._release()
+
+def main():
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    parser = argparse.ArgumentParser(description="Exercise the batch scheduler with concurrent prompts on CPU")
+    parser.add_argument("--model", default="sshleifer/tiny-gpt2", help="Model ID")
+    parser.add_argument("--requests", type=int, default=32, help="Number of concurrent requests")
+    parser.add_argument("--max_batch_size", type=int, default=8, help="Largest batch per forward pass")
+    parser.add_argument("--max_wait_ms", type=float, default=20, help="How long to wait for a batch to fill")
+    parser.add_argument("--max_new_tokens", type=int, default=16, help="Tokens to generate per request")
+    args = parser.parse_args()
+
+    model = AutoModelForCausalLM.from_pretrained(args.model)
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    scheduler = BatchScheduler(model, tokenizer, device='cpu',
+                               max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+
+    start = time.perf_counter()
+    futures = [scheduler.submit(f"Question {i}: what is retrieval augmented generation?", args.max_new_tokens)
+               for i in range(args.requests)]
+    results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+    scheduler.stop()
+
+    print(f"{len(results)} requests in {elapsed:.2f}s ({len(results) / elapsed:.1f} req/s)")
+    print(scheduler.stats())
+
+if __name__ == "__main__":
+    main()
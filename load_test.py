@@ -0,0 +1,73 @@
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+def payload_for(endpoint, i, max_new_tokens):
+    question = f"Question {i}: what is retrieval augmented generation?"
+    if endpoint == 'generate':
+        return '/generate', {"prompt": question, "max_new_tokens": max_new_tokens}
+    return '/api/answer', {"question": question, "contexts": [{"content": "Retrieval augmented generation adds retrieved text to the prompt."}]}
+
+def run_level(url, endpoint, concurrency, num_requests, max_new_tokens, timeout, payload_fn=payload_for):
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+
+    def one(i):
+        path, payload = payload_fn(endpoint, i, max_new_tokens)
+        start = time.perf_counter()
+        try:
+            status = session.post(f"{url}{path}", json=payload, timeout=timeout).status_code
+        except requests.RequestException:
+            status = None
+        return status, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one, range(num_requests)))
+    elapsed = time.perf_counter() - start
+    latencies = np.array([latency for status, latency in results if status == 200]) * 1000
+    return {
+        'concurrency': concurrency,
+        'requests': num_requests,
+        'ok': len(latencies),
+        'rejected_429': sum(status == 429 for status, _ in results),
+        'errors': sum(status not in (200, 429) for status, _ in results),
+        'requests_per_sec': len(latencies) / elapsed,
+        'elapsed_s': elapsed,
+        'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+        'p95_ms': float(np.percentile(latencies, 95)) if len(latencies) else None,
+        'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Closed-loop load test of the model server or a ChatApp backend")
+    parser.add_argument("--url", default="http://localhost:5000", help="Server to load")
+    parser.add_argument("--endpoint", choices=["generate", "answer"], default="generate", help="/generate or /api/answer")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64], help="Concurrent clients per level")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per level")
+    parser.add_argument("--max_new_tokens", type=int, default=32, help="Tokens per /generate request")
+    parser.add_argument("--timeout", type=float, default=300, help="Per-request timeout in seconds")
+    parser.add_argument("--label", default="", help="Name for this run, e.g. development or production")
+    parser.add_argument("--output", help="Append the results as one JSON line to this file")
+    args = parser.parse_args()
+
+    print(f"{'concurrency':>11} {'req/s':>8} {'p50 ms':>9} {'p99 ms':>9} {'429':>5} {'errors':>7}")
+    levels = []
+    for concurrency in args.concurrency:
+        level = run_level(args.url, args.endpoint, concurrency, args.requests, args.max_new_tokens, args.timeout)
+        levels.append(level)
+        p50 = f"{level['p50_ms']:.1f}" if level['p50_ms'] is not None else '-'
+        p99 = f"{level['p99_ms']:.1f}" if level['p99_ms'] is not None else '-'
+        print(f"{concurrency:>11} {level['requests_per_sec']:>8.2f} {p50:>9} {p99:>9} "
+              f"{level['rejected_429']:>5} {level['errors']:>7}")
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps({'label': args.label, 'url': args.url, 'endpoint': args.endpoint, 'levels': levels}) + '\n')
+
+if __name__ == "__main__":
+    main()
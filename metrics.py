@@ -0,0 +1,51 @@
+import contextvars
+import time
+import uuid
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+# Set per HTTP request; model_client forwards it to deploy_phi.py so one id follows an answer end to end
+request_id_var = contextvars.ContextVar('request_id', default=None)
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+STAGE_SECONDS = Histogram('rag_stage_seconds', 'Time spent in each RAG pipeline stage', ['stage'], buckets=BUCKETS)
+REQUEST_SECONDS = Histogram('rag_request_seconds', 'HTTP request time until the response is fully sent',
+                            ['endpoint', 'status'], buckets=BUCKETS)
+TOKENS_GENERATED = Counter('rag_tokens_generated_total', 'Tokens generated by the model server')
+
+def observe(stage, seconds):
+    STAGE_SECONDS.labels(stage).observe(seconds)
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+def register_metrics(app):
+    """Add request ids, per-endpoint latency and a Prometheus /metrics route to a Flask app."""
+    from flask import Response, g, request
+
+    @app.before_request
+    def start_request():
+        g.request_started = time.perf_counter()
+        g.request_id = request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+        request_id_var.set(g.request_id)
+
+    @app.after_request
+    def finish_request(response):
+        response.headers[REQUEST_ID_HEADER] = g.request_id
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        status = str(response.status_code)
+        started = g.request_started
+        # Streamed bodies are still being sent at this point, so observe once the response closes
+        response.call_on_close(lambda: REQUEST_SECONDS.labels(endpoint, status).observe(time.perf_counter() - started))
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
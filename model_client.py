@@ -0,0 +1,181 @@
+import asyncio
+import json
+import os
+import threading
+import weakref
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import REQUEST_ID_HEADER, request_id_var
+
+MODEL_API_URL = os.environ.get('MODEL_API_URL', 'http://localhost:5000')
+CONNECT_TIMEOUT = float(os.environ.get('MODEL_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.environ.get('MODEL_READ_TIMEOUT', 300))
+MAX_RETRIES = int(os.environ.get('MODEL_MAX_RETRIES', 3))
+BACKOFF_FACTOR = float(os.environ.get('MODEL_BACKOFF_FACTOR', 0.5))
+POOL_SIZE = int(os.environ.get('MODEL_POOL_SIZE', 16))
+
+# Only statuses that mean the prompt was never run: a 500 is a failed generation and a 504 can
+# come from a gateway while the server is still generating
+RETRY_STATUSES = (429, 502, 503)
+
+class ModelServerError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        # HTTP status from the model server, e.g. 429 once its queue is full and retries ran out
+        self.status_code = status_code
+
+def _request_headers():
+    request_id = request_id_var.get()
+    return {REQUEST_ID_HEADER: request_id} if request_id else {}
+
+def _parse_stream_line(line):
+    data = json.loads(line)
+    if 'error' in data:
+        raise ModelServerError(f"API request failed: {data['error']}")
+    return data
+
+class ModelClient:
+    """Keep-alive HTTP client for the deploy_phi.py model server with timeouts and retries."""
+
+    def __init__(self, api_url=MODEL_API_URL, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 max_retries=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR, pool_size=POOL_SIZE):
+        self.api_url = api_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        # Read errors are not retried: the server may still be generating and a
+        # retry would run the same prompt twice.
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=0,
+            status=max_retries,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=None,
+            backoff_factor=backoff_factor,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def post(self, path, payload, **kwargs):
+        try:
+            return self.session.post(f"{self.api_url}{path}", json=payload, timeout=self.timeout,
+                                     headers=_request_headers(), **kwargs)
+        except requests.RequestException as e:
+            raise ModelServerError(f"API request failed: {e}") from e
+
+    def generate(self, prompt, **params):
+        response = self.post('/generate', {"prompt": prompt, **params})
+        if response.status_code != 200:
+            raise ModelServerError(f"API request failed: {response.text}", response.status_code)
+        return response.json()['generated_text']
+
+    def default_model_id(self):
+        """The model /generate serves when no model_id is given (set by /initialize)."""
+        try:
+            response = self.session.get(f"{self.api_url}/models", timeout=self.timeout, headers=_request_headers())
+        except requests.RequestException as e:
+            raise ModelServerError(f"API request failed: {e}") from e
+        if response.status_code != 200:
+            raise ModelServerError(f"API request failed: {response.text}", response.status_code)
+        return response.json()['default_model_id']
+
+    def stream(self, prompt, **params):
+        with self.post('/generate', {"prompt": prompt, "stream": True, **params}, stream=True) as response:
+            if response.status_code != 200:
+                raise ModelServerError(f"API request failed: {response.text}", response.status_code)
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                data = _parse_stream_line(line)
+                if data.get('done'):
+                    break
+                yield data['token']
+
+    def close(self):
+        self.session.close()
+
+class AsyncModelClient:
+    """asyncio counterpart of ModelClient built on httpx."""
+
+    def __init__(self, api_url=MODEL_API_URL, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 max_retries=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR, pool_size=POOL_SIZE):
+        self.api_url = api_url.rstrip('/')
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+
+    async def post(self, path, payload):
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            try:
+                response = await self.client.post(f"{self.api_url}{path}", json=payload, headers=_request_headers())
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                if last_attempt:
+                    raise ModelServerError(f"API request failed: {e}") from e
+            except httpx.HTTPError as e:
+                raise ModelServerError(f"API request failed: {e}") from e
+            else:
+                if response.status_code not in RETRY_STATUSES or last_attempt:
+                    return response
+            await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+
+    async def generate(self, prompt, **params):
+        response = await self.post('/generate', {"prompt": prompt, **params})
+        if response.status_code != 200:
+            raise ModelServerError(f"API request failed: {response.text}", response.status_code)
+        return response.json()['generated_text']
+
+    async def stream(self, prompt, **params):
+        payload = {"prompt": prompt, "stream": True, **params}
+        try:
+            async with self.client.stream('POST', f"{self.api_url}/generate", json=payload,
+                                          headers=_request_headers()) as response:
+                if response.status_code != 200:
+                    body = await response.aread()
+                    raise ModelServerError(f"API request failed: {body.decode()}", response.status_code)
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    data = _parse_stream_line(line)
+                    if data.get('done'):
+                        break
+                    yield data['token']
+        except httpx.HTTPError as e:
+            raise ModelServerError(f"API request failed: {e}") from e
+
+    async def aclose(self):
+        await self.client.aclose()
+
+_clients = {}
+# Keyed by the loop itself, so a client goes away with its loop and is never handed to a new one
+_async_clients = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+def get_client(api_url=MODEL_API_URL):
+    """Process-wide ModelClient per API URL so every caller shares one connection pool."""
+    with _clients_lock:
+        client = _clients.get(api_url)
+        if client is None:
+            client = _clients[api_url] = ModelClient(api_url)
+        return client
+
+def get_async_client(api_url=MODEL_API_URL):
+    # httpx clients are bound to the event loop they were first used on, so
+    # async clients are cached per loop.
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        clients = _async_clients.setdefault(loop, {})
+        client = clients.get(api_url)
+        if client is None:
+            client = clients[api_url] = AsyncModelClient(api_url)
+        return client
@@ -0,0 +1,130 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+class ModelPool:
+    """Keeps up to max_models loaded models resident and evicts the least recently used.
+
+    load_fn(model_id, gpu_id, **kwargs) must return an object with gpu_id,
+    size_bytes and unload() attributes.
+    """
+
+    def __init__(self, load_fn, max_models=2, memory_budget_bytes=None):
+        self.load_fn = load_fn
+        self.max_models = max_models
+        self.memory_budget_bytes = memory_budget_bytes
+        self._entries = OrderedDict()
+        self._last_used = {}
+        self._loading = {}
+        self._preload_status = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, model_id):
+        with self._lock:
+            return model_id in self._entries
+
+    def get(self, model_id, gpu_id=None, **load_kwargs):
+        with self._lock:
+            entry = self._entries.get(model_id)
+            if entry is not None and (gpu_id is None or entry.gpu_id == gpu_id):
+                self._entries.move_to_end(model_id)
+                self._last_used[model_id] = time.time()
+                return entry
+            future = self._loading.get(model_id)
+            owner = future is None
+            if owner:
+                future = self._loading[model_id] = Future()
+
+        if not owner:
+            # Someone else is already loading this model; share their result
+            return future.result()
+
+        # Nothing is evicted until the new model has loaded, so a failed load leaves the pool as it was
+        try:
+            entry = self.load_fn(model_id, gpu_id, **load_kwargs)
+        except Exception as e:
+            with self._lock:
+                del self._loading[model_id]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            stale = [self._pop(model_id)] if model_id in self._entries else []
+            self._entries[model_id] = entry
+            self._last_used[model_id] = time.time()
+            del self._loading[model_id]
+            while len(self._entries) > self.max_models or (len(self._entries) > 1 and self._over_budget()):
+                stale.append(self._pop(next(iter(self._entries))))
+        for old in stale:
+            self._unload(old)
+        future.set_result(entry)
+        return entry
+
+    def peek(self, model_id):
+        """The resident entry for model_id, or None; never loads and leaves the LRU order alone."""
+        with self._lock:
+            return self._entries.get(model_id)
+
+    def is_available(self, model_id):
+        """True if model_id is resident or being loaded (e.g. by /preload)."""
+        with self._lock:
+            return model_id in self._entries or model_id in self._loading
+
+    def preload(self, model_id, gpu_id=None, **load_kwargs):
+        with self._lock:
+            if model_id in self._entries or model_id in self._loading:
+                return False
+            self._preload_status[model_id] = 'loading'
+
+        def run():
+            try:
+                self.get(model_id, gpu_id, **load_kwargs)
+                status = 'ready'
+            except Exception as e:
+                status = f'failed: {e}'
+            with self._lock:
+                self._preload_status[model_id] = status
+
+        threading.Thread(target=run, name=f"preload-{model_id}", daemon=True).start()
+        return True
+
+    def evict(self, model_id):
+        with self._lock:
+            entry = self._pop(model_id) if model_id in self._entries else None
+        if entry is not None:
+            self._unload(entry)
+        return entry is not None
+
+    def status(self):
+        with self._lock:
+            return {
+                'max_models': self.max_models,
+                'memory_budget_bytes': self.memory_budget_bytes,
+                'resident_bytes': sum(entry.size_bytes for entry in self._entries.values()),
+                'resident': [
+                    {
+                        'model_id': model_id,
+                        'gpu_id': entry.gpu_id,
+                        'size_bytes': entry.size_bytes,
+                        'last_used': self._last_used.get(model_id),
+                    }
+                    # Most recently used first
+                    for model_id, entry in reversed(self._entries.items())
+                ],
+                'loading': list(self._loading),
+                'preload': dict(self._preload_status),
+            }
+
+    def _over_budget(self):
+        if self.memory_budget_bytes is None:
+            return False
+        return sum(entry.size_bytes for entry in self._entries.values()) > self.memory_budget_bytes
+
+    def _unload(self, entry):
+        # unload() waits for requests still holding the model, so it never runs on the caller's thread
+        threading.Thread(target=entry.unload, name="unload-model", daemon=True).start()
+
+    def _pop(self, model_id):
+        self._last_used.pop(model_id, None)
+        return self._entries.pop(model_id)
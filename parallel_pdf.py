@@ -0,0 +1,104 @@
+import math
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pypdf
+from langchain_core.documents import Document
+
+from metrics import observe
+
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', os.cpu_count() or 1))
+MIN_PAGES_PER_SHARD = 8
+
+def page_count(file_path):
+    return len(pypdf.PdfReader(file_path).pages)
+
+def plan_shards(num_pages, workers, pages_per_shard=None):
+    if pages_per_shard is None:
+        # A few shards per worker keeps the pool busy when some pages are much slower to parse
+        pages_per_shard = max(MIN_PAGES_PER_SHARD, math.ceil(num_pages / (workers * 4)))
+    return [(start, min(start + pages_per_shard, num_pages)) for start in range(0, num_pages, pages_per_shard)]
+
+def load_pages(file_path, start, end):
+    # Same text and metadata as PyPDFLoader(file_path).load(), restricted to [start, end)
+    reader = pypdf.PdfReader(file_path)
+    return [
+        Document(
+            page_content=reader.pages[page_number].extract_text(extraction_mode="plain"),
+            metadata={"source": file_path, "page": page_number},
+        )
+        for page_number in range(start, end)
+    ]
+
+def load_and_split_shard(file_path, start, end, split_fn):
+    # Splitters split each page Document on its own, so chunks (and their
+    # overlap) never cross a page and therefore never cross a shard boundary.
+    return split_fn(load_pages(file_path, start, end))
+
+def timed_load_and_split_shard(file_path, start, end, split_fn):
+    # Workers cannot update the parent's metrics, so they return their timings with the splits
+    started = time.perf_counter()
+    docs = load_pages(file_path, start, end)
+    loaded = time.perf_counter()
+    splits = split_fn(docs)
+    return splits, loaded - started, time.perf_counter() - loaded
+
+def iter_pdf_shards(file_path, split_fn, executor=None, workers=PDF_WORKERS, pages_per_shard=None,
+                    max_in_flight=None):
+    """Yield (splits, pages_done, total_pages) for each page shard, in page order.
+
+    At most max_in_flight shards are parsed ahead of the consumer, so memory
+    stays bounded by the window rather than by the size of the document.
+    split_fn(docs) must be a module-level function so it can be sent to the
+    workers.
+    """
+    total_pages = page_count(file_path)
+    shards = plan_shards(total_pages, workers, pages_per_shard)
+    if workers <= 1 or len(shards) <= 1:
+        for start, end in shards:
+            splits, load_seconds, split_seconds = timed_load_and_split_shard(file_path, start, end, split_fn)
+            observe('pdf_load', load_seconds)
+            observe('split', split_seconds)
+            yield splits, end, total_pages
+        return
+
+    max_in_flight = max_in_flight or workers * 2
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=min(workers, len(shards)))
+    shard_iter = iter(shards)
+    pending = deque()
+    try:
+        for start, end in shard_iter:
+            pending.append((end, executor.submit(timed_load_and_split_shard, file_path, start, end, split_fn)))
+            if len(pending) >= max_in_flight:
+                break
+        while pending:
+            end, future = pending.popleft()
+            splits, load_seconds, split_seconds = future.result()
+            observe('pdf_load', load_seconds)
+            observe('split', split_seconds)
+            # Refill the window before handing the shard over so the workers stay busy
+            next_shard = next(shard_iter, None)
+            if next_shard is not None:
+                next_start, next_end = next_shard
+                pending.append((next_end, executor.submit(timed_load_and_split_shard, file_path, next_start, next_end, split_fn)))
+            yield splits, end, total_pages
+    finally:
+        for _, future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown()
+
+def load_pdf_parallel(file_path, split_fn, executor=None, workers=PDF_WORKERS, pages_per_shard=None):
+    """Load and split a whole PDF with page ranges sharded across processes.
+
+    The result is identical to split_fn(PyPDFLoader(file_path).load()).
+    """
+    return [
+        split
+        for splits, _, _ in iter_pdf_shards(file_path, split_fn, executor, workers, pages_per_shard)
+        for split in splits
+    ]
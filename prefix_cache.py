@@ -0,0 +1,108 @@
+import copy
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+from transformers import DynamicCache
+
+PREFIX_CACHE_MB = float(os.environ.get('PREFIX_CACHE_MB', 512))
+# A prompt's shared prefix ends after the first of these markers (the Phi-3 system block)
+PREFIX_CACHE_MARKERS = tuple(os.environ.get('PREFIX_CACHE_MARKERS', '<|end|>').split(','))
+PREFIX_CACHE_MIN_TOKENS = int(os.environ.get('PREFIX_CACHE_MIN_TOKENS', 16))
+
+def cache_nbytes(cache):
+    if hasattr(cache, 'layers'):
+        tensors = [t for layer in cache.layers for t in (layer.keys, layer.values) if t is not None]
+    else:
+        tensors = [*cache.key_cache, *cache.value_cache]
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+class PrefixCache:
+    """LRU of prefilled past-key-values for shared prompt prefixes, keyed by a hash of the prefix token ids.
+
+    lookup() returns a private copy of the cached state that model.generate can
+    resume from, so only the tokens after the prefix are prefilled.
+    """
+
+    def __init__(self, model, tokenizer, max_bytes=int(PREFIX_CACHE_MB * 1024 ** 2),
+                 markers=PREFIX_CACHE_MARKERS, min_tokens=PREFIX_CACHE_MIN_TOKENS):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_bytes = max_bytes
+        self.markers = markers
+        self.min_tokens = min_tokens
+        # Models still on the legacy tuple cache (e.g. GPT-2 in transformers 4.45) cannot resume from a
+        # DynamicCache, so prefix reuse is off for them and every prompt is prefilled in full
+        self.enabled = bool(getattr(model, '_supports_cache_class', False))
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.tokens_reused = 0
+
+    def prefix_of(self, prompt):
+        for marker in self.markers:
+            end = prompt.find(marker)
+            if end != -1:
+                return prompt[:end + len(marker)]
+        return None
+
+    def lookup(self, prompt, input_ids):
+        """Cached state for prompt's prefix, or None when the prompt has no usable prefix."""
+        if not self.enabled:
+            return None
+        prefix = self.prefix_of(prompt)
+        if prefix is None or input_ids.shape[0] != 1:
+            return None
+        prefix_ids = self.tokenizer(prefix, return_tensors="pt")['input_ids'].to(input_ids.device)
+        length = prefix_ids.shape[1]
+        # The prefix must tokenize identically inside the full prompt and leave at least one token to prefill
+        if length < self.min_tokens or length >= input_ids.shape[1] or not torch.equal(input_ids[:, :length], prefix_ids):
+            return None
+
+        key = hashlib.blake2b(prefix_ids.cpu().numpy().tobytes(), digest_size=16).hexdigest()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.tokens_reused += length
+                # generate() appends to the cache it is given, so every request gets its own copy
+                return copy.deepcopy(entry[0])
+            self.misses += 1
+
+        with torch.no_grad():
+            cache = self.model(input_ids=prefix_ids, past_key_values=DynamicCache(), use_cache=True).past_key_values
+        nbytes = cache_nbytes(cache)
+        if nbytes <= self.max_bytes:
+            with self._lock:
+                if key not in self._entries:
+                    self._entries[key] = (cache, nbytes)
+                    self._bytes += nbytes
+                while self._bytes > self.max_bytes:
+                    _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                    self._bytes -= evicted_bytes
+                    self.evictions += 1
+        return copy.deepcopy(cache)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'tokens_reused': self.tokens_reused,
+            }
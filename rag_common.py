@@ -0,0 +1,37 @@
+from langchain_core.documents import Document
+from langchain_huggingface import HuggingFaceEmbeddings
+
+from ann_index import VECTOR_BACKEND
+from embedding_cache import CachedEmbeddings
+from vector_index import PersistentIndex
+
+def create_embeddings():
+    model_name = "sentence-transformers/all-mpnet-base-v2"
+    return CachedEmbeddings(HuggingFaceEmbeddings(model_name=model_name), model_name)
+
+def open_persistent_index(index_dir, source, source_hash, load_splits, backend=VECTOR_BACKEND):
+    """Vector store persisted in index_dir; load_splits() is only called when source_hash changed."""
+    index = PersistentIndex(index_dir, create_embeddings(), backend=backend)
+    index.sync(source, source_hash, load_splits)
+    return index.vectorstore
+
+def pack_documents(packer, prompt, docs, question):
+    chunks = [{'text': doc.page_content, 'source': doc.metadata.get('source'), 'page': doc.metadata.get('page')} for doc in docs]
+    texts, stats = packer.pack(chunks, prompt.format(input=question, context=""))
+    print(f"Context packing: {stats}")
+    return [Document(page_content=text) for text in texts]
+
+def iter_questions(question):
+    if question:
+        yield question
+        return
+    # Interactive / batch mode: one question per line on stdin until EOF
+    while True:
+        try:
+            line = input("Question> ").strip()
+        except EOFError:
+            return
+        if line in ("exit", "quit"):
+            return
+        if line:
+            yield line
@@ -1,22 +1,36 @@
 import argparse
-import requests
 from langchain_chroma import Chroma
 from langchain_community.document_loaders import WebBaseLoader, PyPDFLoader
 from langchain_core.prompts import PromptTemplate
+from langchain_core.runnables import RunnableLambda
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain.chains import create_retrieval_chain
-from typing import List, Optional, Any
-from langchain_core.callbacks import CallbackManagerForLLMRun
+from typing import List, Optional, Any, Iterator
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.outputs import GenerationChunk
 import bs4, os
 
 from langchain_core.language_models.llms import LLM
 from pydantic import Field
 
+from ann_index import VECTOR_BACKEND
+from ann_vectorstore import ANNVectorStore
+from context_packer import ContextPacker
+from rag_common import create_embeddings, iter_questions, open_persistent_index, pack_documents
+from tokenizer_service import TokenCounter
+from vector_index import file_hash, documents_hash
+from batch_qa import answer_questions_file
+from model_client import ModelClient, get_client, get_async_client
+from parallel_pdf import PDF_WORKERS, load_pdf_parallel
+
 class LocalLLM(LLM):
     api_url: str = Field(..., description="URL of the local model API")
 
+    @property
+    def client(self) -> ModelClient:
+        return get_client(self.api_url)
+
     def _call(
         self,
         prompt: str,
@@ -24,11 +38,29 @@ class LocalLLM(LLM):
         run_manager: Optional[CallbackManagerForLLMRun] = None,
         **kwargs: Any,
     ) -> str:
-        response = requests.post(f"{self.api_url}/generate", json={"prompt": prompt})
-        if response.status_code == 200:
-            return response.json()['generated_text']
-        else:
-            raise Exception(f"API request failed: {response.text}")
+        return self.client.generate(prompt)
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        return await get_async_client(self.api_url).generate(prompt)
+
+    def _stream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[GenerationChunk]:
+        for token in self.client.stream(prompt):
+            chunk = GenerationChunk(text=token)
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
 
     @property
     def _llm_type(self) -> str:
@@ -52,24 +84,49 @@ def load_pdf_file_content(file):
         raise ValueError(f"Unsupported file type: {file_extension}")
 
     
-def load_and_process_document(loader):
-    docs = loader.load()
+def split_documents(docs):
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
     return text_splitter.split_documents(docs)
 
-def create_vectorstore(splits):
-    embeddings_model = HuggingFaceEmbeddings(model_name="sentence-transformers/all-mpnet-base-v2")
-    return Chroma.from_documents(splits, embedding=embeddings_model)
+def load_and_process_document(loader):
+    return split_documents(loader.load())
+
+def load_and_process_pdf(file, workers=PDF_WORKERS):
+    # Validates the extension the same way as the sequential loader
+    load_pdf_file_content(file)
+    return load_pdf_parallel(file, split_documents, workers=workers)
 
-def create_multi_context_rag_chain(llm, retriever, num_contexts):
-    template = """<|system|>
+def create_vectorstore(splits, backend=VECTOR_BACKEND):
+    if backend == 'ann':
+        return ANNVectorStore.from_documents(splits, embedding=create_embeddings())
+    return Chroma.from_documents(splits, embedding=create_embeddings())
+
+def open_index(index_dir, file=None, url=None, workers=PDF_WORKERS, backend=VECTOR_BACKEND):
+    if file:
+        return open_persistent_index(index_dir, os.path.abspath(file), file_hash(file),
+                                     lambda: load_and_process_pdf(file, workers), backend)
+    # Pages have to be fetched to know whether they changed, but unchanged
+    # ones skip splitting and embedding
+    docs = load_url_content(url).load()
+    return open_persistent_index(index_dir, url, documents_hash(docs), lambda: split_documents(docs), backend)
+
+RAG_TEMPLATE = """<|system|>
 You are an assistant for question-answering tasks. Use the following pieces of retrieved context to answer the question. If you don't know the answer, just say that you don't know. Use three sentences maximum and keep the answer concise.<|end|>
 <|user|>
 Question: {input}
 Contexts:
 {context}<|end|>
 <|assistant|>"""
-    prompt = PromptTemplate.from_template(template)
+
+def create_multi_context_rag_chain(llm, retriever, num_contexts, packer=None):
+    prompt = PromptTemplate.from_template(RAG_TEMPLATE)
+
+    if packer is not None:
+        # Overlapping chunks are stitched and the set is trimmed to the model's token budget
+        base_retriever = retriever
+        retriever = RunnableLambda(
+            lambda inputs: pack_documents(packer, prompt, base_retriever.invoke(inputs["input"]), inputs["input"])
+        )
 
     def format_docs(docs):
         return "\n\n".join(f"Context {i+1}:\n{doc.page_content}" for i, doc in enumerate(docs))
@@ -77,32 +134,69 @@ Contexts:
     question_answer_chain = create_stuff_documents_chain(llm, prompt)
     return create_retrieval_chain(retriever, question_answer_chain)
 
+def ask(rag_chain, question, stream=False):
+    print(f"Sending question: {question}")
+    if stream:
+        for chunk in rag_chain.stream({"input": question}):
+            if 'answer' in chunk:
+                print(chunk['answer'], end="", flush=True)
+        print()
+    else:
+        response = rag_chain.invoke({"input": question})
+        print(response['answer'])
+
 def main():
     parser = argparse.ArgumentParser(description="RAG Chain Script")
     parser.add_argument("--model", default="microsoft/Phi-3-mini-4k-instruct", help="Model ID")
-    parser.add_argument("--question", required=True, help="Question to answer")
+    parser.add_argument("--question", help="Question to answer; if omitted, questions are read from stdin")
     parser.add_argument("--url", default="https://lilianweng.github.io/posts/2023-06-23-agent/", help="URL to process")
     parser.add_argument("--file",  help="File to process")
     parser.add_argument("--gpu", type=int, default=0, help="GPU ID to use")
     parser.add_argument("--api_url", default="http://localhost:5000", help="URL of the local model API")
     parser.add_argument("--num_contexts", type=int, default=4, help="Number of contexts to retrieve")
+    parser.add_argument("--stream", action="store_true", help="Print the answer as it is generated")
+    parser.add_argument("--workers", type=int, default=PDF_WORKERS, help="Processes used to parse and split PDF pages")
+    parser.add_argument("--index_dir", "--index-dir", help="Persist the vector index here and reuse it across runs")
+    parser.add_argument("--vector_backend", "--vector-backend", choices=["chroma", "ann"], default=VECTOR_BACKEND,
+                        help="Chroma or the in-process ANN index (tuned with ANN_N_LISTS / ANN_N_PROBE / ANN_PQ_M)")
+    parser.add_argument("--questions_file", "--questions-file", help="JSONL or CSV file with a 'question' field per record")
+    parser.add_argument("--output", default="answers.jsonl", help="Where --questions_file answers and timings are written")
+    parser.add_argument("--batch_size", type=int, default=32, help="Questions embedded and retrieved per batch")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent /generate requests")
     args = parser.parse_args()
 
     # Initialize the model
     llm = LocalLLM(api_url=args.api_url)  # Pass api_url as a named argument
 
-    if(args.file):
-        loader = load_pdf_file_content(args.file)
-        splits = load_and_process_document(loader)
+    if args.index_dir:
+        vectorstore = open_index(args.index_dir, file=args.file, url=args.url, workers=args.workers,
+                                 backend=args.vector_backend)
+    elif(args.file):
+        splits = load_and_process_pdf(args.file, args.workers)
+        vectorstore = create_vectorstore(splits, args.vector_backend)
     else:
         loader = load_url_content(args.url)
         splits = load_and_process_document(loader)
-    vectorstore = create_vectorstore(splits)
+        vectorstore = create_vectorstore(splits, args.vector_backend)
+
+    if args.questions_file:
+        answer_questions_file(
+            vectorstore,
+            PromptTemplate.from_template(RAG_TEMPLATE),
+            args.api_url,
+            args.questions_file,
+            args.output,
+            k=args.num_contexts,
+            batch_size=args.batch_size,
+            concurrency=args.concurrency,
+        )
+        return
+
     retriever = vectorstore.as_retriever()
-    rag_chain = create_multi_context_rag_chain(llm, retriever, args.num_contexts)
-    print(f"Sending question: {args.question}")
-    response = rag_chain.invoke({"input": args.question})
-    print(response['answer'])
+    packer = ContextPacker(TokenCounter(args.model).count_many)
+    rag_chain = create_multi_context_rag_chain(llm, retriever, args.num_contexts, packer)
+    for question in iter_questions(args.question):
+        ask(rag_chain, question, stream=args.stream)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
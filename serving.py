@@ -0,0 +1,17 @@
+import os
+
+# 'development' keeps Flask's debug server; 'production' serves the same app with waitress
+SERVER = os.environ.get('SERVER', 'development')
+SERVER_HOST = os.environ.get('SERVER_HOST', '127.0.0.1')
+SERVER_THREADS = int(os.environ.get('SERVER_THREADS', 16))
+SERVER_CONNECTION_LIMIT = int(os.environ.get('SERVER_CONNECTION_LIMIT', 256))
+
+def run_app(app, port, **dev_kwargs):
+    if SERVER != 'production':
+        app.run(debug=True, port=port, **dev_kwargs)
+        return
+    from waitress import serve
+    # One process on purpose: models, indexes and job queues live in this process's
+    # memory, and the handler threads only wait on them
+    print(f"Serving on http://{SERVER_HOST}:{port} with {SERVER_THREADS} threads")
+    serve(app, host=SERVER_HOST, port=port, threads=SERVER_THREADS, connection_limit=SERVER_CONNECTION_LIMIT)
@@ -0,0 +1,66 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from transformers import AutoTokenizer
+
+class TokenCounter:
+    def __init__(self, model_name="gpt2", max_cache_entries=100_000):
+        self.model_name = model_name
+        self.max_cache_entries = max_cache_entries
+        self._tokenizer = None
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            with self._lock:
+                if self._tokenizer is None:
+                    self._tokenizer = AutoTokenizer.from_pretrained(self.model_name, use_fast=True)
+        return self._tokenizer
+
+    def load(self):
+        return self.tokenizer
+
+    @staticmethod
+    def _key(text):
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+    def count(self, text):
+        return self.count_many([text])[0]
+
+    def count_many(self, texts):
+        keys = [self._key(text) for text in texts]
+        counts = [None] * len(texts)
+        missing = {}
+        with self._lock:
+            for i, key in enumerate(keys):
+                cached = self._counts.get(key)
+                if cached is None:
+                    missing.setdefault(key, []).append(i)
+                else:
+                    self._counts.move_to_end(key)
+                    counts[i] = cached
+
+        if missing:
+            missing_keys = list(missing)
+            missing_texts = [texts[missing[key][0]] for key in missing_keys]
+            # One call into the Rust tokenizer for the whole batch instead of a
+            # Python-level encode() per text.
+            encoded = self.tokenizer(
+                missing_texts,
+                add_special_tokens=False,
+                return_attention_mask=False,
+                return_token_type_ids=False,
+            )['input_ids']
+            with self._lock:
+                for key, ids in zip(missing_keys, encoded):
+                    for i in missing[key]:
+                        counts[i] = len(ids)
+                    self._counts[key] = len(ids)
+                while len(self._counts) > self.max_cache_entries:
+                    self._counts.popitem(last=False)
+        return counts
+
+token_counter = TokenCounter()
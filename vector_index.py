@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+
+from langchain_chroma import Chroma
+
+from ann_index import VECTOR_BACKEND
+from ann_vectorstore import ANNVectorStore
+
+MANIFEST_FILE = "manifest.json"
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def documents_hash(docs):
+    digest = hashlib.sha256()
+    for doc in docs:
+        digest.update(doc.page_content.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+class PersistentIndex:
+    """Chroma collection (or ANN index) on disk plus a manifest of which source versions it holds."""
+
+    def __init__(self, index_dir, embeddings, collection_name="rag", write_batch_size=1000, backend=VECTOR_BACKEND):
+        os.makedirs(index_dir, exist_ok=True)
+        self.index_dir = index_dir
+        self.write_batch_size = write_batch_size
+        if backend == 'ann':
+            self.vectorstore = ANNVectorStore(embeddings, persist_directory=os.path.join(index_dir, collection_name))
+        else:
+            self.vectorstore = Chroma(
+                collection_name=collection_name,
+                embedding_function=embeddings,
+                persist_directory=index_dir,
+            )
+        self.manifest_path = os.path.join(index_dir, MANIFEST_FILE)
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def is_current(self, source, source_hash):
+        entry = self.manifest.get(source)
+        return entry is not None and entry['hash'] == source_hash
+
+    def sync(self, source, source_hash, load_splits):
+        """Re-ingest source only if its hash differs from the manifest. Returns True if it was ingested."""
+        if self.is_current(source, source_hash):
+            print(f"Index up to date for {source}")
+            return False
+        splits = load_splits()
+        self.remove(source)
+        prefix = hashlib.sha1(source.encode('utf-8')).hexdigest()[:12] + '-' + source_hash[:12]
+        ids = [f"{prefix}-{i}" for i in range(len(splits))]
+        for start in range(0, len(splits), self.write_batch_size):
+            end = start + self.write_batch_size
+            self.vectorstore.add_documents(splits[start:end], ids=ids[start:end])
+        self.manifest[source] = {'hash': source_hash, 'ids': ids}
+        self._save_manifest()
+        print(f"Indexed {len(splits)} splits from {source}")
+        return True
+
+    def remove(self, source):
+        entry = self.manifest.pop(source, None)
+        if entry and entry['ids']:
+            self.vectorstore.delete(ids=entry['ids'])
+            self._save_manifest()
+
+    def _save_manifest(self):
+        # The ANN store keeps writes in memory, so it is saved with every manifest update
+        if isinstance(self.vectorstore, ANNVectorStore):
+            self.vectorstore.persist()
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)